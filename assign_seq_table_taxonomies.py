@@ -2,14 +2,23 @@
 
 '''
 Get the taxonomies for a seq table using greengenes (or whatever).
+
+Several tables (e.g., from different runs) can be done at once, so that the database
+and the taxonomies are only loaded once.
 '''
 
 import sys, argparse, tempfile, cPickle as pickle, ConfigParser, os, subprocess
 from Bio import Seq, SeqIO, SeqRecord
 
 
-def seq_table_to_fasta(table_fh, fasta_fh):
-    '''convert sequence table entries to a fasta'''
+def seq_table_to_fasta(table_fh, fasta_fh, start=0):
+    '''
+    convert sequence table entries to a fasta, numbered from start
+
+    returns : int
+        number of sequences
+    '''
+
     # get the sequences (throwing away the first line "SEQUENCE")
     seqs = [line.split()[0] for line in table_fh]
     seq_header = seqs.pop(0)
@@ -17,21 +26,44 @@ def seq_table_to_fasta(table_fh, fasta_fh):
     
     # write the fasta
     for i, seq in enumerate(seqs):
-        record = SeqRecord.SeqRecord(Seq.Seq(seq), id="seq%s" %(i), description='')
+        record = SeqRecord.SeqRecord(Seq.Seq(seq), id="seq%s" %(start + i), description='')
         SeqIO.write(record, fasta_fh, 'fasta')
+
+    return len(seqs)
         
-def write_tmp_fasta(table_fh, tmp_dir):
-    '''make a temporary fasta file'''
+def write_tmp_fasta(table_fhs, tmp_dir):
+    '''
+    make a temporary fasta file of the entries of one or more sequence tables
+
+    returns : tuple
+        (fasta filename, list of the number of sequences in each table)
+    '''
+
     fasta_fh = tempfile.NamedTemporaryFile(suffix='.fst', delete=False, dir=tmp_dir)
-    seq_table_to_fasta(table_fh, fasta_fh)
+
+    counts = []
+    for table_fh in table_fhs:
+        counts.append(seq_table_to_fasta(table_fh, fasta_fh, start=sum(counts)))
     
     fasta_fn = fasta_fh.name
     fasta_fh.close()
     
-    return fasta_fn
+    return fasta_fn, counts
+
+def split_by_counts(items, counts):
+    '''[a, b, c], [2, 1] -> [[a, b], [c]]'''
+    starts = [sum(counts[:i]) for i in range(len(counts))]
+    return [items[start: start + count] for start, count in zip(starts, counts)]
 
-def usearch_against_database_cmd(usearch, table_fh, tmp_dir, db, fid, no_hit=None, strand='both'):
-    fasta_fn = write_tmp_fasta(table_fh, tmp_dir)
+def usearch_against_database_cmd(usearch, table_fhs, tmp_dir, db, fid, no_hit=None, strand='both'):
+    '''
+    command to search the sequences of some tables against a database
+
+    returns : tuple
+        (command, .uc filename, number of sequences in each table)
+    '''
+
+    fasta_fn, counts = write_tmp_fasta(table_fhs, tmp_dir)
     uc_fh = tempfile.NamedTemporaryFile(suffix='.uc', delete=True, dir=tmp_dir)
     uc_fn = uc_fh.name
     uc_fh.close()
@@ -43,7 +75,7 @@ def usearch_against_database_cmd(usearch, table_fh, tmp_dir, db, fid, no_hit=Non
     
     print "  temporary fasta: %s" % fasta_fn
     print "  temporary uc: %s" % uc_fn
-    return cmd, uc_fn
+    return cmd, uc_fn, counts
 
 def uc_to_ids(uc_fh):
     ids = []
@@ -85,15 +117,21 @@ def lookup_taxonomies(ids, tax_pkl_fh, no_match=None, no_match_label=None):
 if __name__ == '__main__':
     # parse command line arguments
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('table', help='input sequence table')
+    parser.add_argument('table', nargs='+', help='input sequence table(s)')
     parser.add_argument('-s', '--sid', default='99', help='greengenes repset identity')
     parser.add_argument('-i', '--fid', default='0.995', help='fractional identity to make hit')
     parser.add_argument('--output', '-o', default=sys.stdout, type=argparse.FileType('w'), help='output file')
+    parser.add_argument('--outputs', nargs='+', default=None, help='output file for each table, when there are several')
     parser.add_argument('--no_hit', default=None, help='get unmatched sequences as separate fasta?')
     parser.add_argument('--no_match', '-n', default='*', help='no match indicator in uc')
     parser.add_argument('--no_match_label', '-l', default='k__; p__; c__; o__; f__; g__; s__', help='taxonomy for no match')
     
     args = parser.parse_args()
+
+    if args.outputs is None and len(args.table) > 1:
+        raise RuntimeError("several tables need --outputs")
+    elif args.outputs is not None and len(args.outputs) != len(args.table):
+        raise RuntimeError("got %d tables but %d outputs" %(len(args.table), len(args.outputs)))
     
     # grab the configuration file
     config = ConfigParser.ConfigParser()
@@ -106,8 +144,10 @@ if __name__ == '__main__':
     tmp_dir = config.get('User', 'tmp_directory')
     
     gg_fasta = os.path.join(gg_dir, "%s_otus.fasta" %(args.sid))
-    with open(args.table) as f:
-        cmd, uc_fn = usearch_against_database_cmd(usearch, f, tmp_dir, gg_fasta, args.fid, args.no_hit)
+    table_fhs = [open(fn) for fn in args.table]
+    cmd, uc_fn, counts = usearch_against_database_cmd(usearch, table_fhs, tmp_dir, gg_fasta, args.fid, args.no_hit)
+    for fh in table_fhs:
+        fh.close()
     
     subprocess.call(cmd)
     
@@ -116,5 +156,10 @@ if __name__ == '__main__':
     
     with open(gg_tax) as f:
         taxs = lookup_taxonomies(ids, f, args.no_match, args.no_match_label)
-        
-    args.output.write("\n".join(taxs) + "\n")
\ No newline at end of file
+
+    if args.outputs is None:
+        args.output.write("\n".join(taxs) + "\n")
+    else:
+        for fn, table_taxs in zip(args.outputs, split_by_counts(taxs, counts)):
+            with open(fn, 'w') as f:
+                f.write("\n".join(table_taxs) + "\n")
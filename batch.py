@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+'''
+Process many sequencing runs together, as one dependency graph.
+
+Each run is an ordinary otu_caller run in its own directory. Its stages run in order,
+as otu_caller would run them, except for the stages that search a shared reference:
+mapping to Greengenes (ref_gg), removing reference chimeras (ref_chimeras), and
+assigning taxonomies to a sequence table (seq_tax). Those are done once for all the
+runs that reach them: the runs' sequences are pooled (see pool_runs.py), searched in
+one command, which loads the reference once, and split back into each run's directory.
+Everything else about a run is left to otu_caller, which is called with --only for the
+stretches of stages between the shared ones.
+
+The manifest has one run per line: the run's directory (relative to the manifest)
+followed by its otu_caller options, e.g.,
+
+    run1 --forward run1_1.fastq --reverse run1_2.fastq -p AGAGTTTGATCCTGGCTCAG --all
+    run2 --forward run2_1.fastq --reverse run2_2.fastq -p AGAGTTTGATCCTGGCTCAG --all
+
+Blank lines and lines starting with # are ignored.
+'''
+
+import argparse, os, shlex, pipes, tempfile, shutil
+import otu_caller, scheduler
+from util import message
+
+# stages that search a shared reference, done once for all the runs
+reference_stages = ['ref_gg', 'ref_chimeras', 'seq_tax']
+
+def map_sid(sid):
+    '''identity for mapping to the reference at some OTU identity (see OTU_Caller.get_filenames)'''
+    return 0.5 * (100.0 + float(sid))
+
+
+class Run():
+    '''one run of the pipeline: its directory, otu_caller options, and stages'''
+
+    def __init__(self, name, run_dir, options, args):
+        '''
+        name : string
+            unique name for the run
+        run_dir : string
+            directory the run's files are in
+        options : list of strings
+            the run's otu_caller options
+        args : parsed options (see otu_caller.parse_args)
+        '''
+
+        self.name = name
+        self.dir = os.path.abspath(run_dir)
+        self.options = list(options)
+        self.args = args
+        self.stages = otu_caller.selected_stages(args)
+
+    def __repr__(self):
+        return "Run(%s)" %(self.name)
+
+    def fn(self, fn):
+        '''a filename in the run's directory'''
+        return os.path.join(self.dir, fn)
+
+    def shares(self, stage):
+        '''does the run do this stage with the shared reference?'''
+        if stage == 'ref_gg':
+            # de novo runs map to their own OTUs
+            return stage in self.stages and not self.args.denovo
+        else:
+            return stage in self.stages
+
+    def groups(self, stage):
+        '''
+        keys of the pooled searches of a shared stage that this run is part of. runs
+        with the same key search the same reference in the same way.
+        '''
+
+        if stage == 'ref_gg':
+            return [(sid, bool(self.args.open_ref_gg)) for sid in self.args.sids]
+        elif stage == 'ref_chimeras':
+            return [(sid, self.args.gold_db) for sid in self.args.sids]
+        elif stage == 'seq_tax':
+            return [()]
+
+
+def read_manifest(lines, base_dir='.', parse=None):
+    '''
+    Runs from the lines of a manifest
+
+    lines : iterator of strings
+    base_dir : string (default current directory)
+        directory that the run directories are relative to
+    parse : function (default otu_caller.parse_args, without saving)
+        list of options -> parsed options
+
+    returns : list of Runs
+    '''
+
+    if parse is None:
+        parse = lambda options: otu_caller.parse_args(options, save=False)
+
+    runs = []
+    for line in lines:
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+
+        words = shlex.split(line)
+        args = parse(words[1:])
+
+        if args.redo or args.detach:
+            raise RuntimeError("run %s: --redo and --detach cannot be used in a batch" %(words[0]))
+
+        runs.append(Run(words[0], os.path.join(base_dir, words[0]), words[1:], args))
+
+    names = [run.name for run in runs]
+    if len(set(names)) != len(names):
+        raise RuntimeError("runs must be in different directories")
+
+    return runs
+
+
+class Batch():
+    '''builds the dependency graph of the stages of many runs'''
+
+    def __init__(self, runs, work_dir, library, usearch, ggdb, local=True):
+        '''
+        runs : list of Runs
+        work_dir : string
+            directory for the pooled files
+        library : string
+            SmileTrain directory
+        usearch : string
+            usearch executable
+        ggdb : string
+            directory with the Greengenes rep sets (e.g., 97_otus.fasta)
+        local : bool (default True)
+            run each run's stages locally, in the process that runs its task
+        '''
+
+        self.runs = runs
+        self.work_dir = work_dir
+        self.library = library
+        self.usearch = usearch
+        self.ggdb = ggdb
+        self.local = local
+
+    def pool_cmd(self, fns, pooled):
+        return ['python', '%s/pool_runs.py' %(self.library), 'pool'] + fns + ['--output', pooled]
+
+    def split_cmd(self, pooled, outputs, format):
+        return ['python', '%s/pool_runs.py' %(self.library), 'split', pooled] + outputs + ['--format', format]
+
+    def run_task(self, run, stages, deps):
+        '''task that runs a stretch of a run's stages with otu_caller'''
+        options = run.options + ['--only', ",".join(stages)]
+        if self.local and not (run.args.local or run.args.dry_run):
+            options.append('--local')
+
+        cmd = "cd %s && python %s/otu_caller.py %s" %(pipes.quote(run.dir), self.library, " ".join([pipes.quote(x) for x in options]))
+        return scheduler.Task('%s: %s' %(run.name, ",".join(stages)), [cmd], deps=deps, stage='run')
+
+    def shared_task(self, stage, key, runs, deps):
+        '''task that does a shared stage for some runs at once'''
+        if stage == 'ref_gg':
+            sid, open_ref = key
+            name = 'ref_gg %d%s' %(sid, ' open' if open_ref else '')
+            base = os.path.join(self.work_dir, name.replace(' ', '.'))
+            db = '%s/%d_otus.fasta' %(self.ggdb, sid)
+
+            notmatched = None
+            if open_ref:
+                notmatched = base + '.no_match.fst'
+
+            cmds = [self.pool_cmd([run.fn('q.derep.fst') for run in runs], base + '.fst'),
+                otu_caller.reference_map_cmd(self.usearch, base + '.fst', db, base + '.uc', map_sid(sid), notmatched)]
+
+            outputs = [run.fn('otus.%d.uc' %(sid)) for run in runs]
+            cmds.append(self.split_cmd(base + '.uc', outputs, 'uc'))
+
+            if open_ref:
+                cmds.append(self.split_cmd(notmatched, [run.fn('q.%d.no_match.fst' %(sid)) for run in runs], 'fasta'))
+        elif stage == 'ref_chimeras':
+            sid, gold_db = key
+            name = 'ref_chimeras %d %s' %(sid, gold_db)
+            base = os.path.join(self.work_dir, 'ref_chimeras.%d.%d' %(sid, sorted(set([run.args.gold_db for run in self.runs])).index(gold_db)))
+
+            outputs = [run.fn('otus.%d.fst' %(sid)) for run in runs]
+            cmds = [self.pool_cmd(outputs, base + '.fst'),
+                otu_caller.reference_chimeras_cmd(self.usearch, base + '.fst', gold_db, base + '.nonchimeras.fst'),
+                self.split_cmd(base + '.nonchimeras.fst', outputs, 'fasta')]
+        elif stage == 'seq_tax':
+            name = 'seq_tax'
+            outputs = [run.fn('seq.tax') for run in runs]
+            cmds = [['python', '%s/assign_seq_table_taxonomies.py' %(self.library)] + [run.fn('seq.counts') for run in runs] + ['--outputs'] + outputs]
+
+        return scheduler.Task(name, cmds, deps=deps, outputs=outputs, stage=stage)
+
+    def tasks(self):
+        '''
+        The tasks of all the runs. Each run's stretches of stages between shared stages
+        follow one another; a shared stage waits for every run that takes part in it.
+
+        returns : list of scheduler.Tasks
+        '''
+
+        tasks = []
+
+        # for each run, its pieces in order: lists of its own stages, or (stage, keys)
+        # of the shared searches it takes part in
+        pieces = dict([(run, []) for run in self.runs])
+        members = {}
+        for run in self.runs:
+            own = []
+            for stage in run.stages:
+                if stage in reference_stages and run.shares(stage):
+                    if len(own) > 0:
+                        pieces[run].append(own)
+                        own = []
+
+                    keys = run.groups(stage)
+                    pieces[run].append((stage, keys))
+                    for key in keys:
+                        members.setdefault((stage, key), []).append(run)
+                else:
+                    own.append(stage)
+
+            if len(own) > 0:
+                pieces[run].append(own)
+
+        # shared tasks first, so that the runs can point to them; each one depends on
+        # the task before it in each of its runs
+        shared = {}
+        for stage, key in sorted(members.keys()):
+            shared[(stage, key)] = self.shared_task(stage, key, members[(stage, key)], [])
+            tasks.append(shared[(stage, key)])
+
+        for run in self.runs:
+            deps = []
+            for piece in pieces[run]:
+                if isinstance(piece, list):
+                    task = self.run_task(run, piece, deps)
+                    tasks.append(task)
+                    deps = [task]
+                else:
+                    stage, keys = piece
+                    for key in keys:
+                        shared[(stage, key)].deps += [dep for dep in deps if dep not in shared[(stage, key)].deps]
+
+                    deps = [shared[(stage, key)] for key in keys]
+
+        return tasks
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run many sequencing runs together, sharing reference searches', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('manifest', help='file with one run per line: directory, then otu_caller options')
+    parser.add_argument('--n_cpus', '-n', type=int, default=None, help='number of tasks to run at once (default: one per run)')
+    parser.add_argument('--retries', default=0, type=int, help='number of times to rerun a task that fails')
+    parser.add_argument('--work_dir', default=None, help='directory for pooled files (default: a new directory, removed at the end)')
+    group_run = parser.add_mutually_exclusive_group()
+    group_run.add_argument('--dry_run', '-z', action='store_true', help='just print the tasks and their commands')
+    group_run.add_argument('--local', '-l', action='store_true', help='run the tasks on this machine, rather than as cluster jobs')
+    args = parser.parse_args()
+
+    config = otu_caller.config
+
+    with open(args.manifest) as f:
+        runs = read_manifest(f, os.path.dirname(os.path.abspath(args.manifest)))
+
+    if args.dry_run:
+        method = 'dry_run'
+    elif args.local:
+        method = 'local'
+    else:
+        method = 'submit'
+
+    work_dir = args.work_dir
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='.SmileTrain.batch.', dir=os.getcwd())
+    elif not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    batch = Batch(runs, os.path.abspath(work_dir), config.get('Scripts', 'library'), config.get('User', 'usearch'), config.get('Data', 'greengenes'))
+    sub = otu_caller.Submitter(method, n_cpus=args.n_cpus or len(runs), cluster=config.get('User', 'cluster'), retries=args.retries)
+
+    message('Running %d run(s) as one dependency graph' %(len(runs)))
+    try:
+        sub.execute_graph(batch.tasks())
+    finally:
+        sub.close()
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
@@ -44,12 +44,12 @@ def check_illumina_format(inputs, targets):
     # check all the formats
     formats = [file_format(i) for i in inputs]
     tests = [form in targets for form in formats]
-    bad_files = [i for i, test in zip(i, tests) if test == False]
+    bad_files = [i for i, test in zip(inputs, tests) if test == False]
     bad_forms = [form for form, test in zip(formats, tests) if test == False]
     
     # complain if something went wrong
     if False in tests:
-        bad_info = "\n".join([" ".join([i, form]) for i, form in zip(bad_files, bad_forms)])
+        bad_info = "\n".join(["%s %s" %(getattr(i, 'name', i), form) for i, form in zip(bad_files, bad_forms)])
         raise RuntimeError("files do not appear to be in %s format: \n%s" % (targets, bad_info))
     else:
         return True
@@ -101,16 +101,22 @@ def fastq_record_format(record):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Use quality scores to check if fastq is in Illumina 1.3-1.7 format or Illumina 1.8 format', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('fastq', help='input fastq')
+    parser.add_argument('fastq', nargs='+', help='input fastq(s)')
+    parser.add_argument('--require', nargs='+', default=None, choices=['illumina13', 'illumina18', 'ambiguous'], help='fail unless every fastq is in one of these formats')
     args = parser.parse_args()
-    
-    with open(args.fastq) as f:
-        format_guess = file_format(f)
-        if format_guess == 'illumina13':
-            print "Illumina 1.3-1.7 format"
-        elif format_guess == 'illumina18':
-            print "Illumina 1.8 format"
-        elif format_guess == 'ambiguous':
-            print "Could be either 1.3-1.7 or 1.8 format. Ambiguous."
-        else:
-            raise RuntimeError
\ No newline at end of file
+
+    if args.require is not None:
+        check_illumina_format(args.fastq, args.require)
+        sys.exit(0)
+
+    for fastq in args.fastq:
+        with open(fastq) as f:
+            format_guess = file_format(f)
+            if format_guess == 'illumina13':
+                print "Illumina 1.3-1.7 format"
+            elif format_guess == 'illumina18':
+                print "Illumina 1.8 format"
+            elif format_guess == 'ambiguous':
+                print "Could be either 1.3-1.7 or 1.8 format. Ambiguous."
+            else:
+                raise RuntimeError
\ No newline at end of file
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+'''
+De novo OTU clustering by greedy, abundance-sorted centroid picking (as in UPARSE).
+
+Input is a dereplicated fasta with abundances in the labels, like
+    >seq0;counts=1000
+    ACGT...
+
+Sequences are processed in order of decreasing abundance. Each sequence joins the most
+similar existing centroid that is at least sid percent identical to it; if there is no
+such centroid, the sequence becomes a new centroid.
+
+All sequence identities are clustered in a single pass. For every sequence, candidate
+centroids are found with a k-mer index and aligned once (with a band wide enough for the
+loosest identity). Those alignments are then reused to make the decision at every identity.
+
+For each identity sid, writes
+    * prefix.sid.fst, the OTU representative sequences
+    * with --uc, prefix.sid.uc, a uc file with a hit line (sequence label -> OTU) for every
+      input. The pipeline leaves this out: mapping to the OTUs with --ref_gg makes the .uc
+      files, after any chimeric OTUs are removed.
+'''
+
+import sys, argparse, re
+from Bio import SeqIO, SeqRecord, Seq
+import util, util_align
+
+def kmers(seq, k):
+    '''set of distinct length-k words in seq'''
+    return set([seq[i: i + k] for i in range(len(seq) - k + 1)])
+
+def label_abundance(label):
+    '''seq0;counts=400 or seq0;size=400 -> 400'''
+    m = re.search('(counts|size)=(\d+)', label)
+    if m is None:
+        raise RuntimeError("sequence label has no abundance: %s" % label)
+    else:
+        return int(m.group(2))
+
+def uc_hit_line(cluster, seq, pct_id, label, otu):
+    '''fields for a uc H line; the alignment is not recorded'''
+    return "\t".join(['H', str(cluster), str(len(seq)), "%.1f" % pct_id, '+', '0', '0', '*', label, otu])
+
+
+class GreedyClusterer():
+    def __init__(self, sids, k=8, max_candidates=32, rename=True):
+        '''
+        sids : list of numbers
+            percent identities to cluster at (e.g., [91, 97])
+        k : int (default 8)
+            word length for the candidate k-mer index
+        max_candidates : int (default 32)
+            align at most this many candidates (those sharing the most k-mers); 0 means all
+        rename : bool (default True)
+            name OTUs OTU{sid}_1, OTU{sid}_2, etc.? if not, use the centroid's label
+        '''
+
+        self.sids = sorted(sids)
+        self.k = k
+        self.max_candidates = max_candidates
+        self.rename = rename
+
+        # pool of every sequence that is a centroid at any identity
+        self.pool_seqs = []
+        self.pool_kmers = {}
+
+        # for each identity, {pool index => OTU name} and lists of centroids and hits
+        self.otu_names = {sid: {} for sid in self.sids}
+        self.centroids = {sid: [] for sid in self.sids}
+        self.hits = {sid: [] for sid in self.sids}
+
+    def candidates(self, seq, seq_kmers):
+        '''
+        Find pool centroids that could be within the loosest identity of seq.
+
+        A sequence at edit distance d from seq must share all but k*d of seq's distinct
+        k-mers (q-gram lemma), so centroids sharing fewer k-mers are skipped unaligned.
+
+        returns : list of ints
+            pool indices, in order of decreasing shared k-mers
+        '''
+
+        shared = {}
+        for kmer in seq_kmers:
+            for i in self.pool_kmers.get(kmer, []):
+                shared[i] = shared.get(i, 0) + 1
+
+        loosest = self.sids[0]
+        passed = []
+        for i, n_shared in shared.items():
+            other_len = len(self.pool_seqs[i])
+            d = util_align.max_differences(loosest, len(seq), other_len)
+            if abs(len(seq) - other_len) <= d and n_shared >= len(seq_kmers) - self.k * d:
+                passed.append((-n_shared, i))
+
+        passed.sort()
+        if self.max_candidates > 0:
+            passed = passed[:self.max_candidates]
+
+        return [i for n, i in passed]
+
+    def add(self, label, seq):
+        '''assign one sequence to an OTU at every identity'''
+
+        seq_kmers = kmers(seq, self.k)
+        candidates = self.candidates(seq, seq_kmers)
+
+        # one banded alignment of seq against all candidates, shared by all identities
+        if len(candidates) > 0:
+            targets = [self.pool_seqs[i] for i in candidates]
+            band = max([util_align.max_differences(self.sids[0], len(seq), len(t)) for t in targets])
+            distances = util_align.edit_distances(seq, targets, band)
+        else:
+            targets = []
+            distances = []
+
+        pool_index = None
+        for sid in self.sids:
+            best = None
+            for i, target, d in zip(candidates, targets, distances):
+                if i in self.otu_names[sid] and d <= util_align.max_differences(sid, len(seq), len(target)):
+                    if best is None or d < best[1]:
+                        best = (i, d, target)
+
+            if best is not None:
+                i, d, target = best
+                pct_id = 100.0 * util_align.identity(d, len(seq), len(target))
+                otu = self.otu_names[sid][i]
+            else:
+                # this sequence is a new centroid
+                if pool_index is None:
+                    pool_index = len(self.pool_seqs)
+                    self.pool_seqs.append(seq)
+                    for kmer in seq_kmers:
+                        self.pool_kmers.setdefault(kmer, []).append(pool_index)
+
+                if self.rename:
+                    otu = "OTU%s_%d" % (sid, len(self.centroids[sid]) + 1)
+                else:
+                    otu = label
+
+                self.otu_names[sid][pool_index] = otu
+                self.centroids[sid].append((otu, seq))
+                pct_id = 100.0
+
+            self.hits[sid].append((label, seq, pct_id, otu))
+
+    def cluster(self, records):
+        '''
+        Cluster fasta records in order of decreasing abundance
+
+        records : iterator of SeqRecords
+            dereplicated sequences with abundances in their ids
+        '''
+
+        entries = [(record.id, str(record.seq)) for record in records]
+        entries.sort(key=lambda entry: label_abundance(entry[0]), reverse=True)
+
+        for label, seq in entries:
+            self.add(label, seq)
+
+    def otu_records(self, sid):
+        '''yield OTU representative sequences for one identity'''
+        for otu, seq in self.centroids[sid]:
+            yield SeqRecord.SeqRecord(Seq.Seq(seq), id=otu, description='')
+
+    def uc_lines(self, sid):
+        '''yield uc hit lines for one identity'''
+        cluster_numbers = {otu: i for i, (otu, seq) in enumerate(self.centroids[sid])}
+        for label, seq, pct_id, otu in self.hits[sid]:
+            yield uc_hit_line(cluster_numbers[otu], seq, pct_id, label, otu)
+
+    def write(self, prefix, uc=True):
+        '''write prefix.sid.fst, and prefix.sid.uc if uc, for every identity'''
+        for sid in self.sids:
+            with open('%s.%s.fst' % (prefix, sid), 'w') as f:
+                SeqIO.write(self.otu_records(sid), f, 'fasta')
+
+            if uc:
+                with open('%s.%s.uc' % (prefix, sid), 'w') as f:
+                    for line in self.uc_lines(sid):
+                        f.write(line + "\n")
+
+
+if __name__ == '__main__':
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description='Greedy abundance-sorted OTU clustering at multiple identities', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('fasta', help='dereplicated fasta (labels like seq0;counts=100)')
+    parser.add_argument('--sids', default='91,94,97,99', help='comma-separated percent identities')
+    parser.add_argument('--prefix', '-p', default='otus', help='outputs are prefix.sid.fst (and prefix.sid.uc)')
+    parser.add_argument('--uc', action='store_true', help='also write the clustering as prefix.sid.uc?')
+    parser.add_argument('-k', type=int, default=8, help='k-mer length for candidate search')
+    parser.add_argument('--max_candidates', type=int, default=32, help='align at most this many candidates per sequence (0 for all)')
+    parser.add_argument('--rename', action='store_true', help='rename OTUs OTU{sid}_1, OTU{sid}_2, etc.?')
+    args = parser.parse_args()
+
+    sids = [int(x) for x in args.sids.split(',')]
+    exts = ['fst', 'uc'] if args.uc else ['fst']
+    util.check_for_collisions(['%s.%d.%s' % (args.prefix, sid, ext) for sid in sids for ext in exts])
+
+    clusterer = GreedyClusterer(sids, k=args.k, max_candidates=args.max_candidates, rename=args.rename)
+    clusterer.cluster(SeqIO.parse(args.fasta, 'fasta'))
+    clusterer.write(args.prefix, args.uc)
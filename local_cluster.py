@@ -0,0 +1,500 @@
+#!/usr/bin/env python
+
+'''
+A stand-in for a PBS cluster that runs job arrays on the local machine, so that job
+submission, monitoring, arrays, and dependencies can be tested and timed without a
+real queue.
+
+A server process owns a state directory and runs the tasks of submitted arrays on a
+pool of processes. The qsub, qstat, and qdel subcommands of this script talk to it
+through that directory and behave like their PBS counterparts (as on coyote): qsub
+takes an array script and prints a job id like 12[].local, qstat -x prints xml, and
+qdel cancels jobs. Ssub uses them when the cluster is 'local'.
+
+The server can be made to behave like a busy cluster: jobs wait in the queue for a
+while before they start, only so many tasks run at once, and some tasks are lost
+(their processes are killed, as if their node had died).
+
+State directory:
+    new/       jobs submitted but not yet taken up by the server
+    cancel/    ids of jobs to cancel
+    queue.json every job the server knows about, rewritten as they change
+    server.pid id of the running server's process
+    stop       tells the server to exit
+'''
+
+import os, sys, re, time, json, glob, signal, random, socket, getpass, subprocess, argparse, fcntl
+from xml.sax.saxutils import escape
+
+script_fn = os.path.abspath(__file__).replace('.pyc', '.py')
+
+# exit status of a lost task, as PBS reports a task killed by SIGKILL
+lost_status = 256 + signal.SIGKILL
+
+def write_json(fn, content):
+    '''write a json file that appears all at once'''
+    with open(fn + '.tmp', 'w') as f:
+        json.dump(content, f)
+
+    os.rename(fn + '.tmp', fn)
+
+def read_json(fn, default=None):
+    '''contents of a json file, or the default if it does not exist'''
+    try:
+        with open(fn) as f:
+            return json.load(f)
+    except IOError:
+        return default
+
+def job_number(job_id):
+    '''12[].local, 12[], or 12 -> 12'''
+    return int(re.match('\d+', job_id).group())
+
+def parse_array_header(script):
+    '''
+    Size and slot limit of a PBS array script, from its #PBS -t line, and its output and
+    error files, from its #PBS -o and -e lines
+
+    returns : dict
+        n_tasks, limit (None for no limit), out, err (None if not given)
+    '''
+
+    header = {'n_tasks': 1, 'limit': None, 'out': None, 'err': None}
+    with open(script) as f:
+        for line in f:
+            m = re.match('#PBS -t 1-(\d+)(%(\d+))?', line)
+            if m:
+                header['n_tasks'] = int(m.group(1))
+                if m.group(3):
+                    header['limit'] = int(m.group(3))
+
+            m = re.match('#PBS -([oe]) (\S+)', line)
+            if m:
+                header[{'o': 'out', 'e': 'err'}[m.group(1)]] = m.group(2)
+
+    return header
+
+
+class LocalCluster():
+    '''the state directory of a local cluster, and its server'''
+
+    def __init__(self, state_dir):
+        self.dir = os.path.abspath(state_dir)
+        for sub in ['new', 'cancel']:
+            path = os.path.join(self.dir, sub)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        self.queue_fn = os.path.join(self.dir, 'queue.json')
+        self.pid_fn = os.path.join(self.dir, 'server.pid')
+        self.stop_fn = os.path.join(self.dir, 'stop')
+        self.counter_fn = os.path.join(self.dir, 'next_id')
+
+        # the server process, if started from this object
+        self.server = None
+
+    def commands(self):
+        '''
+        words of the qsub, qstat -x, and qdel commands for this cluster
+
+        returns : tuple
+            (qsub, qstat, qdel), each a list of words
+        '''
+
+        base = [sys.executable, script_fn, self.dir]
+        return base + ['qsub'], base + ['qstat', '-x'], base + ['qdel']
+
+    def new_id(self):
+        '''the next job number, unique even with several qsubs at once'''
+        with open(self.counter_fn, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            n = int(f.read().strip() or 0) + 1
+            f.seek(0)
+            f.truncate()
+            f.write('%d\n' %(n))
+
+        return n
+
+    def server_running(self):
+        '''is a server process alive for this directory?'''
+        try:
+            with open(self.pid_fn) as f:
+                pid = int(f.read())
+        except (IOError, ValueError):
+            return False
+
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return False
+
+        return True
+
+    def qsub(self, script, depends_on=None, workdir=None):
+        '''
+        submit an array script
+
+        script : string
+            filename of a PBS array script
+        depends_on : list of strings (optional)
+            ids of arrays whose tasks must all succeed before this array starts
+        workdir : string (default current directory)
+            directory the tasks start in (PBS_O_WORKDIR)
+
+        returns : string
+            job id, e.g., 12[].local
+        '''
+
+        if not self.server_running():
+            raise RuntimeError("no local cluster server is running in %s" %(self.dir))
+
+        n = self.new_id()
+        job = {'number': n, 'script': os.path.abspath(script), 'workdir': os.path.abspath(workdir or os.getcwd()),
+            'owner': getpass.getuser(), 'submitted': time.time(),
+            'depends_on': [job_number(job_id) for job_id in depends_on or []]}
+        job.update(parse_array_header(script))
+        write_json(os.path.join(self.dir, 'new', str(n)), job)
+
+        return '%d[].local' %(n)
+
+    def qstat(self, job_ids=None):
+        '''
+        state of jobs, as PBS's qstat -x would give it
+
+        job_ids : list of strings (default all jobs)
+
+        returns : tuple
+            (xml string, list of the asked-for job ids that are unknown)
+        '''
+
+        # jobs not yet taken up by the server are queued. look for them before reading
+        # the queue, since the server adds jobs to the queue before removing them here.
+        new = [int(os.path.basename(fn)) for fn in glob.glob(os.path.join(self.dir, 'new', '*')) if not fn.endswith('.tmp')]
+        jobs = read_json(self.queue_fn, {})
+
+        states = {}
+        for n in new:
+            states[n] = ('Q', getpass.getuser())
+        for job in jobs.values():
+            states[job['number']] = (job['state'], job['owner'])
+
+        if job_ids:
+            numbers = [job_number(job_id) for job_id in job_ids]
+        else:
+            numbers = sorted(states.keys())
+
+        unknown = [job_id for job_id in job_ids or [] if job_number(job_id) not in states]
+
+        host = socket.gethostname()
+        lines = []
+        for n in numbers:
+            if n in states:
+                state, owner = states[n]
+                lines.append('<Job><Job_Id>%d[].local</Job_Id><Job_Owner>%s@%s</Job_Owner><job_state>%s</job_state></Job>' %(n, escape(owner), escape(host), state))
+
+        if len(lines) == 0:
+            return '', unknown
+
+        return '<Data>%s</Data>\n' %("".join(lines)), unknown
+
+    def qdel(self, job_ids):
+        '''ask the server to cancel jobs'''
+        for job_id in job_ids:
+            with open(os.path.join(self.dir, 'cancel', str(job_number(job_id))), 'w') as f:
+                f.write('cancel\n')
+
+    def start(self, **kwargs):
+        '''start a server in the background, with options as for serve, and wait until it is up'''
+        args = [sys.executable, script_fn, self.dir, 'serve']
+        for key, value in sorted(kwargs.items()):
+            if key == 'fail_tasks':
+                value = ",".join(['%d.%d' %(n, task) for n, task in value])
+            args += ['--%s' %(key), str(value)]
+
+        if os.path.exists(self.stop_fn):
+            os.remove(self.stop_fn)
+
+        self.server = subprocess.Popen(args)
+        while not self.server_running():
+            if self.server.poll() is not None:
+                raise RuntimeError("local cluster server exited with status %d" %(self.server.returncode))
+
+            time.sleep(0.01)
+
+    def stop(self):
+        '''tell the server to cancel what is running and exit, and wait for it'''
+        with open(self.stop_fn, 'w') as f:
+            f.write('stop\n')
+
+        if self.server is not None:
+            self.server.wait()
+            self.server = None
+
+
+class Server():
+    '''runs the tasks of the jobs in a local cluster's state directory'''
+
+    def __init__(self, cluster, slots=4, latency=0.0, fail_rate=0.0, fail_tasks=None, seed=None, poll_interval=0.05):
+        '''
+        cluster : LocalCluster
+        slots : int (default 4)
+            most tasks to run at once, over all jobs
+        latency : float (default 0)
+            seconds a job waits in the queue before its tasks can start
+        fail_rate : float (default 0)
+            chance that a task is lost rather than run
+        fail_tasks : list of (job number, task number) (optional)
+            tasks to lose
+        seed : int (optional)
+            seed for choosing which tasks are lost
+        poll_interval : float (default 0.05)
+            seconds between looks at the state directory and the running tasks
+        '''
+
+        self.cluster = cluster
+        self.slots = slots
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.fail_tasks = set([tuple(x) for x in fail_tasks or []])
+        self.random = random.Random(seed)
+        self.poll_interval = poll_interval
+
+        # job number -> job, kept as in queue.json
+        self.jobs = read_json(cluster.queue_fn, {})
+        self.jobs = dict([(int(n), job) for n, job in self.jobs.items()])
+
+        # the tasks of a previous server went with it
+        for job in self.jobs.values():
+            if job['state'] == 'R':
+                job['state'] = 'C'
+                job['end'] = time.time()
+
+        # (job number, task number) -> process
+        self.running = {}
+
+    def write_queue(self):
+        write_json(self.cluster.queue_fn, self.jobs)
+
+    def take_new(self):
+        '''take up newly submitted jobs and cancellations. returns : did anything change?'''
+        fns = [fn for fn in glob.glob(os.path.join(self.cluster.dir, 'new', '*')) if not fn.endswith('.tmp')]
+        for fn in fns:
+            job = read_json(fn)
+            job.update({'state': 'Q', 'tasks': {}, 'start': None, 'end': None})
+            self.jobs[job['number']] = job
+
+        # new jobs go into the queue before they leave new/, so that qstat always sees them
+        if len(fns) > 0:
+            self.write_queue()
+
+        for fn in fns:
+            os.remove(fn)
+
+        cancels = glob.glob(os.path.join(self.cluster.dir, 'cancel', '*'))
+        for fn in cancels:
+            n = int(os.path.basename(fn))
+            if n in self.jobs:
+                self.cancel(n)
+            os.remove(fn)
+
+        return len(fns) + len(cancels) > 0
+
+    def cancel(self, n):
+        '''kill a job's running tasks and drop the rest'''
+        job = self.jobs[n]
+        for key in [key for key in self.running if key[0] == n]:
+            self.kill(key)
+            job['tasks'][str(key[1])] = -signal.SIGTERM
+
+        if job['state'] != 'C':
+            job['state'] = 'C'
+            job['end'] = time.time()
+
+    def kill(self, key):
+        proc = self.running.pop(key)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+        proc.wait()
+
+    def dependencies(self, job):
+        '''
+        state of a job's dependencies
+
+        returns : string
+            'ok' if every task of every array it depends on succeeded, 'failed' if one
+            of them failed or was cancelled, 'waiting' otherwise
+        '''
+
+        for n in job['depends_on']:
+            if n not in self.jobs:
+                # not ours, or long gone
+                continue
+
+            dep = self.jobs[n]
+            if dep['state'] != 'C':
+                return 'waiting'
+            elif len(dep['tasks']) < dep['n_tasks'] or any([status != 0 for status in dep['tasks'].values()]):
+                return 'failed'
+
+        return 'ok'
+
+    def start_task(self, job, task):
+        '''start a task of a job, or lose it'''
+        n = job['number']
+        if (n, task) in self.fail_tasks or (self.fail_rate > 0 and self.random.random() < self.fail_rate):
+            job['tasks'][str(task)] = lost_status
+            return
+
+        env = dict(os.environ, PBS_ARRAYID=str(task), PBS_O_WORKDIR=job['workdir'], PBS_JOBID='%d[%d].local' %(n, task))
+        out = open(job['out'] + '-%d' %(task) if job['out'] else os.devnull, 'w')
+        err = open(job['err'] + '-%d' %(task) if job['err'] else os.devnull, 'w')
+
+        # each task gets its own process group, so that killing it kills its commands too
+        self.running[(n, task)] = subprocess.Popen(['bash', job['script']], cwd=job['workdir'], env=env,
+            stdout=out, stderr=err, preexec_fn=os.setsid)
+        out.close()
+        err.close()
+
+    def schedule(self):
+        '''start what can start and note what has finished. returns : did anything change?'''
+        changed = False
+        now = time.time()
+
+        for key, proc in self.running.items():
+            status = proc.poll()
+            if status is not None:
+                del self.running[key]
+                self.jobs[key[0]]['tasks'][str(key[1])] = status
+                changed = True
+
+        for n in sorted(self.jobs.keys()):
+            job = self.jobs[n]
+            if job['state'] == 'C':
+                continue
+
+            if job['state'] == 'Q':
+                if now - job['submitted'] < self.latency:
+                    continue
+
+                deps = self.dependencies(job)
+                if deps == 'waiting':
+                    continue
+                elif deps == 'failed':
+                    # as PBS deletes a job whose afterok dependency cannot be met
+                    job['state'] = 'C'
+                    job['end'] = now
+                    changed = True
+                    continue
+
+                job['state'] = 'R'
+                job['start'] = now
+                job['next_task'] = 1
+                changed = True
+
+            running = len([key for key in self.running if key[0] == n])
+            while job['next_task'] <= job['n_tasks'] and len(self.running) < self.slots and (job['limit'] is None or running < job['limit']):
+                self.start_task(job, job['next_task'])
+                job['next_task'] += 1
+                running = len([key for key in self.running if key[0] == n])
+                changed = True
+
+            if len(job['tasks']) == job['n_tasks']:
+                job['state'] = 'C'
+                job['end'] = time.time()
+                changed = True
+
+        return changed
+
+    def serve(self):
+        '''run jobs until told to stop'''
+        with open(self.cluster.pid_fn, 'w') as f:
+            f.write('%d\n' %(os.getpid()))
+
+        try:
+            while not os.path.exists(self.cluster.stop_fn):
+                changed = self.take_new()
+                changed = self.schedule() or changed
+                if changed:
+                    self.write_queue()
+
+                time.sleep(self.poll_interval)
+        finally:
+            for key in self.running.keys():
+                self.kill(key)
+
+            os.remove(self.cluster.pid_fn)
+
+
+def qsub_main(cluster, args):
+    parser = argparse.ArgumentParser(prog='qsub', description='Submit an array script to the local cluster')
+    parser.add_argument('-W', dest='attributes', action='append', default=[], help='attributes; only depend=afterokarray:... is used')
+    parser.add_argument('script')
+    args = parser.parse_args(args)
+
+    depends_on = []
+    for attribute in args.attributes:
+        m = re.match('depend=afterokarray:(.+)', attribute)
+        if m:
+            depends_on += m.group(1).split(':')
+        else:
+            sys.stderr.write("qsub: ignoring attribute %s\n" %(attribute))
+
+    try:
+        print cluster.qsub(args.script, depends_on)
+    except RuntimeError as e:
+        sys.stderr.write("qsub: %s\n" %(e))
+        sys.exit(1)
+
+def qstat_main(cluster, args):
+    # -x (xml) is the only output there is
+    job_ids = [arg for arg in args if arg != '-x']
+    xml, unknown = cluster.qstat(job_ids)
+    sys.stdout.write(xml)
+
+    for job_id in unknown:
+        sys.stderr.write("qstat: Unknown Job Id %s\n" %(job_id))
+
+    if len(unknown) > 0:
+        sys.exit(153)
+
+def parse_fail_tasks(value):
+    '''"3.1,4.2" -> [(3, 1), (4, 2)]'''
+    return [tuple([int(x) for x in item.split('.')]) for item in value.split(',') if item]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[2] not in ['serve', 'qsub', 'qstat', 'qdel']:
+        sys.stderr.write("usage: local_cluster.py state_dir {serve,qsub,qstat,qdel} ...\n")
+        sys.exit(2)
+
+    cluster = LocalCluster(sys.argv[1])
+    command, args = sys.argv[2], sys.argv[3:]
+
+    if command == 'serve':
+        parser = argparse.ArgumentParser(prog='serve', description='Run the jobs submitted to a local cluster', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        parser.add_argument('--slots', type=int, default=4, help='most tasks to run at once')
+        parser.add_argument('--latency', type=float, default=0.0, help='seconds each job waits in the queue before it can start')
+        parser.add_argument('--fail_rate', type=float, default=0.0, help='chance that a task is lost rather than run')
+        parser.add_argument('--fail_tasks', type=parse_fail_tasks, default=[], help='tasks to lose, as job.task,job.task,...')
+        parser.add_argument('--seed', type=int, default=None, help='random seed for lost tasks')
+        parser.add_argument('--poll_interval', type=float, default=0.05, help='seconds between looks at the queue')
+        args = parser.parse_args(args)
+
+        if cluster.server_running():
+            sys.stderr.write("a server is already running in %s\n" %(cluster.dir))
+            sys.exit(1)
+
+        # exit (and kill the running tasks) on ctrl-c or kill, too
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+        Server(cluster, slots=args.slots, latency=args.latency, fail_rate=args.fail_rate, fail_tasks=args.fail_tasks,
+            seed=args.seed, poll_interval=args.poll_interval).serve()
+    elif command == 'qsub':
+        qsub_main(cluster, args)
+    elif command == 'qstat':
+        qstat_main(cluster, args)
+    elif command == 'qdel':
+        cluster.qdel(args)
@@ -0,0 +1,173 @@
+'''
+Run shell commands on this machine in a bounded pool of processes.
+
+Each command's output (stdout and stderr together) is streamed line by line with a
+prefix that says which command it came from. If a command fails, the commands still
+running are cancelled and no new ones are started.
+'''
+
+import sys, os, signal, subprocess, threading, time, multiprocessing
+import scheduler
+
+class LocalRunner():
+    def __init__(self, n_procs=None, out=sys.stdout, poll_interval=0.05):
+        '''
+        n_procs : int (default number of cpus)
+            maximum number of commands running at once
+        out : filehandle (default stdout)
+            where to stream the commands' output
+        poll_interval : float (default 0.05)
+            seconds between checks on the running commands
+        '''
+
+        if n_procs is None:
+            n_procs = multiprocessing.cpu_count()
+
+        self.n_procs = max(1, n_procs)
+        self.out = out
+        self.poll_interval = poll_interval
+
+        self.lock = threading.Lock()
+        self.running = {}
+
+    def has_slot(self):
+        '''can another command start now?'''
+        return len(self.running) < self.n_procs
+
+    def _stream(self, fh, prefix):
+        '''copy lines from a process's output to out, with a prefix'''
+        for line in iter(fh.readline, ''):
+            with self.lock:
+                self.out.write(prefix + line)
+                self.out.flush()
+
+        fh.close()
+
+    def start(self, key, cmd, prefix=''):
+        '''
+        start a command without waiting for it, echoing it to out
+
+        key : anything hashable
+            used to refer to the command in poll()
+        cmd : list of words or a shell string
+        prefix : string
+            put in front of each line of the command's output
+        '''
+
+        with self.lock:
+            self.out.write("%s%s\n" %(prefix, scheduler.command_line(cmd)))
+            self.out.flush()
+
+        if type(cmd) is str:
+            args = cmd
+            shell = True
+        else:
+            args = [str(x) for x in cmd]
+            shell = False
+
+        # own process group, so cancelling also stops the shell's children
+        proc = subprocess.Popen(args, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+
+        reader = threading.Thread(target=self._stream, args=(proc.stdout, prefix))
+        reader.daemon = True
+        reader.start()
+
+        self.running[key] = (proc, reader)
+
+    def poll(self):
+        '''
+        check on the running commands
+
+        returns : list of (key, exit status)
+            commands that finished since the last poll
+        '''
+
+        finished = []
+        for key, (proc, reader) in self.running.items():
+            status = proc.poll()
+            if status is not None:
+                reader.join()
+                del self.running[key]
+                finished.append((key, status))
+
+        return finished
+
+    def wait_any(self, timeout=None):
+        '''
+        wait until at least one running command finishes (or until timeout seconds
+        have passed), returning poll() output
+        '''
+
+        start = time.time()
+        while True:
+            finished = self.poll()
+            if len(finished) > 0 or len(self.running) == 0:
+                return finished
+
+            if timeout is not None and time.time() - start > timeout:
+                return finished
+
+            time.sleep(self.poll_interval)
+
+    def cancel(self, keys=None):
+        '''stop some running commands (by default, all of them)'''
+        if keys is None:
+            keys = self.running.keys()
+
+        keys = [key for key in keys if key in self.running]
+
+        for key in keys:
+            proc, reader = self.running[key]
+            try:
+                os.killpg(proc.pid, signal.SIGTERM)
+            except OSError:
+                # already gone
+                pass
+
+        for key in keys:
+            proc, reader = self.running.pop(key)
+            proc.wait()
+            reader.join()
+
+    def run(self, cmds):
+        '''
+        run commands, at most n_procs at a time, stopping at the first failure
+
+        cmds : list of commands (lists of words or shell strings)
+
+        returns : list of ints or None
+            exit status of each command; None for commands that were cancelled or
+            never started because another command failed
+        '''
+
+        statuses = [None for cmd in cmds]
+        waiting = range(len(cmds))
+        failed = False
+
+        while len(waiting) > 0 or len(self.running) > 0:
+            while not failed and len(waiting) > 0 and self.has_slot():
+                i = waiting.pop(0)
+                self.start(i, cmds[i], prefix="[%d] " % i)
+
+            for i, status in self.wait_any():
+                statuses[i] = status
+                if status != 0:
+                    failed = True
+
+            if failed:
+                self.cancel()
+                break
+
+        return statuses
+
+
+def status_report(cmds, statuses):
+    '''one line per command that did not succeed, saying what happened to it'''
+    lines = []
+    for cmd, status in zip(cmds, statuses):
+        if status is None:
+            lines.append("cancelled: %s" % scheduler.command_line(cmd))
+        elif status != 0:
+            lines.append("exit status %d: %s" %(status, scheduler.command_line(cmd)))
+
+    return "\n".join(lines)
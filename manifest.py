@@ -0,0 +1,161 @@
+'''
+Records of what each pipeline stage read, wrote, and was run with, so that a rerun can
+skip the stages that are already up to date.
+
+A file's signature is its size, modification time, and md5 checksum. The checksum is
+only recomputed when the size or time differs from the recorded signature, so checking
+an up-to-date file is a single stat.
+
+Many stages rewrite their input in place (e.g., primer removal replaces each shard with
+the trimmed shard), so a stage's recorded inputs usually cannot be compared to what is
+on disk. Instead, the selected stages are checked as a chain: each stage's recorded
+inputs must match the recorded outputs of the stages before it (or, for files no earlier
+stage wrote, what is on disk), and the files on disk must match the last recorded write.
+'''
+
+import os, json, hashlib
+
+manifest_fn = '.SmileTrain.manifest.json'
+
+def md5sum(fn, block_size=2**20):
+    '''md5 hex digest of a file's contents'''
+    md5 = hashlib.md5()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), ''):
+            md5.update(block)
+
+    return md5.hexdigest()
+
+def file_signature(fn, known=None):
+    '''
+    Size, time, and checksum of a file
+
+    fn : string
+        filename
+    known : dict or None
+        a previous signature of this file; if the size and time match, its
+        checksum is reused rather than recomputed
+
+    returns : dict or None
+        {'size': int, 'mtime': float, 'md5': string}, or None if the file is missing
+    '''
+
+    if not os.path.isfile(fn):
+        return None
+
+    st = os.stat(fn)
+    if known is not None and known['size'] == st.st_size and known['mtime'] == st.st_mtime:
+        md5 = known['md5']
+    else:
+        md5 = md5sum(fn)
+
+    return {'size': st.st_size, 'mtime': st.st_mtime, 'md5': md5}
+
+def same_contents(sig1, sig2):
+    '''do two signatures (or Nones, for missing files) describe the same contents?'''
+    if sig1 is None or sig2 is None:
+        return sig1 is sig2
+
+    return sig1['size'] == sig2['size'] and sig1['md5'] == sig2['md5']
+
+
+class Manifest():
+    '''the recorded inputs, outputs, and parameters of each stage, kept in a json file'''
+    def __init__(self, fn=manifest_fn):
+        self.fn = fn
+
+        if os.path.isfile(fn):
+            with open(fn) as f:
+                self.stages = json.load(f)
+        else:
+            self.stages = {}
+
+    def save(self):
+        # write then rename, so a crash never leaves a half-written manifest
+        tmp_fn = self.fn + '.tmp'
+        with open(tmp_fn, 'w') as f:
+            json.dump(self.stages, f, indent=1, sort_keys=True)
+
+        os.rename(tmp_fn, self.fn)
+
+    def signatures(self, fns):
+        '''signatures of files as they are now, reusing recorded checksums where possible'''
+        known = {}
+        for record in self.stages.values():
+            for files in [record['inputs'], record['outputs']]:
+                for fn, sig in files.items():
+                    if sig is not None:
+                        known[fn] = sig
+
+        return dict([(fn, file_signature(fn, known.get(fn))) for fn in fns])
+
+    def record(self, stage, inputs, outputs, params):
+        '''
+        Save a record of a finished stage
+
+        stage : string
+            stage name
+        inputs : dict
+            signatures of the inputs, taken before the stage ran
+        outputs : list of filenames
+            files the stage wrote or removed; their signatures are taken now
+        params : dict
+            options that affect the stage's outputs
+        '''
+
+        self.stages[stage] = {'inputs': inputs, 'outputs': self.signatures(outputs), 'params': params}
+        self.save()
+
+    def forget(self, stage):
+        if stage in self.stages:
+            del self.stages[stage]
+            self.save()
+
+    def up_to_date(self, stages):
+        '''
+        Check a chain of stages, in the order they run
+
+        stages : list of (stage name, params)
+
+        returns : int
+            the number of stages at the start of the chain that are up to date
+        '''
+
+        # signature each file should have after the stages checked so far
+        expected = {}
+        # index of the first stage to write each file
+        first_writer = {}
+        n_current = 0
+
+        for i, (stage, params) in enumerate(stages):
+            record = self.stages.get(stage)
+            if record is None or record['params'] != params:
+                break
+
+            current = True
+            for fn, sig in record['inputs'].items():
+                if fn in expected:
+                    now = expected[fn]
+                else:
+                    now = self.signatures([fn])[fn]
+
+                if not same_contents(sig, now):
+                    current = False
+
+            if not current:
+                break
+
+            for fn, sig in record['outputs'].items():
+                expected[fn] = sig
+                first_writer.setdefault(fn, i)
+
+            n_current = i + 1
+
+        # files on disk must still be what the up-to-date stages left behind; if one is
+        # not, redo everything from the first stage that wrote it
+        on_disk = self.signatures(expected.keys())
+        for fn, sig in expected.items():
+            if first_writer[fn] < n_current and not same_contents(sig, on_disk[fn]):
+                n_current = first_writer[fn]
+
+        return n_current
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+
+'''
+Merge forward and reverse reads into single reads that span the amplicon.
+
+Forward and reverse fastq files are read in lockstep; the reads in each pair must have
+matching ids (whatever/1 and whatever/2). The reverse read is reverse complemented and
+every possible overlap with the end of the forward read is scored at once for a whole
+batch of reads, using 2-bit encoded sequences. The best overlap with at most max_diffs
+mismatches is kept.
+
+In the overlap, the merged base and quality are the posterior ones: if the reads agree,
+the error probability drops; if they disagree, the higher-quality base is kept with a
+reduced quality. (See Edgar & Flyvbjerg 2015, "Error filtering, pair assembly and error
+correction for next-generation sequencing reads".)
+
+Pairs that do not overlap are dropped. Counts of merged and dropped pairs can be written
+to a log file.
+'''
+
+import sys, argparse, itertools, multiprocessing
+import numpy as np
+import util, check_intersect
+
+# quality encoding and range (Illumina 1.8)
+ascii_offset = 33
+max_q = 41
+
+# 2-bit codes for bases; anything else (e.g., N) gets a code that never matches
+base_codes = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate('ACGT'):
+    base_codes[ord(base)] = code
+code_bases = np.array([ord(x) for x in 'ACGTN'], dtype=np.uint8)
+
+def posterior_quality_tables(max_q=max_q):
+    '''
+    Posterior qualities for overlapping bases.
+
+    returns : tuple of 2d int arrays
+        (agree, disagree), where agree[q1, q2] is the quality of a base called the same by
+        reads with qualities q1 and q2, and disagree[q1, q2] is the quality of the base
+        with quality q1 when the other read called a different base with quality q2 <= q1
+    '''
+
+    q = np.arange(max_q + 1, dtype=np.float64)
+    p = np.minimum(10.0 ** (-q / 10.0), 0.75)
+    p1 = p[:, np.newaxis]
+    p2 = p[np.newaxis, :]
+
+    p_agree = (p1 * p2 / 3.0) / (1.0 - p1 - p2 + 4.0 * p1 * p2 / 3.0)
+    p_disagree = p1 * (1.0 - p2 / 3.0) / (p1 + p2 - 4.0 * p1 * p2 / 3.0)
+
+    to_q = lambda x: np.clip(np.round(-10.0 * np.log10(x)), 2, max_q).astype(np.uint8)
+    return to_q(p_agree), to_q(p_disagree)
+
+agree_quality, disagree_quality = posterior_quality_tables()
+
+def paired_batches(forward, reverse, batch_size):
+    '''yield lists of (forward record, reverse record), checking that the ids match'''
+    pairs = itertools.izip_longest(util.fastq_entries(forward), util.fastq_entries(reverse))
+    while True:
+        batch = list(itertools.islice(pairs, batch_size))
+        if len(batch) == 0:
+            return
+
+        for f, r in batch:
+            if f is None or r is None:
+                raise RuntimeError("forward and reverse fastqs have different numbers of entries")
+
+            check_intersect.check_matching_fastq_ids(f[0], r[0])
+
+        yield batch
+
+def encode_batch(seqs, quals, width, truncqual=None, right_align=False):
+    '''
+    Encode reads into padded code and quality matrices.
+
+    seqs, quals : lists of strings
+        sequences and their quality lines
+    width : int
+        number of columns in the output matrices
+    truncqual : int or None (default None)
+        truncate each read before its first base with quality <= truncqual
+    right_align : bool (default False)
+        put the reads against the right edge of the matrix (padding on the left)?
+
+    returns : tuple
+        (codes, qualities, lengths) as (uint8 matrix, uint8 matrix, int array)
+    '''
+
+    n = len(seqs)
+    codes = np.full((n, width), 4, dtype=np.uint8)
+    qualities = np.zeros((n, width), dtype=np.uint8)
+    lengths = np.zeros(n, dtype=np.int64)
+
+    for i, (seq, qual) in enumerate(zip(seqs, quals)):
+        c = base_codes[np.frombuffer(seq, dtype=np.uint8)]
+        q = np.minimum(np.frombuffer(qual, dtype=np.uint8) - ascii_offset, max_q)
+
+        if truncqual is not None:
+            low = np.flatnonzero(q <= truncqual)
+            if len(low) > 0:
+                c = c[:low[0]]
+                q = q[:low[0]]
+
+        l = len(c)
+        lengths[i] = l
+        if right_align:
+            codes[i, width - l:] = c
+            qualities[i, width - l:] = q
+        else:
+            codes[i, :l] = c
+            qualities[i, :l] = q
+
+    return codes, qualities, lengths
+
+def reverse_complement_batch(codes, qualities):
+    '''reverse complement right-aligned code and quality matrices into left-aligned ones'''
+    rc = codes[:, ::-1].copy()
+    rc[rc < 4] = 3 - rc[rc < 4]
+    return rc, qualities[:, ::-1].copy()
+
+def best_overlaps(f_codes, f_lengths, r_codes, r_lengths, min_overlap, max_diffs, mismatch_penalty=4):
+    '''
+    Score every overlap of every pair in the batch.
+
+    f_codes : uint8 matrix
+        forward reads, right-aligned (so the 3' ends line up)
+    r_codes : uint8 matrix
+        reverse-complemented reverse reads, left-aligned
+    f_lengths, r_lengths : int arrays
+        read lengths
+    min_overlap : int
+        shortest allowed overlap
+    max_diffs : int
+        most mismatches allowed in the overlap
+    mismatch_penalty : int (default 4)
+        an overlap scores 1 for every match and -mismatch_penalty for every mismatch
+
+    returns : tuple of int arrays
+        (overlap length, mismatches) for each pair; overlap length 0 means no overlap
+    '''
+
+    n, width = f_codes.shape
+    best_score = np.full(n, -np.inf)
+    best_overlap = np.zeros(n, dtype=np.int64)
+    best_diffs = np.zeros(n, dtype=np.int64)
+
+    shortest = np.minimum(f_lengths, r_lengths)
+    for overlap in range(min_overlap, width + 1):
+        a = f_codes[:, width - overlap:]
+        b = r_codes[:, :overlap]
+        called = (a < 4) & (b < 4)
+
+        matches = ((a == b) & called).sum(axis=1)
+        diffs = ((a != b) & called).sum(axis=1)
+        score = matches - mismatch_penalty * diffs
+
+        better = (overlap <= shortest) & (diffs <= max_diffs) & (score >= best_score)
+        best_score[better] = score[better]
+        best_overlap[better] = overlap
+        best_diffs[better] = diffs[better]
+
+    return best_overlap, best_diffs
+
+def merge_pair(f_codes, f_quals, r_codes, r_quals, overlap):
+    '''
+    Merge one forward read (right-aligned rows, trimmed to the read) and one reverse-
+    complemented reverse read (left-aligned rows, trimmed to the read).
+
+    returns : tuple of strings
+        (merged sequence, merged quality line)
+    '''
+
+    fl = len(f_codes)
+    a, qa = f_codes[fl - overlap:], f_quals[fl - overlap:]
+    b, qb = r_codes[:overlap], r_quals[:overlap]
+
+    # in the overlap, use the higher-quality base (an N never wins)
+    take_b = (b < 4) & ((a == 4) | (qb > qa))
+    hi = np.where(take_b, qb, qa)
+    lo = np.where(take_b, qa, qb)
+    base = np.where(take_b, b, a)
+
+    agree = (a == b) & (a < 4)
+    one_called = (a == 4) | (b == 4)
+    qual = np.where(agree, agree_quality[hi, lo], disagree_quality[hi, lo])
+    qual = np.where(one_called, hi, qual)
+
+    codes = np.concatenate([f_codes[:fl - overlap], base, r_codes[overlap:]])
+    quals = np.concatenate([f_quals[:fl - overlap], qual, r_quals[overlap:]])
+    quals = np.minimum(quals, max_q)
+
+    return code_bases[codes].tostring(), (quals + ascii_offset).astype(np.uint8).tostring()
+
+def merge_batch(batch, min_overlap=16, max_diffs=5, truncqual=None):
+    '''
+    Merge a batch of read pairs.
+
+    batch : list of ((label, seq, qual), (label, seq, qual))
+        forward and reverse records
+    min_overlap, max_diffs : ints
+        see best_overlaps
+    truncqual : int or None
+        see encode_batch
+
+    returns : tuple
+        (list of merged fastq entry strings, dictionary of counts)
+    '''
+
+    forwards, reverses = zip(*batch)
+    width = max([len(rec[1]) for rec in forwards + reverses])
+
+    f_codes, f_quals, f_lengths = encode_batch([f[1] for f in forwards], [f[2] for f in forwards], width, truncqual, right_align=True)
+    r_codes, r_quals, r_lengths = encode_batch([r[1] for r in reverses], [r[2] for r in reverses], width, truncqual, right_align=True)
+    rc_codes, rc_quals = reverse_complement_batch(r_codes, r_quals)
+
+    overlaps, diffs = best_overlaps(f_codes, f_lengths, rc_codes, r_lengths, min_overlap, max_diffs)
+
+    entries = []
+    for i, (label, seq, qual) in enumerate(forwards):
+        if overlaps[i] == 0:
+            continue
+
+        fl = f_lengths[i]
+        rl = r_lengths[i]
+        merged_seq, merged_qual = merge_pair(f_codes[i, width - fl:], f_quals[i, width - fl:], rc_codes[i, :rl], rc_quals[i, :rl], overlaps[i])
+        entries.append("@%s\n%s\n+\n%s\n" % (label, merged_seq, merged_qual))
+
+    stats = {'pairs': len(batch), 'merged': len(entries), 'not_merged': len(batch) - len(entries)}
+    return entries, stats
+
+def _merge_batch_star(args):
+    '''unpack arguments for merge_batch (for use with multiprocessing)'''
+    return merge_batch(*args)
+
+def merge_fastqs(forward, reverse, output, min_overlap=16, max_diffs=5, truncqual=None, batch_size=10000, threads=1):
+    '''
+    Merge the pairs in forward and reverse fastq filehandles.
+
+    forward, reverse : filehandles
+        paired inputs
+    output : filehandle
+        merged fastq output
+    batch_size : int (default 10000)
+        number of pairs scored together
+    threads : int (default 1)
+        number of processes merging batches
+
+    returns : dict
+        counts of pairs, merged pairs, and pairs that did not merge
+    '''
+
+    tasks = ((batch, min_overlap, max_diffs, truncqual) for batch in paired_batches(forward, reverse, batch_size))
+
+    if threads > 1:
+        pool = multiprocessing.Pool(threads)
+        results = pool.imap(_merge_batch_star, tasks)
+    else:
+        pool = None
+        results = itertools.imap(_merge_batch_star, tasks)
+
+    totals = {'pairs': 0, 'merged': 0, 'not_merged': 0}
+    for entries, stats in results:
+        output.write("".join(entries))
+        for key in stats:
+            totals[key] += stats[key]
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    return totals
+
+def stats_lines(stats):
+    '''{'pairs': 10, ...} -> tab-separated lines in a fixed order'''
+    return ["%s\t%d" % (key, stats[key]) for key in ['pairs', 'merged', 'not_merged']]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge forward and reverse reads', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('forward', help='forward reads fastq')
+    parser.add_argument('reverse', help='reverse reads fastq')
+    parser.add_argument('--min_overlap', type=int, default=16, help='minimum overlap length')
+    parser.add_argument('--max_diffs', type=int, default=5, help='maximum mismatches in the overlap')
+    parser.add_argument('--truncqual', type=int, default=None, help='truncate reads at first base with this quality or lower')
+    parser.add_argument('--batch_size', type=int, default=10000, help='read pairs per batch')
+    parser.add_argument('--threads', '-t', type=int, default=1, help='number of processes')
+    parser.add_argument('--log', '-l', default=None, help='output statistics file')
+    parser.add_argument('--output', '-o', default=sys.stdout, type=argparse.FileType('w'), help='merged fastq')
+    args = parser.parse_args()
+
+    with open(args.forward) as f, open(args.reverse) as r:
+        stats = merge_fastqs(f, r, args.output, args.min_overlap, args.max_diffs, args.truncqual, args.batch_size, args.threads)
+
+    if args.log is not None:
+        with open(args.log, 'w') as f:
+            f.write("\n".join(stats_lines(stats)) + "\n")
@@ -5,21 +5,71 @@ Main script in the pipeline. Produces lists of commands and submits them using s
 Options allow the user to run individual parts of the pipeline or the entire thing.
 '''
 
-import argparse, os, ConfigParser, subprocess, pickle
-import ssub
+import argparse, os, sys, ConfigParser, pickle, multiprocessing, tempfile, shutil, time, pipes
+import ssub, scheduler, local_runner, manifest, resources, telemetry, worker
 import util
 from util import *
 import check_fastq_format
 
 commands_fn = '.SmileTrain.commands.pkl'
 
+def marked_command(cmd, marker):
+    '''
+    shell line that runs a command and, only if it succeeds, creates a marker file
+
+    The marker is written to a temporary name and renamed, so it appears all at once.
+    '''
+    return "(%s) && echo done > %s.tmp && mv %s.tmp %s" %(cmd, marker, marker, marker)
+
+
 class Submitter():
     '''runs jobs on a cluster, locally, or in a dry run'''
-    def __init__(self, method, n_cpus=1, cluster=None):
+    def __init__(self, method, n_cpus=1, cluster=None, retries=0, packing='round_robin', workers=False, speculate=0):
+        '''
+        method : string
+            'submit', 'local', or 'dry_run'
+        n_cpus : int (default 1)
+            number of jobs (or local processes) to spread commands over
+        cluster : string
+            cluster name, for submit
+        retries : int (default 0)
+            number of times to rerun the commands that did not complete before
+            giving up on a stage
+        packing : string (default 'round_robin')
+            how cluster commands are spread over jobs (see ssub.Ssub.write_jobs)
+        workers : bool (default False)
+            run commands on warm python workers (see worker.py), one per local
+            process or cluster job, rather than starting each command on its own
+        speculate : float (default 0)
+            in a dependency graph, start a copy of a task that has run this many times
+            longer than the median of its finished siblings, keeping whichever copy
+            finishes first (see scheduler.Speculator). 0 to never copy tasks.
+        '''
+
         if method not in ['submit', 'local', 'dry_run']:
             raise ArgumentError("unexpcted method %s passed to Submitter" %(method))
 
         self.method = method
+        self.retries = retries
+        self.workers = workers
+        self.n_cpus = n_cpus
+        self.speculate = speculate
+
+        # the queue that workers take commands from, the local workers, and the number
+        # of commands queued so far
+        self.queue = None
+        self.worker_runner = None
+        self.n_queued = 0
+
+        # memory (gb) to request for each cluster job; None for the default
+        self.memory = None
+
+        # seconds to wait before looking again for files that seem missing or empty
+        self.file_delay = 0.1
+
+        # a telemetry.Recorder to measure each command, and the stage to file them under
+        self.telemetry = None
+        self.stage = None
 
         if method == 'dry_run':
             self.dry_run = True
@@ -31,10 +81,25 @@ class Submitter():
 
             # set up the cluster submission object
             self.ssub = ssub.Ssub(username=config.get('User', 'username'), cluster=config.get('User', 'cluster'),
-                queue=config.get('User', 'queue'), tmp_dir=config.get('User', 'tmp_directory'), bashrc=config.get('Scripts', 'bashrc'), n_cpus=n_cpus)
+                queue=config.get('User', 'queue'), tmp_dir=config.get('User', 'tmp_directory'), bashrc=config.get('Scripts', 'bashrc'), n_cpus=n_cpus, packing=packing)
         elif method == 'local':
             self.dry_run = False
 
+            # run up to one command per cpu, but no more than asked for
+            self.runner = local_runner.LocalRunner(min(n_cpus, multiprocessing.cpu_count()))
+
+    def check_files(self, fns, nonempty):
+        '''
+        assert that files exist (and are nonempty), giving the filesystem a few chances
+        to catch up with files just written on other nodes
+        '''
+
+        missing, empty = util.wait_for_files(fns, nonempty, delay=self.file_delay)
+        if len(missing) > 0:
+            raise RuntimeError("file(s) missing: %s" % " ".join(missing))
+        elif len(empty) > 0:
+            raise RuntimeError("file(s) empty: " + " ".join(empty))
+
     def check_for_existence(self, fns):
         '''assert that each of filenames does exist'''
 
@@ -43,12 +108,7 @@ class Submitter():
         if self.method == 'dry_run':
             message("dry run: test for existence of files: " + " ".join(fns), indent=4)
         else:
-            # running ls first seems to prevent spurious empties
-            subprocess.check_output(['ls', '-lah'])
-            tests = [os.path.isfile(fn) for fn in fns]
-            if False in tests:
-                bad_names = " ".join([fn for fn, test in zip(fns, tests) if test == False])
-                raise RuntimeError("file(s) missing: %s" % bad_names)
+            self.check_files(fns, nonempty=False)
 
     def check_for_nonempty(self, fns):
         '''assert that each file exists and is nonempty'''
@@ -57,11 +117,7 @@ class Submitter():
         if self.method == 'dry_run':
             message("dry run: test that files are non-empty: " + " ".join(fns), indent=4)
         else:
-            self.check_for_existence(fns)
-            tests = [os.stat(fn).st_size > 0 for fn in fns]
-            if False in tests:
-                bad_names = " ".join([fn for fn, t in zip(fns, tests) if t == False])
-                raise RuntimeError("file(s) empty: " + bad_names)
+            self.check_files(fns, nonempty=True)
 
     def check_for_collisions(self, fns):
         if self.method == 'dry_run':
@@ -75,15 +131,48 @@ class Submitter():
             raise RuntimeError("file %s should be executable, but it is not" %(fn))
 
     def move_files(self, start_fns, end_fns):
+        '''rename files here, rather than as jobs'''
         assert(len(start_fns) == len(end_fns))
-        cmds = [['mv', x, y] for x, y in zip(start_fns, end_fns)]
-        self.execute(cmds)
+        if self.method == 'dry_run':
+            print "\n".join(["mv %s %s" %(x, y) for x, y in zip(start_fns, end_fns)])
+        else:
+            for x, y in zip(start_fns, end_fns):
+                os.rename(x, y)
 
     def rm_files(self, fns):
-        cmds = [['rm', fn] for fn in fns]
-        self.execute(cmds)
+        '''remove files here, rather than as jobs'''
+        if self.method == 'dry_run':
+            print "\n".join(["rm %s" %(fn) for fn in fns])
+        else:
+            for fn in fns:
+                os.remove(fn)
+
+    def wrap(self, cmd, stage=None):
+        '''shell line that runs a command, measured if telemetry is on'''
+        if self.telemetry is None:
+            return cmd
+        else:
+            return self.telemetry.wrap(cmd, stage or self.stage)
+
+    def execute(self, cmds, serial=False):
+        '''
+        run a list of commands (each a list of words or a shell string)
+
+        serial : bool
+            run the commands one at a time, in order, each waiting for the one
+            before it? (for chains of commands that read each other's outputs)
+
+        returns : list of ints or None
+            in local mode, the exit status of each command
+        '''
+
+        if serial:
+            statuses = [self.execute([cmd]) for cmd in cmds]
+            if self.method == 'local':
+                return [status for x in statuses for status in x]
+            else:
+                return None
 
-    def execute(self, cmds):
         # recast all parts of the command to strings
         # swo> I regret this hack. It's to make spp's redirect command work.
         #cmds = [[str(x) for x in cmd] for cmd in cmds]
@@ -95,27 +184,448 @@ class Submitter():
 
         cmds = [recast_cmd(cmd) for cmd in cmds]
 
+        if self.workers and self.method != 'dry_run':
+            return self.execute_in_workers([cmd[0] if len(cmd) == 1 else cmd for cmd in cmds])
+
+        if self.retries > 0 and self.method != 'dry_run':
+            return self.execute_with_markers([" ".join(cmd) for cmd in cmds])
+
         if self.method == 'submit':
             # recast commands as single lines
             cmds = [" ".join(cmd) for cmd in cmds]
-            self.ssub.submit_and_wait(cmds)
+            self.ssub.submit_and_wait([self.wrap(cmd) for cmd in cmds], memory=self.memory)
         elif self.method == 'local':
-            for cmd in cmds:
-                print " ".join(cmd)
-                if len(cmd) > 1:
-                    subprocess.check_call(cmd)
-                elif len(cmd) == 1:
-                    subprocess.check_call(cmd[0], shell=True)
+            # single words are shell strings
+            cmds = [cmd[0] if len(cmd) == 1 else cmd for cmd in cmds]
+
+            if self.telemetry is None:
+                statuses = self.runner.run(cmds)
+            else:
+                # word lists are quoted so the shell sees the same words
+                statuses = self.runner.run([self.wrap(cmd if type(cmd) is str else " ".join([pipes.quote(word) for word in cmd])) for cmd in cmds])
+
+            if statuses.count(0) < len(statuses):
+                raise RuntimeError("local command(s) failed:\n" + local_runner.status_report(cmds, statuses))
+
+            return statuses
         elif self.method == 'dry_run':
             print "\n".join([" ".join(cmd) for cmd in cmds])
 
+    def execute_with_markers(self, cmds):
+        '''
+        Run commands so that each one leaves a completion marker when it succeeds.
+        Commands without a marker (because they failed, were cancelled, or their node
+        died) are rerun, up to the number of retries, before moving on.
+
+        cmds : list of shell strings
+
+        returns : list of ints
+            exit status of each command (all 0)
+        '''
+
+        marker_dir = tempfile.mkdtemp(prefix='.SmileTrain.done.', dir=os.getcwd())
+        markers = [os.path.join(marker_dir, str(i)) for i in range(len(cmds))]
+
+        # exit status of each command's last run (None if unknown)
+        statuses = [None for cmd in cmds]
+
+        todo = range(len(cmds))
+        try:
+            for attempt in range(self.retries + 1):
+                if attempt > 0:
+                    message("rerunning %d of %d commands that did not complete (attempt %d of %d)" %(len(todo), len(cmds), attempt + 1, self.retries + 1), indent=4)
+
+                marked_cmds = [marked_command(self.wrap(cmds[i]), markers[i]) for i in todo]
+                if self.method == 'submit':
+                    # commands that fail are rerun below, so only stop at the first failure
+                    # (and report it) on the last attempt
+                    self.ssub.submit_and_wait(marked_cmds, fail_fast=(attempt == self.retries), memory=self.memory)
+                elif self.method == 'local':
+                    for i, status in zip(todo, self.runner.run(marked_cmds)):
+                        statuses[i] = status
+
+                todo = [i for i in todo if not os.path.isfile(markers[i])]
+                if len(todo) == 0:
+                    break
+        finally:
+            shutil.rmtree(marker_dir)
+
+        if len(todo) > 0:
+            if self.method == 'local':
+                report = local_runner.status_report([cmds[i] for i in todo], [statuses[i] for i in todo])
+            else:
+                # failed array tasks were reported when they stopped the last attempt, so
+                # these did not finish at all (e.g., their node died)
+                report = "\n".join([cmds[i] for i in todo])
+
+            raise RuntimeError("command(s) did not complete after %d attempt(s):\n%s" %(self.retries + 1, report))
+
+        return [0 for cmd in cmds]
+
+    def execute_in_workers(self, cmds):
+        '''
+        Queue commands for warm workers and wait for them. Commands that fail are
+        requeued, up to the number of retries, as are commands whose worker job died in
+        submit mode. A local worker that dies is an error.
+
+        cmds : list of commands (lists of words or shell strings)
+
+        returns : list of ints
+            exit status of each command (all 0)
+        '''
+
+        if self.queue is None:
+            self.queue = worker.TaskQueue(tempfile.mkdtemp(prefix='.SmileTrain.queue.', dir=os.getcwd()))
+
+        if self.telemetry is None:
+            record_dir = None
+        else:
+            record_dir = self.telemetry.record_dir
+
+        statuses = [None for cmd in cmds]
+        todo = range(len(cmds))
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                message("rerunning %d of %d commands that did not complete (attempt %d of %d)" %(len(todo), len(cmds), attempt + 1, self.retries + 1), indent=4)
+
+            task_ids = {}
+            for i in todo:
+                task_ids[i] = self.n_queued
+                self.n_queued += 1
+                self.queue.put(task_ids[i], cmds[i], record_dir, self.stage)
+
+            if self.method == 'local':
+                self.wait_for_local_workers(task_ids.values())
+            elif self.method == 'submit':
+                # each job is one worker, which exits once the queue is empty
+                n_jobs = min(len(todo), self.ssub.n_cpus)
+                worker_cmd = "python %s %s --exit_when_idle" %(worker.script_fn, self.queue.dir)
+                self.ssub.submit_and_wait([worker_cmd] * n_jobs, fail_fast=False, memory=self.memory)
+
+            for i in todo:
+                # commands that no worker got to should not be left for the next stage
+                self.queue.cancel(task_ids[i])
+                statuses[i] = self.queue.status(task_ids[i])
+
+            todo = [i for i in todo if statuses[i] != 0]
+            if len(todo) == 0:
+                break
+
+        if len(todo) > 0:
+            raise RuntimeError("command(s) did not complete after %d attempt(s):\n%s" %(self.retries + 1, local_runner.status_report([cmds[i] for i in todo], [statuses[i] for i in todo])))
+
+        return statuses
+
+    def wait_for_local_workers(self, task_ids, poll_interval=0.05):
+        '''start the local workers, if they are not running, and wait for some queued commands'''
+        if self.worker_runner is None:
+            n_workers = min(self.n_cpus, multiprocessing.cpu_count())
+            self.worker_runner = local_runner.LocalRunner(n_workers, out=self.runner.out)
+            for i in range(n_workers):
+                self.worker_runner.start(i, ['python', worker.script_fn, self.queue.dir], prefix="[worker %d] " %(i))
+
+        waiting = list(task_ids)
+        while len(waiting) > 0:
+            for i, status in self.worker_runner.poll():
+                self.worker_runner.cancel()
+                self.worker_runner = None
+                raise RuntimeError("worker %d exited early with status %d" %(i, status))
+
+            waiting = [task_id for task_id in waiting if self.queue.status(task_id) is None]
+            if len(waiting) > 0:
+                time.sleep(poll_interval)
+
+    def close(self):
+        '''stop any local workers and remove the queue'''
+        if self.worker_runner is not None:
+            self.queue.stop()
+            while len(self.worker_runner.running) > 0:
+                self.worker_runner.wait_any()
+
+            self.worker_runner = None
+
+        if self.queue is not None:
+            shutil.rmtree(self.queue.dir)
+            self.queue = None
+
+    def prepare_copy(self, task):
+        '''
+        Snapshot a straggling task's inputs as hard links, which keep the inputs as they
+        were even if the original task replaces them with its outputs, and make the
+        command line for a copy that reads the snapshots
+
+        returns : string or None
+            command line, or None if the original has already claimed its outputs or
+            the inputs could not be linked
+        '''
+
+        snapshots = dict([(fn, '%s.copy' %(fn)) for fn in task.inputs])
+
+        try:
+            for fn, snapshot in snapshots.items():
+                if os.path.exists(snapshot):
+                    os.remove(snapshot)
+
+                os.link(fn, snapshot)
+        except OSError as e:
+            message("could not snapshot the inputs of task %s: %s" %(task.name, e), indent=4)
+            self.clear_copies(task)
+            return None
+
+        # the links were made before looking, so if the original has not claimed its
+        # outputs yet, it has not replaced any of its inputs either
+        if task.winner is not None and os.path.isdir(task.winner):
+            self.clear_copies(task)
+            return None
+
+        return " && ".join([scheduler.command_line(cmd) for cmd in task.copy(snapshots)])
+
+    def clear_copies(self, task):
+        '''remove a task's input snapshots and the mark left by the copy that finished first'''
+        for fn in task.inputs:
+            if os.path.exists('%s.copy' %(fn)):
+                os.remove('%s.copy' %(fn))
+
+        if task.winner is not None and os.path.isdir(task.winner):
+            os.rmdir(task.winner)
+
+    def execute_graph(self, tasks):
+        '''
+        Run a dependency graph of tasks, starting each task as soon as the tasks it
+        depends on have finished and their outputs are in place.
+
+        If speculating, a task that runs much longer than the finished tasks of its
+        stage gets a copy, started on another slot. Whichever copy finishes first
+        finishes the task, and the other is cancelled.
+
+        tasks : list of scheduler.Tasks
+        '''
+
+        graph = scheduler.TaskGraph(tasks)
+
+        # number of times each task has been started
+        attempts = dict([(task, 0) for task in tasks])
+
+        if self.speculate > 0:
+            speculator = scheduler.Speculator(self.speculate)
+            timeout = 1.0
+        else:
+            speculator = None
+            timeout = None
+
+        # the key of a running task is the task itself, and the key of its copy is
+        # (task, 'copy'). key -> time it started (None if it has not started yet).
+        started = {}
+
+        def other_key(key):
+            if isinstance(key, tuple):
+                return key[0], key[0]
+            else:
+                return key, (key, 'copy')
+
+        if self.method == 'dry_run':
+            for task in graph.order():
+                after = ", ".join([dep.name for dep in task.deps])
+                message("%s (after: %s)" %(task.name, after or "nothing"), indent=4)
+                print task.command_line()
+        elif self.method == 'local':
+            def start(key, line):
+                task, other = other_key(key)
+                started[key] = time.time()
+                self.runner.start(key, self.wrap(line, task.stage), prefix="[%s] " %(task.name))
+
+            while not graph.done():
+                for task in graph.ready():
+                    if not self.runner.has_slot():
+                        break
+
+                    graph.start(task)
+                    attempts[task] += 1
+                    self.clear_copies(task)
+                    start(task, task.command_line())
+
+                if speculator is not None and self.runner.has_slot():
+                    n_free = self.runner.n_procs - len(self.runner.running)
+                    elapsed = dict([(key, time.time() - started[key]) for key in started if not isinstance(key, tuple)])
+                    for task in speculator.stragglers(elapsed, n_free):
+                        line = self.prepare_copy(task)
+                        if line is not None:
+                            message("task %s is running slowly; starting a copy" %(task.name), indent=4)
+                            start((task, 'copy'), line)
+
+                for key, status in self.runner.wait_any(timeout):
+                    if key not in started:
+                        # a copy that finished alongside the winner
+                        continue
+
+                    task, other = other_key(key)
+                    seconds = time.time() - started.pop(key)
+
+                    if status != 0 and other in started:
+                        # the other copy may still finish
+                        continue
+
+                    if other in started:
+                        message("task %s: the first copy to finish won; cancelling the other" %(task.name), indent=4)
+                        self.runner.cancel([other])
+                        del started[other]
+
+                    self.clear_copies(task)
+
+                    if status != 0:
+                        if attempts[task] <= self.retries:
+                            message("task %s failed with exit status %d; rerunning it" %(task.name, status), indent=4)
+                            attempts[task] += 1
+                            start(task, task.command_line())
+                            continue
+
+                        self.runner.cancel()
+                        raise RuntimeError("task %s failed with exit status %d" %(task.name, status))
+
+                    if speculator is not None:
+                        speculator.finished(task, seconds)
+
+                    self.check_for_nonempty(task.outputs)
+                    graph.finish(task)
+        elif self.method == 'submit':
+            # each task is its own job; one monitor watches all of them. a task that does
+            # not leave its completion marker is resubmitted.
+            marker_dir = tempfile.mkdtemp(prefix='.SmileTrain.done.', dir=os.getcwd())
+            markers = dict([(task, os.path.join(marker_dir, str(i))) for i, task in enumerate(graph.tasks)])
+            markers.update([((task, 'copy'), '%s.copy' %(markers[task])) for task in graph.tasks])
+
+            monitor = ssub.JobMonitor(self.ssub)
+
+            # task -> job ids of its copy that lost and was cancelled. qdel takes effect
+            # later, so the winner mark and snapshots stay until those jobs have left
+            # the queue; otherwise the loser could claim the outputs again.
+            cancelled = {}
+
+            def submit(key, line):
+                task, other = other_key(key)
+                started[key] = None
+                monitor.add(key, self.ssub.submit([marked_command(self.wrap(line, task.stage), markers[key])]))
+
+            try:
+                while not graph.done():
+                    for task in graph.ready():
+                        graph.start(task)
+                        attempts[task] += 1
+                        self.clear_copies(task)
+                        submit(task, task.command_line())
+
+                    if speculator is not None:
+                        # jobs write their start times when they start
+                        now = time.time()
+                        for key in started:
+                            if started[key] is None:
+                                started[key] = self.ssub.task_started(monitor.groups[key][0])
+
+                        elapsed = dict([(key, None if started[key] is None else now - started[key]) for key in started if not isinstance(key, tuple)])
+                        for task in speculator.stragglers(elapsed):
+                            line = self.prepare_copy(task)
+                            if line is not None:
+                                message("task %s is running slowly; submitting a copy" %(task.name), indent=4)
+                                submit((task, 'copy'), line)
+
+                    for key in monitor.wait_any(timeout):
+                        if key not in started:
+                            # a copy that finished alongside the winner
+                            continue
+
+                        task, other = other_key(key)
+                        start = started.pop(key)
+                        complete = os.path.isfile(markers[key])
+
+                        if not complete and other in started:
+                            # the other copy may still finish
+                            continue
+
+                        if other in started:
+                            message("task %s: the first copy to finish won; cancelling the other" %(task.name), indent=4)
+                            cancelled[task] = monitor.groups[other]
+                            monitor.remove(other)
+                            del started[other]
+                        else:
+                            self.clear_copies(task)
+
+                        if not complete:
+                            if attempts[task] <= self.retries:
+                                message("task %s did not complete; resubmitting it" %(task.name), indent=4)
+                                attempts[task] += 1
+                                submit(task, task.command_line())
+                                continue
+
+                            raise RuntimeError("task %s did not complete" %(task.name))
+
+                        if speculator is not None and start is not None:
+                            speculator.finished(task, time.time() - start)
+
+                        self.check_for_nonempty(task.outputs)
+                        graph.finish(task)
+            finally:
+                # after a failure, jobs of other tasks may still be running
+                for key in monitor.groups.keys():
+                    monitor.remove(key)
+
+                if len(cancelled) > 0:
+                    self.wait_for_jobs_to_leave([job_id for job_ids in cancelled.values() for job_id in job_ids])
+                    for task in cancelled:
+                        self.clear_copies(task)
+
+                shutil.rmtree(marker_dir)
+
+    def wait_for_jobs_to_leave(self, job_ids, poll_interval=2.0):
+        '''wait until cancelled jobs are no longer queued or running'''
+        while True:
+            try:
+                running = set(self.ssub.running_jobs(job_ids))
+            except RuntimeError as e:
+                # a failed query says nothing about the jobs; try again
+                message('job status query failed: %s' %(e), indent=6)
+                running = set(job_ids)
+
+            if len(running.intersection(job_ids)) == 0:
+                break
+
+            time.sleep(poll_interval)
+
+    def submit_graph(self, tasks):
+        '''
+        Submit every task of a dependency graph at once, each held by the cluster's
+        scheduler until the jobs of the tasks it depends on have finished. Nothing
+        waits for the jobs or checks their outputs.
+
+        tasks : list of scheduler.Tasks
+
+        returns : dict
+            job ids of each task
+        '''
+
+        if self.method != 'submit':
+            raise RuntimeError("only cluster jobs can be submitted without waiting for them")
+
+        job_ids = {}
+        for task in scheduler.TaskGraph(tasks).order():
+            depends_on = [job_id for dep in task.deps for job_id in job_ids[dep]]
+            job_ids[task] = self.ssub.submit([task.command_line()], depends_on=depends_on)
+
+        return job_ids
+
 
 # open the config file sister to this script
 config = ConfigParser.ConfigParser()
 config.read(os.path.join(os.path.dirname(__file__), 'user.cfg'))
 
-def parse_args():
-    '''arguments to be parsed and passed to the OTU_Caller object'''
+def parse_args(argv=None, save=True):
+    '''
+    arguments to be parsed and passed to the OTU_Caller object
+
+    argv : list of strings (optional)
+        arguments to parse, rather than those on the command line
+    save : bool (default True)
+        save the arguments in the current directory, for --redo
+    '''
 
     # create argument parser
     parser = argparse.ArgumentParser(description="Smile Train: a 16S pipeline", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -157,12 +667,14 @@ def parse_args():
     group1.add_argument('--seq_tax', action='store_true', help='Get taxonomies for sequence table?')
     group1.add_argument('--dbotu', action='store_true', help='Call OTUs using dbOTUs?')
     group1.add_argument('--otu_table', action='store_true', help='Make OTU table?')
+    group1.add_argument('--only', default=None, help='run only these of the selected stages (comma-separated stage names, e.g., dereplicate,index)')
     group2.add_argument('--forward', '-f', help='Input fastq (forward)')
     group2.add_argument('--reverse', '-r', help='Input fastq (reverse)')
     group2.add_argument('-p', help='Primer sequence (forward)')
     group2.add_argument('-q', help='Primer sequence (reverse)')
     group2.add_argument('--barcodes', '-b', default=None, help='Barcodes list')
     group4.add_argument('--p_mismatch', default=1, type=int, help='Number of mismatches allowed in primers')
+    group5.add_argument('--merge_threads', default=1, type=int, help='Processes for each merge command (one per shard)')
     group6.add_argument('--b_mismatch', default=1, type=int, help='Number of mismatches allowed in barcodes')
     group7.add_argument('--truncqual', default = 2, type = int, help = '')
     group7.add_argument('--maxee', default = 2., type = float, help = 'Maximum expected error (UPARSE)')
@@ -179,14 +691,26 @@ def parse_args():
     group12.add_argument('--dbotu_jscutoff', default=0.02, type=float, help='Jensen-Shannon divergence cut-off value used with --dbotu_js (default=0.02)')
     group12.add_argument('--dbotu_id', default=0.1, type=float, help='Distance used for dbOTUs and/or pre-clustering (default=0.1)')
     group13.add_argument('--align_start',  default=5, type=int, help='split upstream fastq into how many files?')
-    group13.add_argument('--n_split', '-n', default=1, type=int, help='split upstream fastq into how many files?')
+    group13.add_argument('--n_split', '-n', default=1, type=int, help='split upstream fastq into how many files? (0 to choose from the input size)')
+    group13.add_argument('--shard_mb', default=resources.default_shard_mb, type=float, help='target shard size in megabytes, when choosing the number of shards')
+    group13.add_argument('--packing', choices=['round_robin', 'lpt'], default='lpt', help='spread cluster commands over jobs in turn, or biggest inputs first (longest-processing-time packing)')
+    group13.add_argument('--retries', default=1, type=int, help='number of times to rerun shard commands that fail before giving up on a stage')
+    group13.add_argument('--detach', action='store_true', help='with --dag on a cluster, submit all the per-shard jobs chained by scheduler dependencies and exit without waiting')
+    group13.add_argument('--workers', action='store_true', help='run commands on one warm python worker per local process or cluster job, instead of starting python for each command')
+    group13.add_argument('--metrics', default='SmileTrain.metrics.json', help='file for the time, memory, and I/O used by each command (empty to not measure)')
+    group13.add_argument('--scratch', action='store_true', help='with --dag, run each shard through its stages in node-local scratch space (scratch in user.cfg, or $TMPDIR), copying back only the finished shard')
+    group13.add_argument('--speculate', default=0, type=float, help='with --scratch, start a copy of a shard that has run this many times longer than the median finished shard, keeping the first to finish (0 to never copy)')
+    group13.add_argument('--stream', action='store_true', help='with --dag, pass each shard from stage to stage through pipes, writing only the finished shard to disk')
+    group13.add_argument('--dag', action='store_true', help='run the per-shard stages (split through quality filter) as a dependency graph, so shards do not wait for each other between stages')
     group14.add_argument('--demultiplex', default = False, action = 'store_true', help = 'Demultiplex?')
     group14.add_argument('--already_demultiplexed', default = False, action = 'store_true', help = 'Already have seperate demultiplexed files?')
     group_run.add_argument('--dry_run', '-z', action='store_true', help='submit no jobs; suppress file checks; just print output commands')
     group_run.add_argument('--local', '-l', action='store_true', help='execute all tasks locally')
     
     # parse arguments
-    if __name__ == '__main__':
+    if argv is not None:
+        args = parser.parse_args(argv)
+    elif __name__ == '__main__':
         args = parser.parse_args()
     else:
         args = parser.parse_args('')
@@ -195,6 +719,9 @@ def parse_args():
         # load command line arguments if available
         with open(commands_fn, 'rb') as f:
             args = pickle.load(f)
+
+        # the saved arguments were from a run without --redo
+        args.redo = True
     else:
         # process arguments
         if args.all == True:
@@ -202,16 +729,123 @@ def parse_args():
         args.sids = map(int, args.sids.split(','))
         
         # check combinations
+        if args.detach and not args.dag:
+            raise RuntimeError("--detach only works with --dag")
+
+        if args.stream and not args.dag:
+            raise RuntimeError("--stream only works with --dag")
+
+        if args.scratch and not args.dag:
+            raise RuntimeError("--scratch only works with --dag")
+
+        if args.speculate > 0 and not args.scratch:
+            raise RuntimeError("--speculate only works with --scratch")
+
         if args.check or args.split or args.convert or args.primers or args.merge or args.demultiplex or args.qfilter:
             if args.forward is None and args.reverse is None:
                 raise RuntimeError("no fastq files selected")
 
         # save arguments for use with redo
-        with open(commands_fn, 'wb') as f:
-            pickle.dump(args, f)
+        if save:
+            with open(commands_fn, 'wb') as f:
+                pickle.dump(args, f)
         
     return args
 
+# the message and OTU_Caller method of each stage
+stage_steps = {'check': ('Checking input formats', 'check_format'),
+    'shards': ('Running per-shard stages as a dependency graph', 'run_shard_graph'),
+    'split': ('Splitting fastq', 'split_fastq'),
+    'convert': ('Converting format', 'convert_format'),
+    'merge': ('Merging reads', 'merge_reads'),
+    'primers': ('Removing primers', 'remove_primers'),
+    'demultiplex': ('Demultiplexing', 'demultiplex_reads'),
+    'reformat': ('Already demultiplexed: reformatting sequence headers', 'reformat_headers'),
+    'qfilter': ('Quality filtering', 'quality_filter'),
+    'dereplicate': ('Dereplicating sequences', 'dereplicate_reads'),
+    'index': ('Indexing samples', 'make_index'),
+    'denovo': ('Denovo clustering', 'denovo_clustering'),
+    'ref_gg': ('Mapping to reference', 'reference_mapping'),
+    'dbotu_alignment': ('dbOTU: aligning sequences', 'dbotu_alignment'),
+    'dbotu_progressive': ('dbOTU: progressive clustering', 'dbotu_progressive_clustering'),
+    'dbotu_call': ('Calling dbOTUs', 'dbotu_call_otus'),
+    'ref_chimeras': ('Removing chimeras by reference', 'remove_reference_chimeras'),
+    'chimeras': ('Removing chimeras de novo with uchime', 'remove_denovo_chimeras'),
+    'dbotu_chimeras': ('Removing chimeras from dbOTUs de novo', 'dbotu_remove_chimeras'),
+    'seq_table': ('Making sequence table', 'make_seq_table'),
+    'seq_tax': ('Assigning sequence table taxonomies', 'get_seq_tax'),
+    'otu_table': ('Making OTU tables', 'make_otu_tables')}
+
+def selected_stages(args):
+    '''
+    Names of the stages that the options select, in the order they run
+
+    args : parsed arguments (or an OTU_Caller)
+
+    returns : list of strings
+    '''
+
+    stages = []
+
+    if args.check:
+        stages.append('check')
+
+    shard_stages = [stage for stage, selected in [('split', args.split), ('convert', args.convert), ('merge', args.merge),
+        ('primers', args.primers), ('demultiplex', args.demultiplex),
+        ('reformat', args.already_demultiplexed), ('qfilter', args.qfilter)] if selected]
+
+    if args.dag:
+        # the per-shard stages run as one graph
+        if len(shard_stages) > 0:
+            stages.append('shards')
+    else:
+        stages += shard_stages
+
+    for stage, selected in [('dereplicate', args.dereplicate), ('index', args.index), ('denovo', args.denovo),
+        ('ref_gg', args.ref_gg or args.open_ref_gg)]:
+        if selected:
+            stages.append(stage)
+
+    if args.dbotu:
+        stages.append('dbotu_alignment')
+        if args.dbotu_split:
+            stages.append('dbotu_progressive')
+        stages.append('dbotu_call')
+
+    for stage in ['ref_chimeras', 'chimeras', 'dbotu_chimeras', 'seq_table', 'seq_tax', 'otu_table']:
+        if getattr(args, stage):
+            stages.append(stage)
+
+    if getattr(args, 'only', None):
+        only = args.only.split(',')
+        unknown = [stage for stage in only if stage not in stage_steps]
+        if len(unknown) > 0:
+            raise RuntimeError("unrecognized stage(s) in --only: %s" %(" ".join(unknown)))
+
+        stages = [stage for stage in stages if stage in only]
+
+    return stages
+
+def reference_map_cmd(usearch, query, db, uc, map_sid, notmatched=None):
+    '''
+    command to map sequences to a reference database
+
+    map_sid : float
+        percent identity for a hit
+    notmatched : string (optional)
+        fasta for the sequences that did not hit
+    '''
+
+    cmd = [usearch, '-usearch_global', query, '-db', db, '-uc', uc, '-strand', 'both', '-id', '.%d' %(map_sid)]
+    if notmatched is not None:
+        cmd += ['-notmatched', notmatched]
+
+    return cmd
+
+def reference_chimeras_cmd(usearch, otus, gold_db, output):
+    '''command to keep the sequences that are not chimeras of reference sequences'''
+    return [usearch, '-uchime_ref', otus, '-db', gold_db, '-nonchimeras', output, '-strand', 'plus']
+
 
 class OTU_Caller():
     '''
@@ -225,8 +859,19 @@ class OTU_Caller():
         self.ggdb = config.get('Data', 'greengenes')
         self.library = config.get('Scripts', 'library')
 
+        # node-local scratch space, expanded on the node that uses it
+        if config.has_option('User', 'scratch'):
+            self.scratch_dir = config.get('User', 'scratch')
+        else:
+            self.scratch_dir = '${TMPDIR:-/tmp}'
+
         # copy command line arguments
         self.__dict__.update(parse_args().__dict__)
+
+        # choose the number of shards from the input size
+        if self.n_split == 0:
+            self.n_split = self.auto_n_split()
+
         # create filenames
         self.get_filenames()
 
@@ -240,8 +885,54 @@ class OTU_Caller():
             method = 'submit'
 
         cluster = config.get('User', 'cluster')
-        self.sub = Submitter(method, cluster=cluster, n_cpus=self.n_split)
+        self.sub = Submitter(method, cluster=cluster, n_cpus=self.n_split, retries=self.retries, packing=self.packing, workers=self.workers, speculate=self.speculate)
+
+        # records of completed stages, for skipping up-to-date stages with --redo
+        self.manifest = manifest.Manifest()
+
+        # measure every command, except those of jobs we will not wait for
+        if self.metrics and method != 'dry_run' and not self.detach:
+            self.sub.telemetry = telemetry.Recorder()
     
+    # options that change each stage's outputs
+    stage_options = {'check': [], 'split': ['n_split'], 'convert': [], 'merge': ['truncqual'],
+        'primers': ['p', 'q', 'p_mismatch'], 'demultiplex': ['b_mismatch'], 'reformat': [],
+        'qfilter': ['truncqual', 'maxee', 'trunclen'], 'dereplicate': [], 'index': [],
+        'denovo': ['sids'], 'ref_gg': ['sids', 'open_ref_gg'], 'dbotu_alignment': ['alignref', 'align_start', 'minlength'],
+        'dbotu_progressive': ['dbotu_id'], 'dbotu_call': ['k_fold', 'pval', 'dbotu_id', 'dbotu_split', 'dbotu_js', 'dbotu_jscutoff'],
+        'ref_chimeras': ['gold_db'], 'chimeras': [], 'dbotu_chimeras': [], 'seq_table': [], 'seq_tax': [], 'otu_table': [],
+        'shards': ['split', 'convert', 'merge', 'primers', 'demultiplex', 'already_demultiplexed', 'qfilter',
+            'n_split', 'truncqual', 'p', 'q', 'p_mismatch', 'b_mismatch', 'maxee', 'trunclen']}
+
+    def auto_n_split(self):
+        '''number of shards for the input size, up to the number that can run at once'''
+        inputs = [fn for fn in [self.forward, self.reverse] if fn and os.path.isfile(fn)]
+
+        if self.local:
+            max_shards = multiprocessing.cpu_count()
+        else:
+            max_shards = ssub.default_slot_limit
+
+        n_split = resources.auto_shard_count(inputs, self.shard_mb, max_shards)
+        message('splitting into %d shard(s) of about %g MB or less' %(n_split, self.shard_mb))
+        return n_split
+
+    def stage_memory(self, stage):
+        '''memory (gb) to request for each job in a stage, from the size of its inputs, or None for the default'''
+        if stage in ['index', 'seq_table']:
+            # these scale with the unique sequences
+            inputs = ['q.derep.fst']
+        else:
+            inputs = self.stage_files(stage)[0]
+
+        # sharded stages divide their inputs among one command per shard
+        if stage in self.stage_options['shards']:
+            n_commands = self.n_split
+        else:
+            n_commands = 1
+
+        return resources.stage_memory_gb(stage, inputs, n_commands)
+
     def get_filenames(self):
         '''Generate filenames to use in pipeline'''
 
@@ -254,6 +945,7 @@ class OTU_Caller():
             self.fi = ['%s.%d' %(self.forward, i) for i in range(self.n_split)] # forward reads (split)
             self.ri = ['%s.%d' %(self.reverse, i) for i in range(self.n_split)] # reverse reads (split)
             self.mi = ['%s.%d.merge' %(self.forward, i) for i in range(self.n_split)] # merged reads (split)
+            self.li = ['%s.%d.merge.log' %(self.forward, i) for i in range(self.n_split)] # merge statistics (split)
             self.Fi = ['%s.%d.tmp' %(self.forward, i) for i in range(self.n_split)] # forward reads (temp)
             self.Ri = ['%s.%d.tmp' %(self.reverse, i) for i in range(self.n_split)] # reverse reads (temp)
             self.Mi = ['%s.%d.tmp' %(self.forward, i) for i in range(self.n_split)] # merged reads (temp)
@@ -277,6 +969,138 @@ class OTU_Caller():
             elif self.ref_gg or self.open_ref_gg:
                 self.db = ['%s/%d_otus.fasta' %(self.ggdb, sid) for sid in self.sids]
                 
+    def stage_files(self, stage):
+        '''
+        Files read and written by a stage
+
+        returns : tuple
+            (inputs, outputs, temporary files); outputs include files the stage removes
+        '''
+
+        raw = [fn for fn in [self.forward, self.reverse] if fn]
+        fwd = self.fi if self.forward else []
+        rev = self.ri if self.reverse else []
+        barcodes = [self.barcodes] if self.barcodes else []
+
+        if stage == 'check':
+            return raw, [], []
+        elif stage == 'split':
+            return raw, fwd + rev, []
+        elif stage == 'convert':
+            return fwd + rev, fwd + rev, self.Fi + self.Ri
+        elif stage == 'merge':
+            return self.fi + self.ri, self.fi + self.li + self.ri, self.Fi
+        elif stage == 'primers':
+            return self.fi, self.fi, self.Fi
+        elif stage == 'demultiplex':
+            return self.ci + barcodes, self.ci, self.Ci
+        elif stage == 'reformat':
+            return self.ci, self.ci, self.Ci
+        elif stage == 'qfilter':
+            return self.ci, ['q.fst'], []
+        elif stage == 'shards':
+            inputs = raw if self.split else fwd + rev
+            outputs = ['q.fst'] if self.qfilter else fwd + rev
+            if self.merge:
+                outputs += self.li + rev
+            temps = (self.Fi + self.Ci if self.forward else []) + (self.Ri if self.reverse else [])
+            return inputs + barcodes, outputs, temps
+        elif stage == 'dereplicate':
+            return ['q.fst'], ['q.derep.fst'], []
+        elif stage == 'index':
+            return ['q.fst', 'q.derep.fst'], ['q.index'], []
+        elif stage == 'denovo':
+            return ['q.derep.fst'], self.oi, []
+        elif stage == 'ref_gg':
+            outputs = self.uc + (self.open_fst if self.open_ref_gg else [])
+            return ['q.derep.fst'] + self.db, outputs, []
+        elif stage == 'dbotu_alignment':
+            return ['q.derep.fst', 'q.index'], ['unique.good.align', 'unique.f0.good.mat'], []
+        elif stage == 'dbotu_progressive':
+            return ['unique.good.align', 'unique.f0.good.mat'], ['unique.PC.final.list'], []
+        elif stage == 'dbotu_call':
+            return ['unique.f0.good.mat', 'unique.good.align'], ['unique.dbOTU.list', 'unique.dbOTU.ng.fasta', 'unique.dbOTU.mat', 'unique.dbOTU.log'], []
+        elif stage in ['ref_chimeras', 'chimeras']:
+            return self.oi, self.oi, self.Oi
+        elif stage == 'dbotu_chimeras':
+            return ['unique.dbOTU.mat', 'q.derep.fst'], ['unique.dbOTU.ng.fasta', 'unique.dbOTU.nonchimera.fasta', 'unique.dbOTU.nonchimera.mat'], []
+        elif stage == 'seq_table':
+            return ['q.fst', 'q.derep.fst'] + barcodes, ['seq.counts'], []
+        elif stage == 'seq_tax':
+            return ['seq.counts'], [self.seq_tax_fn], []
+        elif stage == 'otu_table':
+            return self.uc + ['q.index'] + barcodes, self.xi, []
+        else:
+            raise RuntimeError("unrecognized stage %s" %(stage))
+
+    def stage_params(self, stage):
+        '''values of the options that affect a stage's outputs'''
+        return dict([(option, getattr(self, option)) for option in self.stage_options[stage]])
+
+    def run_stages(self, stages):
+        '''
+        Run pipeline stages in order, recording what each one read and wrote. With
+        --redo, skip the stages at the start of the list that are already up to date,
+        and clear out the outputs of the others before rerunning them.
+
+        stages : list of (stage name, message, method)
+        '''
+
+        n_current = 0
+        if self.redo and not self.dry_run:
+            n_current = self.manifest.up_to_date([(stage, self.stage_params(stage)) for stage, text, method in stages])
+
+        try:
+            self.run_stages_from(stages, n_current)
+        finally:
+            self.sub.close()
+            if self.sub.telemetry is not None:
+                self.report_metrics()
+
+    def run_stages_from(self, stages, n_current):
+        '''run the stages in order, skipping the first n_current'''
+        for i, (stage, text, method) in enumerate(stages):
+            if i < n_current:
+                message('%s: up to date, skipping' %(text))
+                continue
+
+            message(text)
+
+            if self.dry_run:
+                method()
+                continue
+
+            inputs, outputs, temps = self.stage_files(stage)
+
+            if self.redo:
+                # outputs that are not rewritten in place are stale
+                stale = [fn for fn in outputs + temps if fn not in inputs and os.path.isfile(fn)]
+                if len(stale) > 0:
+                    message('removing stale files: %s' %(" ".join(stale)), indent=4)
+                    for fn in stale:
+                        os.remove(fn)
+
+            self.sub.memory = self.stage_memory(stage)
+            if self.sub.method == 'submit' and self.sub.memory is not None:
+                message('requesting %d gb per job' %(self.sub.memory), indent=4)
+
+            self.manifest.forget(stage)
+            input_signatures = self.manifest.signatures(inputs)
+
+            self.sub.stage = stage
+            start = time.time()
+            method()
+            if self.sub.telemetry is not None:
+                self.sub.telemetry.time_stage(stage, time.time() - start)
+
+            self.manifest.record(stage, input_signatures, outputs, self.stage_params(stage))
+
+    def report_metrics(self):
+        '''write the measurements of every command and summarize them by stage'''
+        self.sub.telemetry.write(self.metrics)
+        message('Resources used (details in %s):\n%s' %(self.metrics, self.sub.telemetry.summary()))
+        self.sub.telemetry.cleanup()
+
     def check_format(self):
         '''Make sure we have the correct input format'''
         files = []
@@ -295,6 +1119,52 @@ class OTU_Caller():
 
         self.sub.execute(cmds)
     
+    def split_cmd(self, fastq):
+        '''command to split a fastq into n_split shards'''
+        return ['python', '%s/split_fastq.py' %(self.library), fastq, self.n_split]
+
+    def convert_cmd(self, fastq, output):
+        '''command to convert one shard's fastq format'''
+        return ['python', '%s/convert_fastq.py' %(self.library), fastq, '--output', output]
+
+    def merge_cmd(self, forward, reverse, output, log):
+        '''command to merge the forward and reverse reads of one shard'''
+        return ['python', '%s/merge_pairs.py' %(self.library), forward, reverse, '--truncqual', self.truncqual, '--threads', self.merge_threads, '--output', output, '--log', log]
+
+    def primers_cmd(self, fastq, output):
+        '''command to remove primers from one shard'''
+        # use both primers if we have them, otherwise the forward only
+        if not self.p:
+            raise RuntimeError("remove primers called with bad input: need -p or both -p and -q")
+
+        cmd = ['python', '%s/remove_primers.py' %(self.library), fastq, self.p, '--max_primer_diffs', self.p_mismatch, '--output', output]
+        if self.q:
+            cmd += ['--reverse_primer', self.q]
+
+        return cmd
+
+    def demultiplex_cmd(self, fastq, output):
+        '''command to demultiplex one shard'''
+        return ['python', '%s/map_barcodes.py' %(self.library), fastq, self.barcodes, '--max_barcode_diffs', self.b_mismatch, '--output', output]
+
+    def reformat_cmd(self, fastq, output):
+        '''command to reformat the headers of one (already demultiplexed) shard'''
+        return ['python', '%s/reformat_headers.py' %(self.library), fastq, '--output', output]
+
+    def quality_filter_cmd(self, fastqs):
+        '''command to quality filter all the shards into q.fst, with a process per shard (up to the number of cpus)'''
+        threads = min(len(fastqs), multiprocessing.cpu_count())
+        cmd = ['python', '%s/quality_filter.py' %(self.library)] + fastqs + ['--truncqual', self.truncqual, '--maxee', self.maxee, '--threads', threads, '--output', 'q.fst']
+
+        if self.trunclen > 0:
+            cmd += ['--trunclen', self.trunclen]
+
+        return cmd
+
+    def check_format_cmd(self, fastqs):
+        '''command that fails unless the fastqs are in Illumina 1.8 format (or might be)'''
+        return ['python', '%s/check_fastq_format.py' %(self.library)] + fastqs + ['--require', 'illumina18', 'ambiguous']
+
     def split_fastq(self):
         '''Split forward and reverse reads (for parallel processing)'''
 
@@ -313,11 +1183,9 @@ class OTU_Caller():
         # Get list of commands
         cmds = []
         if do_forward:
-            cmd = ['python', '%s/split_fastq.py' %(self.library), self.forward, self.n_split]
-            cmds.append(cmd)
+            cmds.append(self.split_cmd(self.forward))
         if do_reverse:
-            cmd = ['python', '%s/split_fastq.py' %(self.library), self.reverse, self.n_split]
-            cmds.append(cmd)
+            cmds.append(self.split_cmd(self.reverse))
         
         # submit commands
         self.sub.execute(cmds)
@@ -342,11 +1210,9 @@ class OTU_Caller():
         cmds = []
         for i in range(self.n_split):
             if self.forward:
-                cmd = ['python', '%s/convert_fastq.py' %(self.library), self.fi[i], '--output', self.Fi[i]]
-                cmds.append(cmd)
+                cmds.append(self.convert_cmd(self.fi[i], self.Fi[i]))
             if self.reverse:
-                cmd = ['python', '%s/convert_fastq.py' %(self.library), self.ri[i], '--output', self.Ri[i]]
-                cmds.append(cmd)
+                cmds.append(self.convert_cmd(self.ri[i], self.Ri[i]))
                 
         self.sub.execute(cmds)
         
@@ -362,56 +1228,30 @@ class OTU_Caller():
             self.sub.check_for_nonempty(self.ri)
 
     def merge_reads(self):
-        '''Merge forward and reverse reads using USEARCH'''
+        '''Merge forward and reverse reads'''
 
         # check for inputs and collisions
         self.sub.check_for_nonempty(self.fi + self.ri)
-        self.sub.check_for_collisions(self.Fi + self.Ri)
-        
-        # check that usearch is ready to go
-        self.sub.check_is_executable(self.usearch)
-        
-        # check that forward and reverse reads intersect
-        cmds = []
-        for i in range(self.n_split):
-            cmd = ['python', '%s/check_intersect.py' %(self.library), self.fi[i], self.ri[i]]
-            cmds.append(cmd)
-        self.sub.execute(cmds)
-        
-        # Merge reads
-        cmds = []
-        for i in range(self.n_split):
-            cmd = [self.usearch, '-fastq_mergepairs', self.fi[i], '-reverse', self.ri[i], '-fastq_truncqual', self.truncqual, '-fastqout', self.Fi[i]]
-            cmds.append(cmd)
+        self.sub.check_for_collisions(self.Fi + self.Ri + self.li)
+
+        # merge reads; the merger checks that forward and reverse reads are paired
+        cmds = [self.merge_cmd(self.fi[i], self.ri[i], self.Fi[i], self.li[i]) for i in range(self.n_split)]
         self.sub.execute(cmds)
-        
-        self.sub.check_for_nonempty(self.Fi)
+
+        self.sub.check_for_nonempty(self.Fi + self.li)
         self.sub.rm_files(self.fi + self.ri)
         self.sub.move_files(self.Fi, self.fi)
         self.sub.check_for_nonempty(self.fi)
-    
+
     def remove_primers(self):
         '''Remove diversity region + primer and discard reads with > 2 mismatches'''
 
-        # do forward only if there is a forward read file and a forward primer
-        # similar for reverse
-        both = self.p and self.q
-        if not both:
-            if self.p and not self.q:
-                forward_only = True
-            else:
-                raise RuntimeError("remove primers called with bad input: need -p or both -p and -q")
-
         # check for inputs and collisions of output
         self.sub.check_for_nonempty(self.fi)
         self.sub.check_for_collisions(self.Fi)
         
-        # get list of commands using forward only
-        cmds = [['python', '%s/remove_primers.py' %(self.library), fi, self.p, '--max_primer_diffs', self.p_mismatch, '--output', fo] for fi, fo in zip(self.fi, self.Fi)]
-
-        # add reverse primer if needed
-        if both:
-            cmds = [cmd + ['--reverse_primer', self.q] for cmd in cmds]
+        # use the forward primer, and the reverse primer if there is one
+        cmds = [self.primers_cmd(fi, fo) for fi, fo in zip(self.fi, self.Fi)]
         
         # submit commands
         self.sub.execute(cmds)
@@ -427,10 +1267,7 @@ class OTU_Caller():
         self.sub.check_for_nonempty(self.ci)
         self.sub.check_for_collisions(self.Ci)
 
-        cmds = []
-        for i in range(self.n_split):
-            cmd = ['python', '%s/map_barcodes.py' %(self.library), self.ci[i], self.barcodes, '--max_barcode_diffs', self.b_mismatch, '--output', self.Ci[i]]
-            cmds.append(cmd)
+        cmds = [self.demultiplex_cmd(self.ci[i], self.Ci[i]) for i in range(self.n_split)]
         self.sub.execute(cmds)
         
         self.sub.check_for_nonempty(self.Ci)
@@ -441,10 +1278,7 @@ class OTU_Caller():
         self.sub.check_for_nonempty(self.ci)
         self.sub.check_for_collisions(self.Ci)
 
-        cmds = []
-        for i in range(self.n_split):
-            cmd = ['python', '%s/reformat_headers.py' %(self.library), self.ci[i],'--output', self.Ci[i]]
-            cmds.append(cmd)
+        cmds = [self.reformat_cmd(self.ci[i], self.Ci[i]) for i in range(self.n_split)]
         self.sub.execute(cmds)
         
         self.sub.check_for_nonempty(self.Ci)
@@ -453,38 +1287,272 @@ class OTU_Caller():
 
     
     def quality_filter(self):
-        '''Quality filter with truncqual and maximum expected error'''
+        '''Quality filter with truncqual and maximum expected error, writing all shards to q.fst'''
         
         # validate input/output
         self.sub.check_for_nonempty(self.ci)
-        self.sub.check_for_collisions(self.Ci)
-        
-        # check that usearch is ready to go
-        self.sub.check_is_executable(self.usearch)
+        self.sub.check_for_collisions('q.fst')
         
         # check that the files are in the right format
         if self.dry_run:
-            cmds = ['python %s/check_fastq_format.py %s' %(self.library, f) for f in self.ci]
-            message("\n".join(cmds), indent=0)
+            message(" ".join([str(x) for x in self.check_format_cmd(self.ci)]), indent=0)
         else:
             check_fastq_format.check_illumina_format(self.ci, ['illumina18', 'ambiguous'])
 
-        cmds = []
+        self.sub.execute([self.quality_filter_cmd(self.ci)])
+        self.sub.check_for_nonempty('q.fst')
+
+    def shard_tasks(self):
+        '''
+        Describe the selected per-shard stages (split through quality filter) as a
+        dependency graph. Each shard moves through convert, merge, primers, and
+        demultiplexing on its own, so a slow shard only holds up the quality filter,
+        which needs all of them.
+
+        returns : list of scheduler.Tasks
+        '''
+
+        tasks = []
+
+        # the last tasks to write each forward and reverse shard
+        fwd = [[] for i in range(self.n_split)]
+        rev = [[] for i in range(self.n_split)]
+
+        if self.split:
+            if self.forward:
+                task = scheduler.Task('split forward', [self.split_cmd(self.forward)], outputs=self.fi, stage='split')
+                tasks.append(task)
+                fwd = [[task] for i in range(self.n_split)]
+            if self.reverse:
+                task = scheduler.Task('split reverse', [self.split_cmd(self.reverse)], outputs=self.ri, stage='split')
+                tasks.append(task)
+                rev = [[task] for i in range(self.n_split)]
+
         for i in range(self.n_split):
-            cmd = [self.usearch, '-fastq_filter', self.ci[i], '-fastq_truncqual', self.truncqual, '-fastq_maxee', self.maxee, '-fastaout', self.Ci[i]]
+            if (self.stream or self.scratch) and (self.convert or self.merge or self.primers or self.demultiplex or self.already_demultiplexed):
+                task = self.shard_task(i, fwd[i] + rev[i])
+                tasks.append(task)
+                fwd[i] = [task]
+                rev[i] = []
+                continue
+
+            if self.convert:
+                if self.forward:
+                    cmds = [self.convert_cmd(self.fi[i], self.Fi[i]), ['mv', self.Fi[i], self.fi[i]]]
+                    task = scheduler.Task('convert forward %d' %(i), cmds, deps=fwd[i], outputs=[self.fi[i]], stage='convert')
+                    tasks.append(task)
+                    fwd[i] = [task]
+                if self.reverse:
+                    cmds = [self.convert_cmd(self.ri[i], self.Ri[i]), ['mv', self.Ri[i], self.ri[i]]]
+                    task = scheduler.Task('convert reverse %d' %(i), cmds, deps=rev[i], outputs=[self.ri[i]], stage='convert')
+                    tasks.append(task)
+                    rev[i] = [task]
+
+            if self.merge:
+                # the reverse reads are only removed once the merged reads are in place, so
+                # a job that dies before then can be rerun
+                cmds = [self.merge_cmd(self.fi[i], self.ri[i], self.Fi[i], self.li[i]), ['mv', self.Fi[i], self.fi[i]], ['rm', self.ri[i]]]
+                task = scheduler.Task('merge %d' %(i), cmds, deps=fwd[i] + rev[i], outputs=[self.fi[i], self.li[i]], stage='merge')
+                tasks.append(task)
+                fwd[i] = [task]
+                rev[i] = []
+
+            if self.primers:
+                cmds = [self.primers_cmd(self.fi[i], self.Fi[i]), ['mv', self.Fi[i], self.fi[i]]]
+                task = scheduler.Task('primers %d' %(i), cmds, deps=fwd[i], outputs=[self.fi[i]], stage='primers')
+                tasks.append(task)
+                fwd[i] = [task]
+
+            if self.demultiplex:
+                cmds = [self.demultiplex_cmd(self.fi[i], self.Ci[i]), ['mv', self.Ci[i], self.fi[i]]]
+                task = scheduler.Task('demultiplex %d' %(i), cmds, deps=fwd[i], outputs=[self.fi[i]], stage='demultiplex')
+                tasks.append(task)
+                fwd[i] = [task]
+            elif self.already_demultiplexed:
+                cmds = [self.reformat_cmd(self.fi[i], self.Ci[i]), ['mv', self.Ci[i], self.fi[i]]]
+                task = scheduler.Task('reformat %d' %(i), cmds, deps=fwd[i], outputs=[self.fi[i]], stage='reformat')
+                tasks.append(task)
+                fwd[i] = [task]
+
+        if self.qfilter:
+            deps = [task for shard in fwd for task in shard]
+            cmds = [self.check_format_cmd(self.fi), self.quality_filter_cmd(self.fi)]
+            task = scheduler.Task('quality filter', cmds, deps=deps, outputs=['q.fst'], stage='qfilter')
+            tasks.append(task)
+
+        return tasks
+
+    def shard_task(self, i, deps):
+        '''
+        One task that runs shard i through all the selected per-shard stages (convert
+        through demultiplexing).
+
+        With --stream, reads pass from stage to stage through pipes, and the forward
+        and reverse reads reach the merge through named pipes, so only the finished
+        shard is written. With --scratch, the shard's files are copied into node-local
+        scratch space, the stages run there, and only the finished shard (and the
+        merge log) are copied back to the working directory. With --speculate as well,
+        a copy of a slow shard's task can run at the same time, reading snapshots of
+        the shard's files, and only the first to finish copies back its results.
+
+        deps : list of scheduler.Tasks
+            the tasks that make the shard's forward and reverse reads
+
+        returns : scheduler.Task
+        '''
+
+        if self.scratch:
+            where = scheduler.scratch_fn
+        else:
+            where = lambda fn: fn
 
-            if self.trunclen > 0:
-                cmd += ['-fastq_trunclen', self.trunclen]
+        f, r, F, R, l = [where(fn) for fn in [self.fi[i], self.ri[i], self.Fi[i], self.Ri[i], self.li[i]]]
+
+        if self.stream:
+            cmds = self.stream_shard_cmds(f, r, F, R, l)
+        else:
+            cmds = []
+            if self.convert:
+                cmds += [self.convert_cmd(f, F), ['mv', F, f]]
+                if self.reverse:
+                    cmds += [self.convert_cmd(r, R), ['mv', R, r]]
+
+            if self.merge:
+                cmds += [self.merge_cmd(f, r, F, l), ['mv', F, f], ['rm', r]]
+
+            if self.primers:
+                cmds += [self.primers_cmd(f, F), ['mv', F, f]]
+
+            if self.demultiplex:
+                cmds += [self.demultiplex_cmd(f, F), ['mv', F, f]]
+            elif self.already_demultiplexed:
+                cmds += [self.reformat_cmd(f, F), ['mv', F, f]]
+
+        outputs = [self.fi[i]]
+        if self.merge:
+            outputs.append(self.li[i])
+
+        if self.scratch:
+            inputs = [self.fi[i]]
+            if self.reverse and (self.convert or self.merge):
+                inputs.append(self.ri[i])
+
+            copy_back = list(outputs)
+            if self.reverse and self.convert and not self.merge:
+                copy_back.append(self.ri[i])
+
+            # the merge used up the reverse reads
+            if self.merge:
+                after = [['rm', self.ri[i]]]
+            else:
+                after = []
+
+            if self.speculate > 0:
+                winner = '%s.won' %(self.fi[i])
+                stage_cmds = cmds
+
+                def copy(snapshots):
+                    sources = [(snapshots.get(fn, fn), fn) for fn in inputs]
+                    return [scheduler.scratch_command(stage_cmds, sources, copy_back, self.scratch_dir, winner)] + after
+
+                cmds = [scheduler.scratch_command(cmds, inputs, copy_back, self.scratch_dir, winner)] + after
+                return scheduler.Task('shard %d' %(i), cmds, deps=deps, outputs=outputs, stage='shard', inputs=inputs, winner=winner, copy=copy)
+
+            cmds = [scheduler.scratch_command(cmds, inputs, copy_back, self.scratch_dir)] + after
+
+        return scheduler.Task('shard %d' %(i), cmds, deps=deps, outputs=outputs, stage='shard')
+
+    def stream_shard_cmds(self, f, r, F, R, l):
+        '''
+        Commands that run a shard through the selected per-shard stages as a single
+        pipeline
+
+        f, r, F, R, l : strings
+            the shard's forward and reverse reads, their temporary files, and the merge log
+
+        returns : list of commands
+        '''
+
+        cmds = []
+        background = []
+
+        # commands piped one into the next. the first reads the forward shard, and
+        # later ones read the output of the one before.
+        pipeline = []
+
+        def forward_input():
+            if len(pipeline) == 0:
+                return f
+            else:
+                return '/dev/stdin'
+
+        if self.convert:
+            pipeline.append(self.convert_cmd(f, '-'))
+
+            if self.reverse and not self.merge:
+                # nothing downstream reads the reverse reads, so convert them on their own
+                cmds += [self.convert_cmd(r, R), ['mv', R, r]]
+
+        if self.merge:
+            forward, reverse = f, r
+            if len(pipeline) > 0:
+                forward = '%s.fifo' %(f)
+                background.append((pipeline, forward))
+                pipeline = []
+
+            if self.convert:
+                reverse = '%s.fifo' %(r)
+                background.append(([self.convert_cmd(r, '-')], reverse))
+
+            pipeline.append(self.merge_cmd(forward, reverse, '-', l))
+
+        if self.primers:
+            pipeline.append(self.primers_cmd(forward_input(), '-'))
+
+        if self.demultiplex:
+            pipeline.append(self.demultiplex_cmd(forward_input(), '-'))
+        elif self.already_demultiplexed:
+            pipeline.append(self.reformat_cmd(forward_input(), '-'))
+
+        cmds.append(scheduler.stream_command(pipeline, F, background))
+        cmds.append(['mv', F, f])
+
+        if self.merge:
+            cmds.append(['rm', r])
+
+        return cmds
+
+    def run_shard_graph(self):
+        '''Run the per-shard stages as a dependency graph rather than stage by stage'''
+        tasks = self.shard_tasks()
+
+        # check inputs and temporary files up front, since no one waits between stages
+        if self.split:
+            self.sub.check_for_nonempty([fn for fn in [self.forward, self.reverse] if fn])
+        else:
+            inputs = []
+            if self.forward:
+                inputs += self.fi
+            if self.reverse and (self.convert or self.merge):
+                inputs += self.ri
+            self.sub.check_for_nonempty(inputs)
+
+        tmps = []
+        for task in tasks:
+            for cmd in task.cmds:
+                if cmd[0] == 'mv' and cmd[1] not in tmps:
+                    tmps.append(cmd[1])
+        if self.merge:
+            tmps += self.li
+        if self.qfilter:
+            tmps.append('q.fst')
+        self.sub.check_for_collisions(tmps)
+
+        if self.detach and not self.dry_run:
+            self.sub.submit_graph(tasks)
+        else:
+            self.sub.execute_graph(tasks)
 
-            cmds.append(cmd)
-        self.sub.execute(cmds)
-        
-        cmd = ['python', '%s/combine_fasta.py' %(self.library), '--output', 'q.fst'] + self.Ci
-        #swo> I regret this hack; i need to [] the cmd
-        self.sub.execute([cmd])
-        self.sub.check_for_nonempty('q.fst')
-        self.sub.rm_files(self.Ci)
-    
     def dereplicate_reads(self):
         '''Concatenate files and dereplicate'''
 
@@ -503,27 +1571,19 @@ class OTU_Caller():
         
         self.sub.check_for_nonempty('q.index')
     
-    def denovo_clustering(rename=True):
-        '''Denovo clustering with USEARCH'''
-        cmds = []
-        for i in range(len(self.sids)):
-            sid = self.sids[i]
-            cmd = [self.usearch, '-cluster_otus', 'q.derep.fst', '-otus', self.oi[i], '-otuid', '.%d' %(sid)]
-            cmds.append(cmd)
-        self.sub.execute(cmds)
-        self.sub.check_for_nonempty(self.oi)
-        
-        # Rename OTUs
+    def denovo_clustering(self, rename=True):
+        '''Denovo clustering at all identities in one pass, making OTU fastas'''
+        self.sub.check_for_nonempty('q.derep.fst')
+        self.sub.check_for_collisions(self.oi)
+
+        cmd = ['python', '%s/cluster_otus.py' %(self.library), 'q.derep.fst', '--sids', ','.join([str(sid) for sid in self.sids]), '--prefix', 'otus']
+
+        # name OTUs OTU97_1, etc.
         if rename == True:
-            cmds = []
-            for i in range(len(self.sids)):
-                sid = self.sids[i]
-                cmd = ['python', '%s/usearch_python/fasta_number.py' %(self.library), self.oi[i], 'OTU%d_' %(sid), '>', self.Oi[i]]
-                cmds.append(cmd)
-            self.sub.execute(cmds)
-            self.sub.check_for_nonempty(self.Oi)
-            self.sub.move_files(self.Oi, self.oi)
-            self.sub.check_for_nonempty(self.oi)
+            cmd.append('--rename')
+
+        self.sub.execute([cmd])
+        self.sub.check_for_nonempty(self.oi)
     
     def dbotu_progressive_clustering(self):
        '''Denovo clustering with USEARCH'''
@@ -546,16 +1606,12 @@ class OTU_Caller():
        input_lists=",".join([str(x) for x in  uc_list])
        cmds.append(['perl', '%s/merge_progressive_clustering4.pl'% perllib, input_lists, 'unique.PC.final.list'])
 
-       self.sub.execute(cmds)
+       self.sub.execute(cmds, serial=True)
        self.sub.check_for_nonempty('unique.PC.final.list')       
  
     def remove_reference_chimeras(self):
         '''Remove chimeras using gold database'''
-        cmds = []
-        for i in range(len(self.sids)):
-            sid = self.sids[i]
-            cmd = [self.usearch, '-uchime_ref', self.oi[i], '-db', self.gold_db, '-nonchimeras', self.Oi[i], '-strand', 'plus']
-            cmds.append(cmd)
+        cmds = [reference_chimeras_cmd(self.usearch, self.oi[i], self.gold_db, self.Oi[i]) for i in range(len(self.sids))]
         self.sub.execute(cmds)
         
         self.sub.check_for_nonempty(self.Oi)
@@ -574,7 +1630,7 @@ class OTU_Caller():
         cmd = 'perl %s/filter_mat_from_fasta_SmileTrain.pl unique.dbOTU.mat unique.dbOTU.nonchimera.fasta > unique.dbOTU.nonchimera.mat' % perllib
         cmds.append(cmd)
 
-        self.sub.execute(cmds)
+        self.sub.execute(cmds, serial=True)
         self.sub.check_for_nonempty('unique.dbOTU.nonchimera.fasta')
     
     def remove_denovo_chimeras(self):
@@ -593,12 +1649,12 @@ class OTU_Caller():
 
         cmds = []
         for i in range(len(self.sids)):
-            cmd = [self.usearch, '-usearch_global', 'q.derep.fst', '-db', self.db[i], '-uc', self.uc[i], '-strand', 'both', '-id', '.%d' %(self.reference_map_sids[i])]
-
             if self.open_ref_gg:
-                cmd += '-notmatched', self.open_fst[i]
+                notmatched = self.open_fst[i]
+            else:
+                notmatched = None
 
-            cmds.append(cmd)
+            cmds.append(reference_map_cmd(self.usearch, 'q.derep.fst', self.db[i], self.uc[i], self.reference_map_sids[i], notmatched))
             
         self.sub.execute(cmds)
         self.sub.check_for_nonempty(self.uc)
@@ -619,7 +1675,7 @@ class OTU_Caller():
         cmds.append(['%s "#screen.seqs(fasta=unique.align, start=%d, minlength=%d)"' %(mothur, self.align_start, self.minlength)])
         cmds.append('perl %s/filter_mat_from_fasta.pl unique.f0.mat unique.good.align > unique.f0.good.mat' %(perllib))
 
-        self.sub.execute(cmds)
+        self.sub.execute(cmds, serial=True)
         self.sub.check_for_nonempty(['unique.good.align', 'unique.f0.good.mat'])
         
     def dbotu_call_otus(self):
@@ -639,7 +1695,7 @@ class OTU_Caller():
         cmds.append(dbcmd)
         cmds.append(['%s "#degap.seqs(fasta=unique.dbOTU.fasta)"' %(mothur)])
 
-        self.sub.execute(cmds)
+        self.sub.execute(cmds, serial=True)
 
         self.sub.check_for_nonempty(['unique.dbOTU.list', 'unique.dbOTU.ng.fasta', 'unique.dbOTU.mat', 'unique.dbOTU.log'])
     
@@ -689,104 +1745,19 @@ if __name__ == '__main__':
     # Initialize OTU caller
     oc = OTU_Caller()
 
-    # Check fastq format
-    if oc.check:
-        message('Checking input formats')
-        oc.check_format()
-    
-    # Split fastq
-    if oc.split:
-        message('Splitting fastq')
-        oc.split_fastq()
-        
-    if oc.convert:
-        message('Converting format')
-        oc.convert_format()
-
-    # Merge reads
-    if oc.merge:
-        message('Merging reads')
-        oc.merge_reads()
-    
-    # Remove primers
-    if oc.primers == True:
-        message('Removing primers')
-        oc.remove_primers()
-        
     # Set current reads
     # swo> obsolete, now that there are no separate merged files
     if hasattr(oc, 'fi'):
         oc.ci = oc.fi
-    
-    # Demultiplex
-    if oc.demultiplex == True:
-        message('Demultiplexing')
-        oc.demultiplex_reads()
-
-    if oc.already_demultiplexed == True:
-        message('Already demultiplexed: reformatting sequence headers')
-        oc.reformat_headers()
-    
-    # Quality filter
-    if oc.qfilter == True:
-        message('Quality filtering')
-        oc.quality_filter()
-    
-    # Dereplicate reads
-    if oc.dereplicate == True:
-        message('Dereplicating sequences')
-        oc.dereplicate_reads()
-        
-    # Make index file
-    if oc.index == True:
-        message('Indexing samples')
-        oc.make_index()
-    
-    # Denovo clustering
-    if oc.denovo == True:
-        message('Denovo clustering')
-        oc.denovo_clustering(rename = True)
-    
-    # Map to reference database
-    if oc.ref_gg or oc.open_ref_gg:
-        message('Mapping to reference')
-        oc.reference_mapping()
 
-    # Call dbOTUs
-    if oc.dbotu:
-        message("dbOTU: aligning sequences")
-        oc.dbotu_alignment()
+    if oc.detach:
+        # nothing can follow jobs we do not wait for
+        message('Submitting per-shard stages as a chain of dependent jobs')
+        oc.run_shard_graph()
+        message('Jobs submitted. Run later stages once they have finished.')
+        sys.exit(0)
 
-        if oc.dbotu_split:
-            message("dbOTU: progressive clustering")
-            oc.dbotu_progressive_clustering()
+    # Select the stages to run, in order: (name, message, method)
+    stages = [(stage, stage_steps[stage][0], getattr(oc, stage_steps[stage][1])) for stage in selected_stages(oc)]
 
-        message("Calling dbOTUs")
-        oc.dbotu_call_otus()
-
-    # Chimera removal
-    if oc.ref_chimeras:
-        message("Removing chimeras by reference")
-        oc.remove_reference_chimeras()
-
-    if oc.chimeras:
-        message("Removing chimeras de novo with uchime")
-        oc.remove_denovo_chimeras()
-
-    if oc.dbotu_chimeras:
-        message("Removing chimeras from dbOTUs de novo")
-        oc.dbotu_remove_chimeras()
-        
-    # Make sequence tables
-    if oc.seq_table:
-        message('Making sequence table')
-        oc.make_seq_table()
-        
-    if oc.seq_tax:
-        message('Assigning sequence table taxonomies')
-        oc.get_seq_tax()
-    
-    # Make OTU tables
-    if oc.otu_table == True:
-        message('Making OTU tables')
-        oc.make_otu_tables()
+    oc.run_stages(stages)
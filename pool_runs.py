@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+'''
+Pool the sequences of several runs into one fasta, so a reference database only has to
+be loaded once for all of them, and split the results back out by run.
+
+Each pooled label gets the number of its input as a prefix (e.g., >2|seq5;counts=3 for
+the third input), which the split removes. Searching a sequence against a reference
+does not depend on the other sequences being searched, so the split results are the
+same as searching each run on its own.
+'''
+
+import argparse, sys, os
+
+separator = '|'
+
+def pool_fasta_lines(fhs, out):
+    '''
+    Write the entries of several fastas to one, labels prefixed by input number
+
+    fhs : list of filehandles
+        input fastas
+    out : filehandle
+        pooled fasta
+    '''
+
+    for i, fh in enumerate(fhs):
+        for line in fh:
+            if line.startswith('>'):
+                out.write('>%d%s%s' %(i, separator, line[1:]))
+            else:
+                out.write(line)
+
+def unprefix(label):
+    '''
+    split a pooled label into its input number and original label
+
+    returns : tuple
+        (int, string)
+    '''
+
+    prefix, sep, label = label.partition(separator)
+    if sep == '' or not prefix.isdigit():
+        raise RuntimeError("label did not come from a pooled fasta: %s" %(label or prefix))
+
+    return int(prefix), label
+
+def split_fasta_lines(lines, outs):
+    '''
+    Send each entry of a pooled fasta to the output of its input, without its prefix
+
+    lines : iterator of strings
+        pooled fasta
+    outs : list of filehandles
+        one per pooled input
+    '''
+
+    out = None
+    for line in lines:
+        if line.startswith('>'):
+            i, label = unprefix(line[1:])
+            out = outs[i]
+            out.write('>' + label)
+        elif out is not None:
+            out.write(line)
+
+def split_uc_lines(lines, outs):
+    '''
+    Send each line of a .uc file of pooled queries to the output of its query's input,
+    without the prefix
+
+    lines : iterator of strings
+        tab-separated .uc lines, query label in the 9th field
+    outs : list of filehandles
+        one per pooled input
+    '''
+
+    for line in lines:
+        if line.startswith('#'):
+            continue
+
+        fields = line.split('\t')
+        i, fields[8] = unprefix(fields[8])
+        outs[i].write('\t'.join(fields))
+
+def split_into_files(split, pooled, outputs):
+    '''
+    Split a pooled file into new files, each of which appears all at once
+
+    split : function
+        split_fasta_lines or split_uc_lines
+    pooled : string
+        pooled filename
+    outputs : list of strings
+        output filenames, one per pooled input
+    '''
+
+    tmps = ['%s.tmp.%d' %(fn, os.getpid()) for fn in outputs]
+    outs = [open(fn, 'w') for fn in tmps]
+
+    try:
+        with open(pooled) as f:
+            split(f, outs)
+    finally:
+        for out in outs:
+            out.close()
+
+    for tmp, fn in zip(tmps, outputs):
+        os.rename(tmp, fn)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pool the sequences of several runs, or split pooled results back out', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+
+    pool_parser = subparsers.add_parser('pool', help='pool fastas')
+    pool_parser.add_argument('fasta', nargs='+', help='input fastas')
+    pool_parser.add_argument('--output', '-o', default=sys.stdout, type=argparse.FileType('w'), help='pooled fasta')
+
+    split_parser = subparsers.add_parser('split', help='split a pooled fasta or .uc')
+    split_parser.add_argument('pooled', help='pooled fasta or .uc')
+    split_parser.add_argument('outputs', nargs='+', help='output files, in the order their inputs were pooled')
+    split_parser.add_argument('--format', choices=['fasta', 'uc'], default='fasta', help='format of the pooled file')
+
+    args = parser.parse_args()
+
+    if args.command == 'pool':
+        fhs = [open(fn) for fn in args.fasta]
+        pool_fasta_lines(fhs, args.output)
+        for fh in fhs:
+            fh.close()
+    elif args.command == 'split':
+        if args.format == 'fasta':
+            split_into_files(split_fasta_lines, args.pooled, args.outputs)
+        else:
+            split_into_files(split_uc_lines, args.pooled, args.outputs)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+'''
+Quality filter fastq files and write the surviving reads into a single fasta file.
+
+Each read is
+    * truncated before its first base with quality <= truncqual
+    * truncated to trunclen (if trunclen > 0); reads shorter than trunclen are dropped
+    * dropped if its expected number of errors (the sum of the error probabilities of its
+      bases) is greater than maxee
+
+Reads are processed in batches. Quality characters are converted to error probabilities
+with the lookup tables in usearch_python.fastq, so the truncation positions and expected
+errors of every read in a batch are computed together. Batches can be filtered in several
+processes; an ordered writer puts the results back in input order, so the output is the
+same as filtering the inputs one after another.
+'''
+
+import sys, argparse, itertools, multiprocessing
+import numpy as np
+import util
+from usearch_python import fastq
+
+def filter_batch(entries, truncqual, maxee, trunclen=0):
+    '''
+    Quality filter a batch of fastq entries.
+
+    entries : list of (label, seq, qual)
+        fastq entries
+    truncqual : int
+        truncate reads before the first base with this quality or lower
+    maxee : float
+        maximum expected errors in the truncated read
+    trunclen : int (default 0)
+        truncate reads to this length, dropping shorter reads; 0 means no truncation
+
+    returns : tuple
+        (fasta string of the surviving reads, number of surviving reads)
+    '''
+
+    if len(entries) == 0:
+        return '', 0
+
+    quals, lengths = fastq.QualMatrix([qual for label, seq, qual in entries])
+
+    # truncate before the first low-quality base
+    lengths = fastq.TruncPosBatch(None, quals, truncqual, False, lengths)
+
+    if trunclen > 0:
+        keep = lengths >= trunclen
+        lengths = np.minimum(lengths, trunclen)
+    else:
+        keep = lengths > 0
+
+    # expected errors in each truncated read
+    keep &= fastq.GetEEBatch(quals, lengths) <= maxee
+
+    fasta = "".join([">%s\n%s\n" % (label, seq[:l]) for (label, seq, qual), l, k in zip(entries, lengths, keep) if k])
+    return fasta, int(keep.sum())
+
+def _filter_batch_star(args):
+    '''unpack arguments for filter_batch, keeping the batch number (for multiprocessing)'''
+    i, entries, truncqual, maxee, trunclen = args
+    return (i, len(entries)) + filter_batch(entries, truncqual, maxee, trunclen)
+
+
+class OrderedWriter():
+    '''write numbered chunks of output in order, holding chunks that arrive early'''
+    def __init__(self, out):
+        self.out = out
+        self.next_index = 0
+        self.pending = {}
+
+    def write(self, index, text):
+        '''write chunk number index, plus any held chunks that can now follow it'''
+        self.pending[index] = text
+        while self.next_index in self.pending:
+            self.out.write(self.pending.pop(self.next_index))
+            self.next_index += 1
+
+    def close(self):
+        '''make sure no chunks were missed'''
+        if len(self.pending) > 0:
+            raise RuntimeError("ordered writer is missing chunk %d" % self.next_index)
+
+
+def fastq_batches(fastqs, batch_size):
+    '''yield lists of (label, seq, qual) from the fastq filenames, in order'''
+    for fn in fastqs:
+        with open(fn) as f:
+            entries = util.fastq_entries(f)
+            while True:
+                batch = list(itertools.islice(entries, batch_size))
+                if len(batch) == 0:
+                    break
+
+                yield batch
+
+def filter_fastqs(fastqs, output, truncqual, maxee, trunclen=0, batch_size=10000, threads=1):
+    '''
+    Quality filter fastq files into one fasta.
+
+    fastqs : list of filenames
+        inputs, written to the output in this order
+    output : filehandle
+        output fasta
+    batch_size : int (default 10000)
+        number of reads filtered together
+    threads : int (default 1)
+        number of processes filtering batches
+
+    returns : tuple
+        (number of input reads, number of output reads)
+    '''
+
+    tasks = ((i, batch, truncqual, maxee, trunclen) for i, batch in enumerate(fastq_batches(fastqs, batch_size)))
+
+    if threads > 1:
+        pool = multiprocessing.Pool(threads)
+        results = pool.imap_unordered(_filter_batch_star, tasks)
+    else:
+        pool = None
+        results = itertools.imap(_filter_batch_star, tasks)
+
+    writer = OrderedWriter(output)
+    n_in = n_out = 0
+    for i, n_batch, fasta, n_kept in results:
+        writer.write(i, fasta)
+        n_in += n_batch
+        n_out += n_kept
+
+    writer.close()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    return n_in, n_out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quality filter fastq files into a single fasta', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('fastq', nargs='+', help='input fastq(s)')
+    parser.add_argument('--truncqual', type=int, default=2, help='truncate reads at first base with this quality or lower')
+    parser.add_argument('--maxee', type=float, default=2.0, help='maximum expected errors')
+    parser.add_argument('--trunclen', type=int, default=0, help='truncate reads to this length (0 for no truncation)')
+    parser.add_argument('--batch_size', type=int, default=10000, help='reads per batch')
+    parser.add_argument('--threads', '-t', type=int, default=1, help='number of processes')
+    parser.add_argument('--output', '-o', default=sys.stdout, type=argparse.FileType('w'), help='output fasta')
+    args = parser.parse_args()
+
+    n_in, n_out = filter_fastqs(args.fastq, args.output, args.truncqual, args.maxee, args.trunclen, args.batch_size, args.threads)
+    util.message("quality filter: kept %d of %d reads" % (n_out, n_in))
@@ -0,0 +1,127 @@
+'''
+Choose how many shards to split the reads into, and how much memory to ask for in each
+stage, from the size of the inputs.
+
+Read counts are estimated from file sizes and the average size of the first records.
+The fraction of unique sequences is estimated from the same sample. Small samples
+have fewer repeats than whole files, so this tends to overestimate the number of
+unique sequences, which errs on the side of asking for too much memory.
+'''
+
+import os, math, itertools
+
+# default target shard size, in megabytes
+default_shard_mb = 500
+
+# per-stage memory profiles: (base gb, bytes per read, bytes per unique sequence), with
+# the bytes per unique sequence on top of the length of the sequence itself. derep and
+# index keep a dictionary entry per unique sequence; clustering also keeps the kmers of
+# every centroid. streaming stages only hold a few reads at a time, so they have no
+# profile and get the cluster's default request.
+memory_profiles = {'dereplicate': (1.0, 0, 250), 'index': (1.0, 0, 300), 'denovo': (1.0, 0, 2000),
+    'seq_table': (1.0, 0, 400)}
+
+def sample_records(fn, n_records=1000):
+    '''
+    Sequences from the start of a fasta or fastq, and their average size in the file
+
+    fn : string
+        fasta or fastq filename
+    n_records : int (default 1000)
+        number of records to sample
+
+    returns : tuple
+        (list of sequences, average bytes per record), or ([], 0) for an empty file
+    '''
+
+    seqs = []
+    n_bytes = 0
+    with open(fn) as f:
+        first = f.read(1)
+        f.seek(0)
+
+        if first == '@':
+            # fastq: four lines per record
+            for lines in itertools.islice(itertools.izip(f, f, f, f), n_records):
+                seqs.append(lines[1].rstrip())
+                n_bytes += sum([len(line) for line in lines])
+        elif first == '>':
+            # fasta, assuming one sequence line per record, as the pipeline writes them
+            for lines in itertools.islice(itertools.izip(f, f), n_records):
+                seqs.append(lines[1].rstrip())
+                n_bytes += sum([len(line) for line in lines])
+
+    if len(seqs) == 0:
+        return [], 0
+
+    return seqs, float(n_bytes) / len(seqs)
+
+def estimate_reads(fns):
+    '''
+    Estimate the number of reads and unique sequences in some fasta/fastq files
+
+    returns : tuple
+        (number of reads, number of unique sequences, average sequence length)
+    '''
+
+    n_reads = 0.0
+    sample = []
+    for fn in fns:
+        seqs, bytes_per_record = sample_records(fn)
+        if bytes_per_record > 0:
+            n_reads += os.path.getsize(fn) / bytes_per_record
+            sample += seqs
+
+    if len(sample) == 0:
+        return 0, 0, 0
+
+    unique_fraction = float(len(set(sample))) / len(sample)
+    mean_length = float(sum([len(seq) for seq in sample])) / len(sample)
+    return int(n_reads), int(n_reads * unique_fraction), mean_length
+
+def auto_shard_count(fns, shard_mb=default_shard_mb, max_shards=1):
+    '''
+    Number of shards that keeps each shard near the target size, without more shards
+    than can run at once
+
+    fns : list of filenames
+        inputs to be split (e.g., forward and reverse fastq)
+    shard_mb : float
+        target shard size, in megabytes
+    max_shards : int
+        array slot limit (or number of local processes)
+
+    returns : int
+    '''
+
+    # forward and reverse files are split in parallel, so size by the biggest one
+    n_bytes = max([os.path.getsize(fn) for fn in fns] + [0])
+    n = int(math.ceil(n_bytes / (shard_mb * 1e6)))
+    return max(1, min(n, max_shards))
+
+def stage_memory_gb(stage, fns, n_commands=1, safety=1.5):
+    '''
+    Memory to request for each command of a stage
+
+    stage : string
+        stage name
+    fns : list of filenames
+        the stage's sequence inputs
+    n_commands : int (default 1)
+        number of commands the inputs are divided among (e.g., one per shard)
+    safety : float (default 1.5)
+        multiplier on the estimate
+
+    returns : int or None
+        gigabytes, rounded up, or None for stages without a profile
+    '''
+
+    if stage not in memory_profiles:
+        return None
+
+    base, per_read, per_unique = memory_profiles[stage]
+
+    n_reads, n_unique, mean_length = estimate_reads([fn for fn in fns if os.path.isfile(fn)])
+
+    n_bytes = (n_reads * per_read + n_unique * (per_unique + mean_length)) / float(n_commands)
+    return int(math.ceil((base + n_bytes / 1e9) * safety))
@@ -0,0 +1,295 @@
+'''
+Dependency graphs of pipeline tasks.
+
+A task is a short list of commands that run one after another (e.g., convert shard 3 and
+then move the result into place). Each task names the tasks it depends on, so a scheduler
+can start a task as soon as the tasks that make its inputs have finished, rather than
+waiting for every task in the previous stage to finish.
+'''
+
+import os, pipes
+
+def command_line(cmd):
+    '''command (list of words or a shell string) -> shell string'''
+    if type(cmd) is str:
+        return cmd
+    else:
+        return " ".join([str(x) for x in cmd])
+
+
+def stream_command(pipeline, output, background=None):
+    '''
+    Shell line that runs commands connected by pipes, so that their intermediate
+    results stay in memory rather than going through files.
+
+    A command that reads from two streams (e.g., merging forward and reverse reads)
+    can read one or both from named pipes (FIFOs), each fed by a background pipeline.
+    The line fails if any command in it fails. If the main pipeline fails, the
+    background pipelines are killed, since they could be stuck waiting for a reader.
+
+    pipeline : list of commands (lists of words or shell strings)
+        each command's output goes to the next one's input
+    output : string
+        file for the last command's output
+    background : list of (list of commands, fifo filename) (optional)
+        pipelines whose output goes into a FIFO
+
+    returns : string
+        bash command line
+    '''
+
+    background = background or []
+    fifos = " ".join([fifo for cmds, fifo in background])
+
+    lines = ['set -o pipefail', 'pids=']
+    if len(background) > 0:
+        lines.append('rm -f %s && mkfifo %s || exit 1' %(fifos, fifos))
+
+    for cmds, fifo in background:
+        lines.append('%s > %s & pids="$pids $!"' %(" | ".join([command_line(cmd) for cmd in cmds]), fifo))
+
+    lines.append('%s > %s' %(" | ".join([command_line(cmd) for cmd in pipeline]), output))
+    lines.append('status=$?')
+    lines.append('if [ $status -ne 0 ] && [ -n "$pids" ]; then kill $pids 2> /dev/null; fi')
+    lines.append('for pid in $pids; do wait $pid || status=1; done')
+
+    if len(background) > 0:
+        lines.append('rm -f %s' %(fifos))
+
+    lines.append('exit $status')
+    return "bash -c %s" %(pipes.quote("; ".join(lines)))
+
+
+# shell variable that names a task's scratch directory (see scratch_command)
+scratch_var = 'SMILETRAIN_SCRATCH'
+
+# exit status of a copy of a task that finished after another copy had claimed the
+# outputs (see scratch_command)
+lost_status = 75
+
+def scratch_fn(fn):
+    '''name of a file in a task's scratch directory, for use in its commands'''
+    return '$%s/%s' %(scratch_var, os.path.basename(fn))
+
+def scratch_command(cmds, inputs, outputs, scratch_dir, winner=None):
+    '''
+    Shell line that runs commands in a new directory in node-local scratch space.
+
+    The inputs are copied in first. The commands refer to files in the directory with
+    scratch_fn. If every command succeeds, the outputs are copied back, all to
+    temporary names beside their destinations, and only then renamed into place, with
+    outputs that replace an input renamed last. A partially copied output never
+    appears, and a failed copy leaves the inputs as they were, so the task can be rerun.
+    The directory is removed whether the commands succeed or fail.
+
+    If several copies of the line may run at once (see Speculator), only the first to
+    finish its commands copies back its outputs. It claims the right to by making the
+    winner directory, which only one copy can do; the others exit with lost_status.
+
+    cmds : list of commands (lists of words or shell strings)
+        run one after another
+    inputs : list of filenames or (source, filename) pairs
+        files to copy into scratch, optionally from another name (e.g., a snapshot)
+    outputs : list of filenames
+        files to copy back to these names
+    scratch_dir : string
+        directory to make the scratch directory in. It is expanded by the shell on the
+        node that runs the line, so it can be a variable (e.g., $TMPDIR).
+    winner : string (optional)
+        directory that marks that some copy has claimed the outputs
+
+    returns : string
+        bash command line
+    '''
+
+    lines = ['%s=$(mktemp -d "%s/SmileTrain.XXXXXX") || exit 1' %(scratch_var, scratch_dir),
+        'export %s' %(scratch_var),
+        'trap \'rm -rf "$%s"\' EXIT' %(scratch_var)]
+
+    for fn in inputs:
+        if isinstance(fn, tuple):
+            source, fn = fn
+        else:
+            source = fn
+
+        lines.append('cp %s %s || exit 1' %(source, scratch_fn(fn)))
+
+    lines.append('%s || exit $?' %(" && ".join([command_line(cmd) for cmd in cmds])))
+
+    if winner is not None:
+        lines.append('mkdir %s 2> /dev/null || exit %d' %(winner, lost_status))
+
+    tmps = dict([(fn, '%s.tmp.$$' %(fn)) for fn in outputs])
+    for fn in outputs:
+        lines.append('cp %s %s || { rm -f %s; exit 1; }' %(scratch_fn(fn), tmps[fn], " ".join(tmps.values())))
+
+    in_place = [fn[1] if isinstance(fn, tuple) else fn for fn in inputs]
+    for fn in sorted(outputs, key=lambda fn: fn in in_place):
+        lines.append('mv -f %s %s || exit 1' %(tmps[fn], fn))
+
+    return "bash -c %s" %(pipes.quote("; ".join(lines)))
+
+
+class Task():
+    def __init__(self, name, cmds, deps=None, outputs=None, stage=None, inputs=None, winner=None, copy=None):
+        '''
+        name : string
+            unique name for the task
+        cmds : list of commands (each a list of words or a shell string)
+            run one after another; later commands only run if earlier ones succeed
+        deps : list of Tasks (default none)
+            tasks that must finish before this one starts
+        outputs : list of filenames (default none)
+            files that should be non-empty once the task is done
+        stage : string (default None)
+            name of the pipeline stage the task belongs to (e.g., 'convert')
+        inputs : list of filenames (default none)
+            files the task reads and may replace, which a copy of the task should read
+            from snapshots
+        winner : string (default None)
+            directory that the first copy of the task to finish makes to claim its outputs
+        copy : function (default None)
+            takes a dictionary from the inputs to snapshots of them and returns the
+            commands for a duplicate of the task. Tasks without one are never copied.
+        '''
+
+        self.name = name
+        self.cmds = cmds
+        self.deps = list(deps or [])
+        self.outputs = list(outputs or [])
+        self.stage = stage
+        self.inputs = list(inputs or [])
+        self.winner = winner
+        self.copy = copy
+
+    def __repr__(self):
+        return "Task(%s)" % self.name
+
+    def command_line(self):
+        '''all the commands as a single shell line'''
+        return " && ".join([command_line(cmd) for cmd in self.cmds])
+
+
+class TaskGraph():
+    '''tracks which tasks in a dependency graph are waiting, running, or finished'''
+    def __init__(self, tasks):
+        '''
+        tasks : list of Tasks
+            every task's dependencies must also be in the list
+        '''
+
+        self.tasks = list(tasks)
+
+        names = [task.name for task in self.tasks]
+        if len(set(names)) != len(names):
+            raise RuntimeError("task names are not unique")
+
+        for task in self.tasks:
+            for dep in task.deps:
+                if dep not in self.tasks:
+                    raise RuntimeError("task %s depends on %s, which is not in the graph" %(task.name, dep.name))
+
+        self.started = set()
+        self.finished = set()
+
+        # fail now if there is a cycle
+        self.order()
+
+    def order(self):
+        '''tasks in an order that respects dependencies'''
+        ordered = []
+        placed = set()
+        remaining = list(self.tasks)
+        while len(remaining) > 0:
+            ready = [task for task in remaining if all([dep in placed for dep in task.deps])]
+            if len(ready) == 0:
+                raise RuntimeError("dependency cycle among tasks: %s" % " ".join([task.name for task in remaining]))
+
+            for task in ready:
+                ordered.append(task)
+                placed.add(task)
+                remaining.remove(task)
+
+        return ordered
+
+    def ready(self):
+        '''tasks that have not started and whose dependencies are finished'''
+        return [task for task in self.tasks if task not in self.started and all([dep in self.finished for dep in task.deps])]
+
+    def start(self, task):
+        self.started.add(task)
+
+    def finish(self, task):
+        self.finished.add(task)
+
+    def done(self):
+        '''have all the tasks finished?'''
+        return len(self.finished) == len(self.tasks)
+
+
+class Speculator():
+    '''
+    Spots stragglers: running tasks that have taken much longer than the tasks of the
+    same stage that already finished. A straggler is usually on a slow or busy node,
+    so a copy of it started elsewhere can finish first.
+    '''
+
+    def __init__(self, multiple=2.0, min_finished=2):
+        '''
+        multiple : float (default 2.0)
+            a task is a straggler once it has run this many times the median time of
+            its stage's finished tasks
+        min_finished : int (default 2)
+            number of the stage's tasks that must have finished before comparing
+        '''
+
+        self.multiple = multiple
+        self.min_finished = min_finished
+
+        # stage -> run times of its finished tasks
+        self.times = {}
+
+        # tasks already copied
+        self.copied = set()
+
+    def finished(self, task, seconds):
+        self.times.setdefault(task.stage, []).append(seconds)
+
+    def median(self, stage):
+        times = sorted(self.times.get(stage, []))
+        n = len(times)
+        if n == 0:
+            return None
+        elif n % 2 == 1:
+            return times[n // 2]
+        else:
+            return 0.5 * (times[n // 2 - 1] + times[n // 2])
+
+    def stragglers(self, elapsed, n=None):
+        '''
+        Running tasks that should be copied now, slowest first. Each task is only
+        returned once.
+
+        elapsed : dict
+            running task -> seconds it has been running (None if it has not started)
+        n : int (optional)
+            most tasks to return (e.g., the number of free slots)
+
+        returns : list of Tasks
+        '''
+
+        slow = []
+        for task, seconds in elapsed.items():
+            if task.copy is None or task in self.copied or seconds is None:
+                continue
+
+            if len(self.times.get(task.stage, [])) < self.min_finished:
+                continue
+
+            if seconds > self.multiple * self.median(task.stage):
+                slow.append((seconds, task))
+
+        slow.sort(key=lambda x: -x[0])
+        tasks = [task for seconds, task in slow][:n]
+        self.copied.update(tasks)
+        return tasks
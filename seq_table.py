@@ -58,7 +58,8 @@ class SeqTableWriter:
         names : dict
             {seq => name}
         assert_same : bool
-            if true, make sure each seq in the fasta is in names
+            if true, make sure each seq in the fasta is in names; otherwise, sequences
+            not in names (e.g., dropped by dereplication) are not counted
             
         returns : dict of dicts
             {name => {samples => counts}, ...}
@@ -66,15 +67,18 @@ class SeqTableWriter:
     
         table = {}
         abund = {}
+        n_skipped = 0
         for record in SeqIO.parse(fasta, 'fasta'):
             sample = util_index.sid_to_sample(record.id)
             seq = str(record.seq)
 
             if seq in names:
                 name = names[seq]
+            elif assert_same:
+                raise RuntimeError("sequence %s found in fasta but not dereplicated fasta" %(seq))
             else:
-                if assert_same:
-                    raise RuntimeError("sequence %s found in fasta but not dereplicated fasta" %(seq))
+                n_skipped += 1
+                continue
 
             if name in abund:
                 abund[name] += 1
@@ -88,6 +92,9 @@ class SeqTableWriter:
                     table[name][sample] = 1
             else:
                 table[name] = {sample: 1}
+
+        if n_skipped > 0:
+            util.message("seq_table: skipped %d reads whose sequences are not in the dereplicated fasta" %(n_skipped))
                 
         return table, abund
 
@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 
-import argparse, os, re, select, stat, subprocess, sys, tempfile, time, re, time, itertools
+import argparse, os, re, select, stat, subprocess, sys, tempfile, time, re, time, itertools, StringIO, heapq, pipes, getpass
 import xml.etree.ElementTree as ET
 from util import *
+import local_cluster
 
 '''
 ssub is a simple job submission script
@@ -28,11 +29,49 @@ to create and run pipelines:
 
 '''
 
+class CountingReader():
+    '''a filehandle that counts the non-whitespace characters read from it'''
+    def __init__(self, fh):
+        self.fh = fh
+        self.n_read = 0
+
+    def read(self, size=-1):
+        data = self.fh.read(size)
+        self.n_read += len(data.strip())
+        return data
+
+def xml_elements(qstat_output, tag):
+    '''
+    Stream the elements with some tag out of qstat's xml, clearing each one after use so
+    that memory does not grow with the size of the cluster's queue
+
+    qstat_output : string or filehandle
+        xml from qstat (possibly empty, if there are no jobs)
+    tag : string
+        element tag to yield (e.g., 'Job')
+
+    yields : Elements
+    '''
+
+    if isinstance(qstat_output, basestring):
+        qstat_output = StringIO.StringIO(qstat_output)
+
+    reader = CountingReader(qstat_output)
+    try:
+        for event, elem in ET.iterparse(reader):
+            if elem.tag == tag:
+                yield elem
+                elem.clear()
+    except ET.ParseError:
+        # no jobs means no xml at all, but xml that was cut off is an error
+        if reader.n_read > 0:
+            raise
+
 def coyote_parse(qstat_output, my_username):
     '''
-    Parse output from qstat -x, looking for the jobs that have the user as owner
+    Parse output from qstat -x, looking for the unfinished jobs that have the user as owner
 
-    qstat_output : string
+    qstat_output : string or filehandle
         output from qstat -x
     my_username : string
         kerberos username
@@ -40,18 +79,18 @@ def coyote_parse(qstat_output, my_username):
     Returns : list of job IDs, each a string of integers with an optional []
     '''
 
-    root = ET.fromstring(qstat_output)
     job_ids = []
-    for child in root:
+    for job in xml_elements(qstat_output, 'Job'):
         # raw username contains whoever@wiley.coyote.etc.etc
         # get just the part that precedes the @
-        raw_username = child.find('Job_Owner').text
+        raw_username = job.findtext('Job_Owner')
         username = re.match('(.+)@', raw_username).group(1)
 
-        if username == my_username:
+        # completed jobs can stay in the listing for a while
+        if username == my_username and job.findtext('job_state') != 'C':
             # job id contains 12345.wiley.coyote.etc.etc
             # we want just the integers at the beginning
-            raw_job_id = child.find('Job_Id').text
+            raw_job_id = job.findtext('Job_Id')
             job_id = re.match('\d+(\[\])?', raw_job_id).group()
             job_ids.append(job_id)
 
@@ -59,25 +98,268 @@ def coyote_parse(qstat_output, my_username):
 
 def zcluster_parse(qstat_output, my_username):
     '''parse output from `qstat -xml`'''
-    root = ET.fromstring(qstat_output)
     job_ids = []
 
-    # root should have two children, either queue_info or job_info
-    for qinfo_or_jinfo in root:
-        # those children should have elements job_list
-        for job_list in qinfo_or_jinfo:
-            # job_list node should contain owner and job number info
-            username = job_list.find('JB_owner').text
+    # job_list elements, under queue_info or job_info, contain owner and job number info
+    for job_list in xml_elements(qstat_output, 'job_list'):
+        username = job_list.findtext('JB_owner')
 
-            if username == my_username:
-                job_id = job_list.find('JB_job_number').text
-                job_ids.append(job_id)
+        if username == my_username:
+            job_id = job_list.findtext('JB_job_number')
+            job_ids.append(job_id)
 
     return job_ids
 
 
+# relative cost per input byte of the programs in the pipeline; others count as 1
+cost_weights = {'usearch': 10.0, 'cluster_otus.py': 10.0, 'merge_pairs.py': 2.0, 'remove_primers.py': 1.5,
+    'map_barcodes.py': 1.5, 'quality_filter.py': 1.0, 'convert_fastq.py': 0.5, 'split_fastq.py': 0.5}
+
+# programs that run the next word (a script) as the program
+interpreters = ['python', 'python2', 'python3', 'perl', 'sh', 'bash', 'Rscript']
+shell_separators = ['&&', '||', '|', ';']
+
+def split_command(command):
+    '''
+    Split a shell line into the programs it runs and the arguments it gives them.
+    Interpreters, the scripts they run, and telemetry.py (with its record directory and
+    stage label) count as programs; the command that telemetry.py measures is split too.
+
+    command : string
+        shell line
+
+    Returns : (list of strings, list of strings)
+        program words, argument words
+    '''
+
+    programs = []
+    arguments = []
+    start = True
+    skip = 0
+    for raw_word in command.split():
+        # strip shell punctuation, e.g. from commands wrapped in parentheses or quotes
+        word = raw_word.strip('()\'";')
+
+        if raw_word in shell_separators:
+            start = True
+        elif skip > 0:
+            skip -= 1
+        elif word == '':
+            pass
+        elif start:
+            programs.append(word)
+            name = os.path.basename(word)
+            if name == 'telemetry.py':
+                # record directory and stage label, then the measured command
+                skip = 2
+            elif name not in interpreters and not word.startswith('-'):
+                start = False
+        else:
+            arguments.append(word)
+
+        if raw_word.endswith(';'):
+            start = True
+
+    return programs, arguments
+
+def command_cost(command, weights=cost_weights):
+    '''
+    Estimate how much work a command is: the total size of the existing files given
+    as arguments, times a weight for the program it runs
+
+    command : string
+        shell line
+    weights : dict
+        program (basename, e.g. 'merge_pairs.py' or 'usearch') -> weight
+
+    Returns : float
+    '''
+
+    programs, arguments = split_command(command)
+
+    weight = 1.0
+    for word in programs:
+        name = os.path.basename(word)
+        if name in weights:
+            weight = weights[name]
+            break
+
+    n_bytes = sum([os.path.getsize(word) for word in arguments if os.path.isfile(word)])
+    return weight * (1 + n_bytes)
+
+def pack_lpt(costs, n_bins):
+    '''
+    Longest-processing-time-first packing: take items from most to least costly,
+    putting each in the bin with the least total cost so far. Each bin keeps its items
+    in their original order, since later commands may read what earlier ones wrote.
+
+    costs : list of floats
+    n_bins : int
+
+    Returns : list of lists of ints
+        indices of the items in each bin, in increasing order
+    '''
+
+    bins = [[] for i in range(n_bins)]
+    heap = [(0.0, i) for i in range(n_bins)]
+
+    for item in sorted(range(len(costs)), key=lambda i: -costs[i]):
+        load, b = heapq.heappop(heap)
+        bins[b].append(item)
+        heapq.heappush(heap, (load + costs[item], b))
+
+    for items in bins:
+        items.sort()
+
+    return bins
+
+
+class JobMonitor():
+    '''
+    Watch many groups of jobs (e.g., several job arrays) with one status query per poll.
+    The time between polls grows while nothing finishes and drops back when something does.
+    '''
+
+    def __init__(self, ssub, min_interval=2.0, max_interval=60.0, factor=1.5, sleep=time.sleep, fail_fast=True):
+        '''
+        ssub : Ssub
+            used to query the status of the jobs
+        fail_fast : bool (default True)
+            cancel a group's arrays as soon as one of their tasks fails? if not, the
+            group is done once every task has finished
+        min_interval, max_interval : float
+            bounds on the seconds between polls
+        factor : float
+            how much the interval grows after a poll where nothing finished
+        '''
+
+        self.ssub = ssub
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.interval = min_interval
+        self.sleep = sleep
+        self.fail_fast = fail_fast
+        self.groups = {}
+
+        # key -> list of (job id, task, exit status) for groups stopped by a failed task
+        self.failures = {}
+
+    def add(self, key, job_ids):
+        '''start watching a group of jobs, referred to as key'''
+        self.groups[key] = list(job_ids)
+        self.interval = self.min_interval
+
+    def remove(self, key):
+        '''cancel a group's jobs and stop watching them, if they are still being watched'''
+        if key in self.groups:
+            self.ssub.cancel(self.groups.pop(key))
+
+    def check_arrays(self, key):
+        '''
+        Look at the exit status files of a group's arrays
+
+        Returns : bool
+            is the group done, either because every task finished or because a task
+            failed (in which case, with fail_fast, the group's arrays are cancelled)?
+        '''
+
+        job_ids = self.groups[key]
+        arrays = getattr(self.ssub, 'arrays', {})
+        if not all([job_id in arrays for job_id in job_ids]):
+            return False
+
+        complete = True
+        failed = []
+        for job_id in job_ids:
+            statuses = self.ssub.task_statuses(job_id)
+            failed += [(job_id, task, status) for task, (status, start, end) in sorted(statuses.items()) if status != 0]
+            complete = complete and len(statuses) == arrays[job_id][1]
+
+        if len(failed) > 0 and (self.fail_fast or complete):
+            if self.fail_fast:
+                self.ssub.cancel(job_ids)
+            self.failures[key] = failed
+            message(self.failure_report(key), indent=6)
+            return True
+
+        return complete
+
+    def failure_report(self, key):
+        '''the failed tasks of a group, with the end of their stderr'''
+        lines = []
+        for job_id, task, status in self.failures[key]:
+            lines.append("job %s task %d failed with exit status %d" %(job_id, task, status))
+            lines.append(self.ssub.task_stderr(job_id, task).rstrip())
+
+        return "\n".join(lines)
+
+    def poll(self):
+        '''
+        check on the jobs once, first with our arrays' exit status files and then with
+        a status query for whatever is left
+
+        returns : list
+            keys of the groups whose jobs have all finished (and are no longer watched)
+        '''
+
+        done = [key for key in self.groups.keys() if self.check_arrays(key)]
+        for key in done:
+            del self.groups[key]
+
+        if len(self.groups) == 0:
+            return done
+
+        job_ids = [job_id for job_ids in self.groups.values() for job_id in job_ids]
+
+        try:
+            running = set(self.ssub.running_jobs(job_ids))
+        except RuntimeError as e:
+            # a failed query says nothing about the jobs; try again next time
+            message('job status query failed: %s' %(e), indent=6)
+            return done
+
+        finished = [key for key, job_ids in self.groups.items() if not any([job_id in running for job_id in job_ids])]
+        for key in finished:
+            del self.groups[key]
+
+        return done + finished
+
+    def wait_any(self, timeout=None):
+        '''
+        wait until at least one group finishes, returning the keys of the finished
+        groups. With a timeout, give up (returning nothing) after the first poll that
+        ends at least that many seconds after the wait started.
+        '''
+
+        waited = 0.0
+        while len(self.groups) > 0:
+            self.sleep(self.interval)
+            waited += self.interval
+            finished = self.poll()
+
+            if len(finished) > 0:
+                self.interval = self.min_interval
+                return finished
+            else:
+                self.interval = min(self.interval * self.factor, self.max_interval)
+
+            if timeout is not None and waited >= timeout:
+                break
+
+        return []
+
+    def wait_all(self):
+        '''wait until every group is finished'''
+        while len(self.groups) > 0:
+            self.wait_any()
+
+
+# default job array slot limit
+default_slot_limit = 200
+
 class Ssub():
-    def __init__(self, username, cluster, queue, tmp_dir, bashrc, n_cpus=1, header='#!/bin/bash', l=200, m=4, group='', io=''):
+    def __init__(self, username, cluster, queue, tmp_dir, bashrc, n_cpus=1, header='#!/bin/bash', l=default_slot_limit, m=4, group='', io='', packing='round_robin'):
         # initialize cluster parameters
         self.cluster = cluster
         self.username = username
@@ -93,14 +375,23 @@ class Ssub():
         self.G = group  # broad specific?
         self.io = io    # broad specific?
 
+        # how commands are spread over job scripts: 'round_robin' or 'lpt'
+        if packing not in ['round_robin', 'lpt']:
+            raise RuntimeError("unrecognized packing %s" %(packing))
+        self.packing = packing
+
         self.bashrc = bashrc
         self.source_line = 'source %s\n' % self.bashrc
+
+        # job id -> (array script, number of tasks) for the arrays we submit
+        self.arrays = {}
         
         # broad parameters
         if self.cluster == 'broad':
             raise RuntimeError("broad may not be supported")
             # swo> stat_cmd should be a list of words passed to terminal
             self.submit_cmd = 'bsub'
+            self.cancel_cmd = 'bkill'
             self.stat_cmd = 'bjobs -w'
             self.parse_job = lambda x: re.search('Job <(\d+)>', x).group(1)
             # swo> should parse the status!
@@ -109,6 +400,8 @@ class Ssub():
         # coyote parameters
         elif self.cluster == 'coyote':
             self.submit_cmd = 'qsub'
+            self.cancel_cmd = 'qdel'
+            # job ids are added to the query, so only our jobs are listed
             self.stat_cmd = ['qstat', '-x']
             # parse: match a string of integers then either [] or nothing
             self.parse_job = lambda x: re.match('\d+(\[\])?', x).group()
@@ -116,9 +409,22 @@ class Ssub():
 
         elif self.cluster == 'zcluster':
             self.submit_cmd = 'qsub' 
-            self.stat_cmd = ['qstat', '-xml']
+            self.cancel_cmd = 'qdel'
+            # SGE lists jobs by user rather than by job id
+            self.stat_cmd = ['qstat', '-xml', '-u', username]
             self.parse_job = lambda x: re.match('(\d+)\.', x.split()[2]).group(1)
             self.parse_status = lambda x: zcluster_parse(x, username)
+
+        elif self.cluster == 'local':
+            # a stand-in for a PBS cluster that runs jobs on this machine (see
+            # local_cluster.py). its server must be running in tmp_dir/local_cluster.
+            self.local_cluster = local_cluster.LocalCluster(os.path.join(tmp_dir, 'local_cluster'))
+            qsub, qstat, qdel = self.local_cluster.commands()
+            self.submit_cmd = " ".join([pipes.quote(word) for word in qsub])
+            self.cancel_cmd = qdel
+            self.stat_cmd = qstat
+            self.parse_job = lambda x: re.match('\d+(\[\])?', x).group()
+            self.parse_status = lambda x: coyote_parse(x, getpass.getuser())
         
         else:
             raise RuntimeError('unrecognized cluster %s' %(cluster))
@@ -139,9 +445,47 @@ class Ssub():
         fh.write(self.header)
         return fh, fn
     
-    def job_status(self):
+    def stat_args(self, job_ids=None):
+        '''words of the status command, asking only about job_ids where the cluster allows it'''
+        if job_ids and self.cluster in ['coyote', 'local']:
+            return self.stat_cmd + list(job_ids)
+        else:
+            return self.stat_cmd
+
+    def job_status(self, job_ids=None):
         '''call the command specified by the words in stat_cmd'''
-        return subprocess.check_output(self.stat_cmd)
+        return subprocess.check_output(self.stat_args(job_ids))
+
+    def running_jobs(self, job_ids=None):
+        '''
+        Query the cluster for unfinished jobs, parsing the xml as it streams in
+
+        job_ids : list of strings (default all of ours)
+            jobs to ask about
+
+        Returns : list of strings
+            ids of the jobs that are still queued or running
+        '''
+
+        process = subprocess.Popen(self.stat_args(job_ids), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            running = self.parse_status(process.stdout)
+        except ET.ParseError as e:
+            process.communicate()
+            raise RuntimeError("could not parse the status command's output: %s" %(e))
+
+        out, err = process.communicate()
+
+        # asking about jobs that already left the queue is an error for qstat, but it
+        # still lists the others. any other failure (including one with no complaint,
+        # e.g., if qstat was killed) means the query itself failed.
+        if process.returncode != 0:
+            lines = [line for line in err.splitlines() if line.strip()]
+            problems = [line for line in lines if 'Unknown Job' not in line]
+            if len(problems) > 0 or len(lines) == 0:
+                raise RuntimeError("status command failed with exit status %d: %s" %(process.returncode, " ".join(problems)))
+
+        return running
     
     def jobs_finished(self, job_ids):
         '''
@@ -154,27 +498,36 @@ class Ssub():
             were any of the ids found in the job status output?
         '''
 
-        status = self.job_status()
-        running_jobs = self.parse_status(status)
-
-        for job in running_jobs:
+        for job in self.running_jobs(job_ids):
             if job in job_ids:
                 return False
             
         message('jobs completed\ttime: %s' % time.strftime("%d %b %H:%M", time.localtime()), indent=6)
         return True
-    
+
     def write_jobs(self, commands):
-        '''write job scripts from a list of commands'''
+        '''
+        write job scripts from a list of commands. with 'lpt' packing, commands are
+        assigned to scripts by estimated cost, so that the scripts finish at about the
+        same time; otherwise they are dealt out in turn. every command in a script is
+        run, and the script fails if any of them did.
+        '''
         
         # initialize output files
-        fhs, fns = zip(*[self.mktemp(suffix='.sh') for i in range(min(self.n_cpus, len(commands)))])
-        fhs_cycle = itertools.cycle(fhs)
+        n_jobs = min(self.n_cpus, len(commands))
+        fhs, fns = zip(*[self.mktemp(suffix='.sh') for i in range(n_jobs)])
+
+        if self.packing == 'lpt':
+            bins = pack_lpt([command_cost(command) for command in commands], n_jobs)
+        else:
+            bins = [range(i, len(commands), n_jobs) for i in range(n_jobs)]
         
         # write commands to file
-        for command in commands:
-            fh = fhs_cycle.next()
-            fh.write('%s\n' %(command))
+        for fh, items in zip(fhs, bins):
+            fh.write('status=0\n')
+            for i in items:
+                fh.write('{ %s\n} || status=$?\n' %(commands[i]))
+            fh.write('exit $status\n')
         
         # close all filehandles
         for fh in fhs:
@@ -187,14 +540,47 @@ class Ssub():
         
         return fns
     
-    def submit_jobs(self, fns):
-        '''submit jobs to the cluster'''
+    def dependency_flag(self, job_ids):
+        '''
+        Option that makes the scheduler hold a job until other jobs have finished
+
+        job_ids : list of strings
+            ids of the (array) jobs to wait for
+
+        Returns : string
+            qsub/bsub option, with a trailing space, or '' if there are no job ids
+        '''
+
+        if not job_ids:
+            return ''
+
+        if self.cluster == 'broad':
+            return '-w "%s" ' %(" && ".join(['done(%s)' %(job_id) for job_id in job_ids]))
+        elif self.cluster in ['coyote', 'local']:
+            # only start if every task of the arrays succeeded
+            return '-W depend=afterokarray:%s ' %(":".join(job_ids))
+        elif self.cluster == 'zcluster':
+            # SGE only holds until the jobs finish, whether they succeeded or not
+            return '-hold_jid %s ' %(",".join(job_ids))
+
+    def submit_jobs(self, fns, depends_on=None):
+        '''
+        submit jobs to the cluster
+
+        fns : list of filenames
+            job scripts
+        depends_on : list of strings (default none)
+            ids of jobs that must finish before these jobs start
+        '''
+
+        dependency = self.dependency_flag(depends_on)
+
         job_ids = []
         for fn in fns:
             if self.cluster == 'broad':
-                process = subprocess.Popen(['%s < %s' %(self.submit_cmd, fn)], stdout = subprocess.PIPE, shell=True)
-            elif self.cluster in ['coyote', 'zcluster']:
-                process = subprocess.Popen(['%s %s' %(self.submit_cmd, fn)], stdout = subprocess.PIPE, shell=True)
+                process = subprocess.Popen(['%s %s< %s' %(self.submit_cmd, dependency, fn)], stdout = subprocess.PIPE, shell=True)
+            elif self.cluster in ['coyote', 'zcluster', 'local']:
+                process = subprocess.Popen(['%s %s%s' %(self.submit_cmd, dependency, fn)], stdout = subprocess.PIPE, shell=True)
             else:
                 raise RuntimeError("trying to submitting job on unsupported cluster")
 
@@ -210,8 +596,90 @@ class Ssub():
             message('job ID: %s\ttime: %s' %(job_id, time.strftime("%d %b %H:%M", time.localtime())), indent=6)
         return job_ids
     
-    def write_LSF_array(self, fns):
-        '''write an LSF job array from args and filenames'''
+    def status_fn(self, array_fn, task):
+        '''sidecar file with a task's exit status, start time, and end time'''
+        return '%s.status.%s' %(array_fn, task)
+
+    def stderr_fn(self, array_fn, task):
+        '''sidecar file with a task's stderr'''
+        return '%s.err.%s' %(array_fn, task)
+
+    def started_fn(self, array_fn, task):
+        '''sidecar file with a task's start time, written when it starts'''
+        return '%s.started.%s' %(array_fn, task)
+
+    def write_task_runner(self, fh, array_fn, index_var):
+        '''
+        write the end of an array script, which runs this task's job and records its
+        exit status and timing in a sidecar file (written then renamed, so it appears
+        all at once). the task's stderr goes to its own sidecar file.
+
+        index_var : string
+            environment variable with the task number (e.g., PBS_ARRAYID)
+        '''
+
+        fh.write('task=$%s\n' %(index_var))
+        fh.write('start=$(date +%s)\n')
+        fh.write('echo $start > %s\n' %(self.started_fn(array_fn, '$task')))
+        fh.write('${job_array[$task]} 2> %s\n' %(self.stderr_fn(array_fn, '$task')))
+        fh.write('status=$?\n')
+        status_fn = self.status_fn(array_fn, '$task')
+        fh.write('echo "$status $start $(date +%%s)" > %s.tmp && mv %s.tmp %s\n' %(status_fn, status_fn, status_fn))
+        fh.write('exit $status\n')
+
+    def task_statuses(self, job_id):
+        '''
+        Exit status and timing of the finished tasks of an array we submitted
+
+        Returns : dict
+            task number -> (exit status, start time, end time), in seconds since the epoch
+        '''
+
+        array_fn, n_tasks = self.arrays[job_id]
+        statuses = {}
+        for task in range(1, n_tasks + 1):
+            fn = self.status_fn(array_fn, task)
+            if os.path.isfile(fn):
+                with open(fn) as f:
+                    fields = f.read().split()
+
+                if len(fields) == 3:
+                    statuses[task] = tuple([int(x) for x in fields])
+
+        return statuses
+
+    def task_started(self, job_id, task=1):
+        '''start time (seconds since the epoch) of an array task, or None if it has not started'''
+        array_fn, n_tasks = self.arrays[job_id]
+        fn = self.started_fn(array_fn, task)
+        if not os.path.isfile(fn):
+            return None
+
+        with open(fn) as f:
+            fields = f.read().split()
+
+        if len(fields) == 1:
+            return int(fields[0])
+        else:
+            return None
+
+    def task_stderr(self, job_id, task, n_lines=20):
+        '''last lines of an array task's stderr'''
+        array_fn, n_tasks = self.arrays[job_id]
+        fn = self.stderr_fn(array_fn, task)
+        if not os.path.isfile(fn):
+            return ''
+
+        with open(fn) as f:
+            return "".join(f.readlines()[-n_lines:])
+
+    def cancel(self, job_ids):
+        '''remove jobs (whole arrays) from the queue'''
+        subprocess.call(listify(self.cancel_cmd) + list(job_ids))
+        message('cancelled job(s) %s' %(" ".join(job_ids)), indent=6)
+
+    def write_LSF_array(self, fns, memory=None):
+        '''write an LSF job array from args and filenames, with memory in gb (default m)'''
         
         # initialize output file
         fh, array_fn = self.mktemp(suffix='.sh')
@@ -223,7 +691,7 @@ class Ssub():
         fh.write('#BSUB -o %s.o.%%I\n' %(array_fn))
         fh.write('#BSUB -q %s\n' %(self.q))
         fh.write('#BSUB -G %s\n' %(self.G))
-        fh.write('#BSUB -R "rusage[mem=%s:argon_io=%s]"\n' %(self.m, self.io))
+        fh.write('#BSUB -R "rusage[mem=%s:argon_io=%s]"\n' %(memory or self.m, self.io))
         fh.write('#BSUB -P %s\n' %(array_fn))
         fh.write('source %s\n' % self.bashrc)
         fh.write('cd $LS_SUBCWD\n')
@@ -232,7 +700,7 @@ class Ssub():
         for i, fn in enumerate(fns):
             os.chmod(fn, stat.S_IRWXU)
             fh.write('job_array[%d]=%s\n' %(i+1, os.path.abspath(fn)))
-        fh.write('${job_array[$LSB_JOBINDEX]};\n')
+        self.write_task_runner(fh, array_fn, 'LSB_JOBINDEX')
         fh.close()
         
         # make executable and print message
@@ -240,8 +708,8 @@ class Ssub():
         message('Writing array %s' %(array_fn))
         return array_fn
     
-    def write_PBS_array(self, fns):
-        '''write a PBS job array from args and filenames'''
+    def write_PBS_array(self, fns, memory=None):
+        '''write a PBS job array from args and filenames, requesting memory (gb) if given'''
         
         # initialize output file
         fh, array_fn = self.mktemp(suffix='.sh')
@@ -251,6 +719,8 @@ class Ssub():
         fh.write('#PBS -t 1-%d%%%s\n' %(len(fns), min(len(fns), int(self.l))))
         fh.write('#PBS -e %s.e\n' %(array_fn))
         fh.write('#PBS -q %s\n' %(self.q))
+        if memory:
+            fh.write('#PBS -l mem=%dgb\n' %(memory))
         fh.write('#PBS -o %s.o\n' %(array_fn))
         fh.write('source %s\n' % self.bashrc)
         fh.write('cd $PBS_O_WORKDIR\n')
@@ -259,7 +729,7 @@ class Ssub():
         for i, fn in enumerate(fns):
             os.chmod(fn, stat.S_IRWXU)
             fh.write('job_array[%d]=%s\n' %(i+1, os.path.abspath(fn)))
-        fh.write('${job_array[$PBS_ARRAYID]};\n')
+        self.write_task_runner(fh, array_fn, 'PBS_ARRAYID')
         fh.close()
         
         # make executable and print message
@@ -268,8 +738,8 @@ class Ssub():
         return array_fn
    
 
-    def write_SGE_array(self, fns):
-        '''write an SGE job array from args and filenames'''
+    def write_SGE_array(self, fns, memory=None):
+        '''write an SGE job array from args and filenames, requesting memory (gb) if given'''
 
         # initialize output file
         fh, array_fn = self.mktemp(suffix='.sh')
@@ -279,6 +749,8 @@ class Ssub():
         fh.write('#$ -t 1-%d%s\n' %(len(fns), min(len(fns), int(self.l))))
         fh.write('#$ -e %s.e\n' %(array_fn))
         fh.write('#$ -q %s\n' %(self.q))
+        if memory:
+            fh.write('#$ -l h_vmem=%dG\n' %(memory))
         fh.write('#$ -o %s.o\n' %(array_fn))
         fh.write('source %s\n' % self.bashrc)
         fh.write('cd $SGE_O_WORKDIR\n')
@@ -287,7 +759,7 @@ class Ssub():
         for i, fn in enumerate(fns):
             os.chmod(fn, stat.S_IRWXU)
             fh.write('job_array[%d]=%s\n' %(i+1, os.path.abspath(fn)))
-        fh.write('${job_array[$SGE_TASK_ID]};\n')
+        self.write_task_runner(fh, array_fn, 'SGE_TASK_ID')
         fh.close()
 
         # make executable and print message
@@ -298,39 +770,77 @@ class Ssub():
 
 
  
-    def write_job_array(self, fns):
+    def write_job_array(self, fns, memory=None):
         '''write a job array (LSF or PBS)'''
         if self.cluster == 'broad':
-            array_fn = self.write_LSF_array(fns)
+            array_fn = self.write_LSF_array(fns, memory)
         elif self.cluster == 'zcluster':
-	    array_fn = self.write_SGE_array(fns)
-        elif self.cluster == 'coyote':
-            array_fn = self.write_PBS_array(fns)
+	    array_fn = self.write_SGE_array(fns, memory)
+        elif self.cluster in ['coyote', 'local']:
+            array_fn = self.write_PBS_array(fns, memory)
         return array_fn
     
-    def submit(self, commands):
-        '''submit a job array to the cluster'''
+    def submit(self, commands, depends_on=None, memory=None):
+        '''
+        submit a job array to the cluster, optionally held until other jobs finish and
+        with a memory request (gb) for each job
+        '''
         fns = self.write_jobs(commands)
-        array_fn = self.write_job_array(fns)
-        job_ids = self.submit_jobs([array_fn])
+        array_fn = self.write_job_array(fns, memory)
+        job_ids = self.submit_jobs([array_fn], depends_on)
+
+        for job_id in job_ids:
+            self.arrays[job_id] = (array_fn, len(fns))
+
         return job_ids
     
-    def wait(self, job_ids):
-        '''wait for jobs to finish'''
-        while True:
-            time.sleep(5)
-            if self.jobs_finished(job_ids):
-                break 
+    def wait(self, job_ids, fail_fast=True):
+        '''
+        wait for jobs to finish
+
+        fail_fast : bool (default True)
+            if a task of one of our arrays fails, raise an error (after the monitor has
+            cancelled the rest of the array)
+        '''
+
+        monitor = JobMonitor(self, fail_fast=fail_fast)
+        monitor.add('jobs', job_ids)
+        monitor.wait_all()
+
+        if fail_fast and 'jobs' in monitor.failures:
+            raise RuntimeError("array task(s) failed:\n%s" %(monitor.failure_report('jobs')))
+
+        message('jobs completed\ttime: %s' % time.strftime("%d %b %H:%M", time.localtime()), indent=6)
     
-    def submit_and_wait(self, commands):
+    def submit_and_wait(self, commands, fail_fast=True, memory=None):
         '''submit job array and wait for it to finish'''
-        job_ids = self.submit(commands)
-        self.wait(job_ids)
+        job_ids = self.submit(commands, memory=memory)
+        self.wait(job_ids, fail_fast)
     
-    def submit_pipeline(self, pipeline):
-        '''a pipeline is a list of lists of commands'''
+    def submit_pipeline(self, pipeline, wait=True):
+        '''
+        Submit every stage of a pipeline at once, each stage held by the scheduler until
+        the stage before it has finished
+
+        pipeline : list of lists of commands
+            stages, in order
+        wait : bool (default True)
+            wait for the last stage to finish? if not, return right after submitting
+
+        Returns : list of lists of strings
+            job ids of each stage
+        '''
+
+        stage_job_ids = []
+        previous = None
         for commands in pipeline:
-            self.submit_and_wait(commands)
+            previous = self.submit(commands, depends_on=previous)
+            stage_job_ids.append(previous)
+
+        if wait:
+            self.wait([job_id for job_ids in stage_job_ids for job_id in job_ids])
+
+        return stage_job_ids
     
 
 if __name__ == '__main__':
@@ -345,13 +855,22 @@ if __name__ == '__main__':
     parser.add_argument('-m', type=int, default=4, help='memory (gb)')
     parser.add_argument('-l', type=int, default=200, help='job array slot limit')
     parser.add_argument('--io', type=int, default=1, help='disk io (units)')
+    parser.add_argument('--packing', choices=['round_robin', 'lpt'], default='round_robin', help='how to spread commands over jobs: in turn, or longest (by input size) first')
+    parser.add_argument('--pipeline', action='store_true', help='commands are stages separated by blank lines; submit them all at once, chained by dependencies')
     parser.add_argument('commands', nargs='?', type=argparse.FileType('r'), default='-')
 
     # convert the arguments to a dictionary
     args = parser.parse_args()
     argdict = vars(args)
-    commands = [line for line in argdict.pop('commands')]
+    pipeline = argdict.pop('pipeline')
+    commands = [line.rstrip('\n') for line in argdict.pop('commands')]
 
     # create the ssub object with the command line arguments. submit the commands!
     s = Ssub(**argdict)
-    s.submit(commands)
+
+    if pipeline:
+        stages = [list(group) for blank, group in itertools.groupby(commands, lambda line: line.strip() == '') if not blank]
+        for job_ids in s.submit_pipeline(stages, wait=False):
+            print " ".join(job_ids)
+    else:
+        s.submit([command for command in commands if command.strip() != ''])
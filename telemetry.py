@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+'''
+Measure the resources used by each pipeline command.
+
+Commands are wrapped so that they run under this script, which records wall time, cpu
+time, peak resident memory, and bytes read and written, and writes them as a small json
+record into a shared directory. This works the same on a cluster node as on the local
+machine. A Recorder gathers the records when the run finishes, writes them all to a
+metrics file, and summarizes them by stage.
+
+Cpu time and peak memory are those of the process that ran the command alone, from
+wait4, so that a long-lived process (e.g., a worker) does not report the peak of
+everything it has run before. The byte counts come from /proc/self/io, which includes
+the counts of waited-for children; they are left out where there is no /proc (e.g., OS X).
+'''
+
+import os, sys, time, json, socket, subprocess, tempfile, shutil, pipes, glob, argparse
+
+# the fields of /proc/<pid>/io that are recorded: characters read and written through
+# system calls, and bytes that actually went to or came from storage
+io_fields = ['rchar', 'wchar', 'read_bytes', 'write_bytes']
+
+script_fn = os.path.abspath(__file__).replace('.pyc', '.py')
+
+def proc_io(pid='self'):
+    '''
+    I/O counters of a process
+
+    returns : dict or None
+        values of io_fields, or None if /proc is unavailable
+    '''
+
+    try:
+        with open('/proc/%s/io' %(pid)) as f:
+            counts = dict([line.split(':') for line in f if ':' in line])
+    except IOError:
+        return None
+
+    return dict([(field, int(counts[field])) for field in io_fields if field in counts])
+
+def usage(rusage):
+    '''
+    resources used by a process
+
+    rusage : resource.struct_rusage
+        e.g., from getrusage or wait4
+
+    returns : tuple
+        (user seconds, system seconds, peak resident memory in MB)
+    '''
+
+    if sys.platform == 'darwin':
+        # bytes
+        rss_scale = 1e6
+    else:
+        # kilobytes
+        rss_scale = 1e3
+
+    return rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss / rss_scale
+
+def wait_for(pid):
+    '''
+    Wait for a child process to finish
+
+    returns : tuple
+        (exit status, resource.struct_rusage of that child and its own waited-for children)
+    '''
+
+    pid, status, rusage = os.wait4(pid, 0)
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status), rusage
+    else:
+        return os.WEXITSTATUS(status), rusage
+
+def run_shell(cmd):
+    '''
+    Run a shell command and wait for it
+
+    returns : tuple
+        (exit status, resource.struct_rusage of the shell)
+    '''
+
+    proc = subprocess.Popen(cmd, shell=True)
+    status, rusage = wait_for(proc.pid)
+
+    # wait4 has already reaped the shell, so the Popen should not look for it
+    proc.returncode = status
+    return status, rusage
+
+def measure(cmd, run=None):
+    '''
+    Run a command and measure what it used
+
+    cmd : string
+        shell command
+    run : function (optional)
+        function that runs the command in a child process, waits for it, and returns
+        its exit status and resource usage (see wait_for). By default, the command is
+        run in a shell.
+
+    returns : dict
+        exit status, wall and cpu seconds, peak memory (MB), and I/O counts
+    '''
+
+    if run is None:
+        run = lambda: run_shell(cmd)
+
+    io_before = proc_io()
+    start = time.time()
+    status, rusage = run()
+    wall = time.time() - start
+    io_after = proc_io()
+    user, system, max_rss = usage(rusage)
+
+    record = {'command': cmd, 'status': status, 'host': socket.gethostname(), 'start': start,
+        'wall': wall, 'user': user, 'sys': system, 'max_rss_mb': max_rss}
+
+    for field in io_fields:
+        if io_before is None or io_after is None:
+            record[field] = None
+        else:
+            record[field] = io_after[field] - io_before[field]
+
+    return record
+
+def write_record(record, record_dir):
+    '''write a record to a unique file in the directory, appearing all at once'''
+    fn = os.path.join(record_dir, '%s.%d.%d.json' %(socket.gethostname(), os.getpid(), int(record['start'] * 1e6)))
+    with open(fn + '.tmp', 'w') as f:
+        json.dump(record, f)
+
+    os.rename(fn + '.tmp', fn)
+
+
+class Recorder():
+    '''wraps commands for measurement and gathers the measurements'''
+
+    def __init__(self, record_dir=None):
+        '''
+        record_dir : string (optional)
+            directory for the records of individual commands. It must be visible to
+            every node that runs commands. By default, a new directory under the
+            current one.
+        '''
+
+        if record_dir is None:
+            record_dir = tempfile.mkdtemp(prefix='.SmileTrain.telemetry.', dir=os.getcwd())
+
+        self.record_dir = record_dir
+        self.records = []
+
+        # (stage, elapsed seconds) in the order the stages ran
+        self.stage_times = []
+
+    def wrap(self, cmd, stage=None):
+        '''
+        shell line that runs a command under this script
+
+        cmd : string
+            shell command
+        stage : string (optional)
+            label for the summary
+
+        returns : string
+        '''
+
+        return "python %s %s %s %s" %(script_fn, self.record_dir, pipes.quote(stage or 'other'), pipes.quote(cmd))
+
+    def time_stage(self, stage, elapsed):
+        self.stage_times.append((stage, elapsed))
+
+    def collect(self):
+        '''read and remove any new records, adding them to this object's records'''
+        fns = sorted(glob.glob(os.path.join(self.record_dir, '*.json')))
+        for fn in fns:
+            with open(fn) as f:
+                self.records.append(json.load(f))
+
+            os.remove(fn)
+
+        self.records.sort(key=lambda record: record['start'])
+
+    def write(self, fn):
+        '''write all the records to a json file'''
+        self.collect()
+        with open(fn, 'w') as f:
+            json.dump({'stages': [{'stage': stage, 'elapsed': elapsed} for stage, elapsed in self.stage_times],
+                'commands': self.records}, f, indent=2)
+
+    def cleanup(self):
+        shutil.rmtree(self.record_dir, ignore_errors=True)
+
+    def summary(self):
+        '''
+        table of the resources used by each stage's commands
+
+        returns : string
+        '''
+
+        self.collect()
+
+        # stages in the order they ran, then any commands run outside of a stage
+        stages = [stage for stage, elapsed in self.stage_times]
+        stages += sorted(set([record['stage'] for record in self.records if record['stage'] not in stages]))
+        elapsed = dict(self.stage_times)
+
+        header = ['stage', 'commands', 'elapsed s', 'command s', 'cpu s', 'max rss MB', 'read MB', 'written MB']
+        rows = [header]
+        for stage in stages:
+            records = [record for record in self.records if record['stage'] == stage]
+
+            if len(records) > 0 and records[0]['rchar'] is not None:
+                read = "%.1f" %(sum([record['rchar'] for record in records]) / 1e6)
+                written = "%.1f" %(sum([record['wchar'] for record in records]) / 1e6)
+            else:
+                read = written = '-'
+
+            if len(records) > 0:
+                max_rss = "%.1f" %(max([record['max_rss_mb'] for record in records]))
+            else:
+                max_rss = '-'
+
+            rows.append([stage, str(len(records)),
+                "%.1f" %(elapsed[stage]) if stage in elapsed else '-',
+                "%.1f" %(sum([record['wall'] for record in records])),
+                "%.1f" %(sum([record['user'] + record['sys'] for record in records])),
+                max_rss, read, written])
+
+        widths = [max([len(row[i]) for row in rows]) for i in range(len(header))]
+        lines = ["  ".join([row[0].ljust(widths[0])] + [x.rjust(w) for x, w in zip(row[1:], widths[1:])]) for row in rows]
+        return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a shell command and record the resources it used', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('record_dir', help='directory for the json record')
+    parser.add_argument('stage', help='stage label')
+    parser.add_argument('command', help='shell command')
+    args = parser.parse_args()
+
+    record = measure(args.command)
+    record['stage'] = args.stage
+
+    # a record that cannot be written should not fail the command
+    try:
+        write_record(record, args.record_dir)
+    except (IOError, OSError) as e:
+        sys.stderr.write("telemetry: could not write record: %s\n" %(e))
+
+    # wait_for already reports a command killed by a signal the way the shell does
+    sys.exit(record['status'])
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+'''
+unit tests for batch.py
+'''
+
+import unittest, argparse
+from SmileTrain import batch, scheduler
+
+stage_flags = ['check', 'dag', 'split', 'convert', 'merge', 'primers', 'demultiplex', 'already_demultiplexed',
+    'qfilter', 'dereplicate', 'index', 'denovo', 'ref_gg', 'open_ref_gg', 'dbotu', 'dbotu_split', 'ref_chimeras',
+    'chimeras', 'dbotu_chimeras', 'seq_table', 'seq_tax', 'otu_table', 'redo', 'detach', 'local', 'dry_run']
+
+def fake_parse(options):
+    '''parsed options with just the stage flags that are given'''
+    args = dict([(flag, False) for flag in stage_flags])
+    args.update({'only': None, 'sids': [97], 'gold_db': 'gold.fasta'})
+    args.update([(option.lstrip('-'), True) for option in options])
+    return argparse.Namespace(**args)
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        lines = ['# runs', '', 'a --dereplicate --ref_gg --otu_table', 'b --dereplicate --ref_gg --seq_table --seq_tax',
+            'c --dereplicate --denovo --ref_gg --seq_tax']
+        self.runs = batch.read_manifest(lines, '/data', parse=fake_parse)
+        self.batch = batch.Batch(self.runs, '/work', '/lib', 'usearch', '/gg')
+        self.tasks = dict([(task.name, task) for task in self.batch.tasks()])
+
+    def test_manifest(self):
+        self.assertEqual([run.name for run in self.runs], ['a', 'b', 'c'])
+        self.assertEqual(self.runs[0].dir, '/data/a')
+        self.assertEqual(self.runs[1].stages, ['dereplicate', 'ref_gg', 'seq_table', 'seq_tax'])
+
+    def test_graph(self):
+        '''shared stages should wait for the runs that take part, and the runs for them'''
+        self.assertEqual(sorted(self.tasks.keys()), ['a: dereplicate', 'a: otu_table', 'b: dereplicate',
+            'b: seq_table', 'c: dereplicate,denovo,ref_gg', 'ref_gg 97', 'seq_tax'])
+
+        deps = dict([(name, sorted([dep.name for dep in task.deps])) for name, task in self.tasks.items()])
+        self.assertEqual(deps['ref_gg 97'], ['a: dereplicate', 'b: dereplicate'])
+        self.assertEqual(deps['a: otu_table'], ['ref_gg 97'])
+        self.assertEqual(deps['seq_tax'], ['b: seq_table', 'c: dereplicate,denovo,ref_gg'])
+
+        # no cycles
+        scheduler.TaskGraph(self.tasks.values()).order()
+
+    def test_commands(self):
+        '''a shared search should pool its runs and split the results back'''
+        cmds = [scheduler.command_line(cmd) for cmd in self.tasks['ref_gg 97'].cmds]
+        self.assertEqual(cmds, ['python /lib/pool_runs.py pool /data/a/q.derep.fst /data/b/q.derep.fst --output /work/ref_gg.97.fst',
+            'usearch -usearch_global /work/ref_gg.97.fst -db /gg/97_otus.fasta -uc /work/ref_gg.97.uc -strand both -id .98',
+            'python /lib/pool_runs.py split /work/ref_gg.97.uc /data/a/otus.97.uc /data/b/otus.97.uc --format uc'])
+        self.assertEqual(self.tasks['ref_gg 97'].outputs, ['/data/a/otus.97.uc', '/data/b/otus.97.uc'])
+
+        self.assertEqual(self.tasks['a: otu_table'].command_line(), 'cd /data/a && python /lib/otu_caller.py --dereplicate --ref_gg --otu_table --only otu_table --local')
+
+    def test_same_directory(self):
+        self.assertRaises(RuntimeError, batch.read_manifest, ['a --ref_gg', 'a --seq_tax'], parse=fake_parse)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+'''
+unit tests for cluster_otus.py
+'''
+
+from SmileTrain.test import fake_fh
+import unittest, tempfile, shutil, os
+from Bio import SeqIO
+from SmileTrain import cluster_otus, uc2otus
+
+
+class TestKmers(unittest.TestCase):
+    def test_correct(self):
+        self.assertEqual(cluster_otus.kmers('ACGTA', 3), set(['ACG', 'CGT', 'GTA']))
+
+
+class TestLabelAbundance(unittest.TestCase):
+    def test_correct(self):
+        self.assertEqual(cluster_otus.label_abundance('seq0;counts=400'), 400)
+        self.assertEqual(cluster_otus.label_abundance('seq0;size=12;'), 12)
+
+    def test_raise(self):
+        self.assertRaises(RuntimeError, cluster_otus.label_abundance, 'seq0')
+
+
+class TestGreedyClusterer(unittest.TestCase):
+    def setUp(self):
+        # seq1 is 1 difference (95%) from seq0; seq2 is unrelated
+        base = 'ACGTTGCAAGCTTAGCCGTA'
+        near = 'ACGTTGCAAGCTTAGCCGTT'
+        far = 'TTTTGGGGCCCCAAAATTTT'
+        fasta = fake_fh(['>seq1;counts=5', near, '>seq0;counts=10', base, '>seq2;counts=2', far])
+
+        self.clusterer = cluster_otus.GreedyClusterer([90, 99], k=4)
+        self.clusterer.cluster(SeqIO.parse(fasta, 'fasta'))
+
+    def test_loose_identity(self):
+        '''abundant sequence should absorb the near one at 90%'''
+        self.assertEqual([otu for otu, seq in self.clusterer.centroids[90]], ['OTU90_1', 'OTU90_2'])
+        otus = [hit[3] for hit in self.clusterer.hits[90]]
+        self.assertEqual(otus, ['OTU90_1', 'OTU90_1', 'OTU90_2'])
+
+    def test_strict_identity(self):
+        '''every sequence should be its own OTU at 99%'''
+        self.assertEqual(len(self.clusterer.centroids[99]), 3)
+
+    def test_uc_lines(self):
+        '''uc output should parse into the sequence-to-OTU mapping'''
+        sid_otu = uc2otus.parse_uc_lines(self.clusterer.uc_lines(90))
+        self.assertEqual(sid_otu, {'seq0': 'OTU90_1', 'seq1': 'OTU90_1', 'seq2': 'OTU90_2'})
+
+    def test_write(self):
+        '''uc files should only be written if asked for'''
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            prefix = os.path.join(tmp_dir, 'otus')
+            self.clusterer.write(prefix, uc=False)
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ['otus.90.fst', 'otus.99.fst'])
+            self.clusterer.write(prefix)
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ['otus.90.fst', 'otus.90.uc', 'otus.99.fst', 'otus.99.uc'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+'''
+unit tests for local_cluster.py
+'''
+
+import unittest, tempfile, os, shutil, time
+from SmileTrain import ssub, local_cluster
+
+
+class TestLocalCluster(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ssub = ssub.Ssub('me', 'local', 'speedy', self.tmp_dir, '/dev/null', n_cpus=4)
+        self.cluster = self.ssub.local_cluster
+        self.out = os.path.join(self.tmp_dir, 'out')
+
+    def tearDown(self):
+        self.cluster.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def spans(self, job_ids):
+        '''(start, end) of each finished task of some arrays'''
+        return [(start, end) for job_id in job_ids for status, start, end in self.ssub.task_statuses(job_id).values()]
+
+    def test_array(self):
+        '''tasks should run, record their status, and be seen as finished'''
+        self.cluster.start()
+        job_ids = self.ssub.submit(['echo a >> %s' % self.out, 'echo b >> %s' % self.out])
+        self.assertEqual(job_ids, ['1[]'])
+        self.ssub.wait(job_ids)
+
+        with open(self.out) as f:
+            self.assertEqual(sorted(f.read().split()), ['a', 'b'])
+        self.assertEqual(sorted(self.ssub.task_statuses(job_ids[0]).keys()), [1, 2])
+        self.assertEqual(self.ssub.running_jobs(job_ids), [])
+
+    def test_dependency(self):
+        '''a held array should start after the arrays it depends on, and not at all if one failed'''
+        self.cluster.start()
+        first = self.ssub.submit(['sleep 0.5'])
+        second = self.ssub.submit(['echo b > %s' % self.out], depends_on=first)
+        failed = self.ssub.submit(['exit 1'])
+        never = self.ssub.submit(['echo c > %s' % self.out], depends_on=failed)
+        self.ssub.wait(second + never, fail_fast=False)
+
+        (first_start, first_end), = self.spans(first)
+        (second_start, second_end), = self.spans(second)
+        self.assertTrue(second_start >= first_end)
+        self.assertEqual(self.spans(never), [])
+
+        with open(self.out) as f:
+            self.assertEqual(f.read(), 'b\n')
+
+    def test_slots(self):
+        '''no more tasks should run at once than there are slots'''
+        self.cluster.start(slots=2)
+        job_ids = self.ssub.submit(['sleep 0.3'] * 4)
+        self.ssub.wait(job_ids)
+
+        spans = self.spans(job_ids)
+        self.assertEqual(len(spans), 4)
+        for start, end in spans:
+            overlapping = [x for x in spans if x[0] < end and x[1] > start]
+            self.assertTrue(len(overlapping) <= 2)
+
+    def test_latency(self):
+        '''jobs should wait in the queue, where qstat shows them'''
+        self.cluster.start(latency=0.5)
+        start = time.time()
+        job_ids = self.ssub.submit(['true'])
+        self.assertEqual(self.ssub.running_jobs(job_ids), job_ids)
+        self.ssub.wait(job_ids)
+        self.assertTrue(time.time() - start >= 0.5)
+
+    def test_lost(self):
+        '''a lost task should leave no status, but its array should still finish'''
+        self.cluster.start(fail_tasks=[(1, 2)])
+        self.ssub.n_cpus = 2
+        job_ids = self.ssub.submit(['true', 'true'])
+        self.ssub.wait(job_ids)
+        self.assertEqual(sorted(self.ssub.task_statuses(job_ids[0]).keys()), [1])
+
+    def test_cancel(self):
+        self.cluster.start()
+        job_ids = self.ssub.submit(['sleep 30'])
+        self.ssub.cancel(job_ids)
+        self.ssub.wait(job_ids)
+        self.assertEqual(self.ssub.task_statuses(job_ids[0]), {})
+
+    def test_no_server(self):
+        self.assertRaises(RuntimeError, self.ssub.submit, ['true'])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
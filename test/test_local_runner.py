@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+'''
+unit tests for local_runner.py
+'''
+
+from SmileTrain.test import fake_fh
+import unittest, time, tempfile, os, shutil
+from SmileTrain import local_runner, otu_caller
+
+
+class TestRun(unittest.TestCase):
+    def test_correct(self):
+        '''should run commands and prefix their output'''
+        out = fake_fh()
+        runner = local_runner.LocalRunner(2, out=out)
+        statuses = runner.run([['echo', 'hello'], 'echo world'])
+
+        self.assertEqual(statuses, [0, 0])
+        lines = out.getvalue().split("\n")
+        self.assertIn('[0] hello', lines)
+        self.assertIn('[1] world', lines)
+
+    def test_parallel(self):
+        '''commands should run at the same time'''
+        runner = local_runner.LocalRunner(3, out=fake_fh())
+        start = time.time()
+        runner.run(['sleep 0.5'] * 3)
+        self.assertTrue(time.time() - start < 1.2)
+
+    def test_fail_fast(self):
+        '''a failure should cancel running commands and skip waiting ones'''
+        runner = local_runner.LocalRunner(2, out=fake_fh())
+        start = time.time()
+        statuses = runner.run(['sleep 10', 'exit 3', 'echo never'])
+
+        self.assertEqual(statuses, [None, 3, None])
+        self.assertTrue(time.time() - start < 5)
+
+    def test_report(self):
+        report = local_runner.status_report(['a', 'b', 'c'], [0, 3, None])
+        self.assertEqual(report, 'exit status 3: b\ncancelled: c')
+
+
+class TestSubmitterLocal(unittest.TestCase):
+    def test_raise(self):
+        sub = otu_caller.Submitter(method='local')
+        sub.runner.out = fake_fh()
+        self.assertEqual(sub.execute([['true'], 'true']), [0, 0])
+        self.assertRaises(RuntimeError, sub.execute, [['false']])
+
+    def test_retry(self):
+        '''should rerun only the command that failed'''
+        tmp_dir = tempfile.mkdtemp()
+        log = os.path.join(tmp_dir, 'log')
+        flag = os.path.join(tmp_dir, 'flag')
+        flaky = 'echo b >> %s; test -e %s || (touch %s; exit 1)' %(log, flag, flag)
+
+        sub = otu_caller.Submitter(method='local', retries=1)
+        sub.runner.out = fake_fh()
+        self.assertEqual(sub.execute(['echo a >> %s' % log, flaky]), [0, 0])
+
+        with open(log) as f:
+            self.assertEqual(sorted(f.read().split()), ['a', 'b', 'b'])
+
+        # the marker directory should be cleaned up
+        self.assertEqual([fn for fn in os.listdir('.') if fn.startswith('.SmileTrain.done')], [])
+        shutil.rmtree(tmp_dir)
+
+    def test_serial(self):
+        '''each command in a chain should see the output of the one before it'''
+        tmp_dir = tempfile.mkdtemp()
+        a, b = [os.path.join(tmp_dir, x) for x in ['a', 'b']]
+
+        sub = otu_caller.Submitter(method='local', n_cpus=2)
+        sub.runner.out = fake_fh()
+        self.assertEqual(sub.execute(['sleep 0.2; echo x > %s' % a, ['cp', a, b]], serial=True), [0, 0])
+
+        with open(b) as f:
+            self.assertEqual(f.read(), 'x\n')
+        shutil.rmtree(tmp_dir)
+
+    def test_retry_fail(self):
+        sub = otu_caller.Submitter(method='local', retries=1)
+        sub.runner.out = fake_fh()
+        self.assertRaisesRegexp(RuntimeError, 'exit status 1: false', sub.execute, ['false'])
+        self.assertEqual([fn for fn in os.listdir('.') if fn.startswith('.SmileTrain.done')], [])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
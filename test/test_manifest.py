@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+'''
+unit tests for manifest.py
+'''
+
+import unittest, tempfile, os, shutil
+from SmileTrain import manifest
+
+
+class TestManifest(unittest.TestCase):
+    '''a pipeline of split (raw -> shard), trim (shard -> shard, in place), and filter (shard -> out)'''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.raw, self.shard, self.out = [os.path.join(self.tmp_dir, x) for x in ['raw', 'shard', 'out']]
+        self.m = manifest.Manifest(os.path.join(self.tmp_dir, 'manifest.json'))
+        self.stages = [('split', {}), ('trim', {'diffs': 1}), ('filter', {})]
+
+        self.write(self.raw, 'ACGTACGT')
+        self.fake_stage('split', [self.raw], [self.shard], 'ACGTACGT')
+        self.fake_stage('trim', [self.shard], [self.shard], 'ACGT', {'diffs': 1})
+        self.fake_stage('filter', [self.shard], [self.out], 'ACGT')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, fn, content):
+        with open(fn, 'w') as f:
+            f.write(content)
+
+    def fake_stage(self, stage, inputs, outputs, content, params={}):
+        '''fake a stage that writes content to its outputs'''
+        sigs = self.m.signatures(inputs)
+        for fn in outputs:
+            self.write(fn, content)
+        self.m.record(stage, sigs, outputs, params)
+
+    def test_all_current(self):
+        '''in-place stages should not make earlier stages look stale'''
+        self.assertEqual(self.m.up_to_date(self.stages), 3)
+
+    def test_reload(self):
+        '''records should survive a reload from disk'''
+        m = manifest.Manifest(self.m.fn)
+        self.assertEqual(m.up_to_date(self.stages), 3)
+
+    def test_params(self):
+        stages = [('split', {}), ('trim', {'diffs': 1}), ('filter', {'maxee': 1})]
+        self.assertEqual(self.m.up_to_date(stages), 2)
+
+    def test_params_in_place(self):
+        '''redoing an in-place stage means redoing the stage that made its input'''
+        stages = [('split', {}), ('trim', {'diffs': 2}), ('filter', {})]
+        self.assertEqual(self.m.up_to_date(stages), 0)
+
+    def test_missing_output(self):
+        os.remove(self.out)
+        self.assertEqual(self.m.up_to_date(self.stages), 2)
+
+    def test_changed_input(self):
+        self.write(self.raw, 'TTTT')
+        self.assertEqual(self.m.up_to_date(self.stages), 0)
+
+    def test_changed_shard(self):
+        '''a shard that is not what the last stage left should redo from the stage that made it'''
+        self.write(self.shard, 'AC')
+        self.assertEqual(self.m.up_to_date(self.stages), 0)
+
+    def test_forget(self):
+        self.m.forget('filter')
+        self.assertEqual(self.m.up_to_date(self.stages), 2)
+
+
+class TestSignature(unittest.TestCase):
+    def test_missing(self):
+        self.assertEqual(manifest.file_signature('/nonexistent/file'), None)
+        self.assertTrue(manifest.same_contents(None, None))
+
+    def test_reuse(self):
+        '''should reuse a known checksum if the size and time match'''
+        fh, fn = tempfile.mkstemp()
+        os.write(fh, 'hello')
+        os.close(fh)
+
+        sig = manifest.file_signature(fn)
+        self.assertEqual(sig['md5'], '5d41402abc4b2a76b9719d911017c592')
+        sig['md5'] = 'fake'
+        self.assertEqual(manifest.file_signature(fn, sig)['md5'], 'fake')
+        os.remove(fn)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+'''
+unit tests for merge_pairs.py
+'''
+
+from SmileTrain.test import fake_fh
+import unittest
+import numpy as np
+from SmileTrain import merge_pairs
+
+
+class TestPosteriorQualities(unittest.TestCase):
+    def test_agree(self):
+        '''agreeing bases should have higher quality than either read'''
+        self.assertTrue(merge_pairs.agree_quality[20, 20] > 20)
+
+    def test_disagree(self):
+        '''disagreeing bases with equal quality should be nearly a coin flip'''
+        self.assertEqual(merge_pairs.disagree_quality[30, 30], 3)
+
+
+class TestEncodeBatch(unittest.TestCase):
+    def test_right_align(self):
+        codes, quals, lengths = merge_pairs.encode_batch(['ACG'], ['III'], 5, right_align=True)
+        self.assertEqual(list(codes[0]), [4, 4, 0, 1, 2])
+        self.assertEqual(list(quals[0]), [0, 0, 40, 40, 40])
+        self.assertEqual(list(lengths), [3])
+
+    def test_truncqual(self):
+        '''should truncate before the first low-quality base'''
+        codes, quals, lengths = merge_pairs.encode_batch(['ACGT'], ['II#I'], 4, truncqual=2)
+        self.assertEqual(list(lengths), [2])
+
+
+class TestMergeFastqs(unittest.TestCase):
+    def setUp(self):
+        # 30 bp amplicon; forward read is the first 20 bp, reverse read is the revcomp of the last 20 bp
+        self.amplicon = 'ACGTTGCAAGCTTAGCCGTAGGATCCATGC'
+        forward = self.amplicon[:20]
+        reverse = 'GCATGGATCCTACGGCTAAG'
+        self.fwd = fake_fh(['@read1#ACGT/1', forward, '+', 'I' * 20, '@read2#ACGT/1', forward, '+', 'I' * 20])
+        self.rev = fake_fh(['@read1#ACGT/2', reverse, '+', 'I' * 20, '@read2#ACGT/2', 'TTTTTTTTTTTTTTTTTTTT', '+', 'I' * 20])
+
+    def test_correct(self):
+        '''should merge the overlapping pair and drop the non-overlapping one'''
+        out = fake_fh()
+        stats = merge_pairs.merge_fastqs(self.fwd, self.rev, out, min_overlap=5, max_diffs=1)
+        lines = out.getvalue().split("\n")
+
+        self.assertEqual(stats, {'pairs': 2, 'merged': 1, 'not_merged': 1})
+        self.assertEqual(lines[0], '@read1#ACGT/1')
+        self.assertEqual(lines[1], self.amplicon)
+        self.assertEqual(len(lines[3]), len(self.amplicon))
+
+    def test_unpaired(self):
+        '''should raise an error when the ids do not match'''
+        rev = fake_fh(['@read9#ACGT/2', 'ACGT', '+', 'IIII'])
+        self.assertRaises(RuntimeError, merge_pairs.merge_fastqs, self.fwd, rev, fake_fh())
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
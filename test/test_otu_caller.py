@@ -5,7 +5,7 @@ Unit tests for otu_caller.py
 '''
 
 from SmileTrain.test import fake_fh
-import unittest, tempfile, subprocess, os, shutil, StringIO
+import unittest, tempfile, subprocess, os, shutil, StringIO, argparse
 from Bio import SeqIO, Seq
 
 from SmileTrain import util, remove_primers, derep_fulllength, check_fastq_format, convert_fastq, map_barcodes, derep_fulllength, uc2otus, index, otu_caller
@@ -39,6 +39,7 @@ class TestFileChecks(TestWithFiles):
         os.unlink(self.no_fn)
 
         self.sub = otu_caller.Submitter(method='local')
+        self.sub.file_delay = 0.0
         
     def test_check_for_existence_empty(self):
         '''should identify empty files as existing'''
@@ -63,6 +64,36 @@ class TestFileChecks(TestWithFiles):
     def test_check_for_collision_no(self):
         '''should identify destination as empty'''
         self.sub.check_for_collisions(self.no_fn)
+
+    def test_check_for_nonempty(self):
+        self.sub.check_for_nonempty([self.full_fn])
+        self.assertRaises(RuntimeError, self.sub.check_for_nonempty, [self.full_fn, self.empty_fn])
+
+    def test_check_for_existence_directory(self):
+        '''a directory should not count as an existing file'''
+        self.assertRaises(RuntimeError, self.sub.check_for_existence, [self.full_fn, tmp_dir])
+
+    def test_wait_for_files(self):
+        '''should look again at files that are late, backing off'''
+        sleeps = []
+        def sleep(x):
+            sleeps.append(x)
+            if len(sleeps) == 2:
+                with open(self.no_fn, 'w') as f:
+                    f.write('late')
+
+        missing, empty = util.wait_for_files([self.full_fn, self.no_fn, self.empty_fn], delay=1.0, sleep=sleep)
+        self.assertEqual((missing, empty), ([], [self.empty_fn]))
+        self.assertEqual(sleeps, [1.0, 2.0, 4.0, 8.0, 16.0])
+
+    def test_move_and_remove(self):
+        '''should move and remove files in this process'''
+        moved = self.full_fn + '.moved'
+        self.sub.move_files([self.full_fn], [moved])
+        self.assertTrue(os.path.isfile(moved))
+        self.sub.rm_files([moved, self.empty_fn])
+        self.assertFalse(os.path.exists(moved))
+        self.assertFalse(os.path.exists(self.empty_fn))
         
 
 def TestPipelineSteps(TestWithFiles):
@@ -93,5 +124,21 @@ def TestPipelineSteps(TestWithFiles):
         self.assertEqual(table_content, expected_table)
         
 
+class TestSelectedStages(unittest.TestCase):
+    def args(self, **selected):
+        options = ['check', 'dag', 'split', 'convert', 'merge', 'primers', 'demultiplex', 'already_demultiplexed', 'qfilter',
+            'dereplicate', 'index', 'denovo', 'ref_gg', 'open_ref_gg', 'dbotu', 'dbotu_split', 'ref_chimeras', 'chimeras',
+            'dbotu_chimeras', 'seq_table', 'seq_tax', 'otu_table']
+        args = argparse.Namespace(**dict([(option, False) for option in options]))
+        args.__dict__.update(selected)
+        return args
+
+    def test_dag(self):
+        '''the per-shard stages should run as one graph, but only if any are selected'''
+        self.assertEqual(otu_caller.selected_stages(self.args(merge=True, qfilter=True, dereplicate=True)), ['merge', 'qfilter', 'dereplicate'])
+        self.assertEqual(otu_caller.selected_stages(self.args(dag=True, merge=True, qfilter=True, dereplicate=True)), ['shards', 'dereplicate'])
+        self.assertEqual(otu_caller.selected_stages(self.args(dag=True, dereplicate=True)), ['dereplicate'])
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+'''
+unit tests for pool_runs.py
+'''
+
+from SmileTrain.test import fake_fh
+import unittest
+from SmileTrain import pool_runs
+
+
+class TestPoolRuns(unittest.TestCase):
+    def setUp(self):
+        self.fastas = [">seq1;counts=3\nAAA\n>seq2;counts=1\nCCC\n", ">seq1;counts=5\nGGG\nTTT\n"]
+
+    def test_pool_and_split(self):
+        '''splitting a pooled fasta should give back the inputs'''
+        pooled = fake_fh()
+        pool_runs.pool_fasta_lines([fake_fh(x) for x in self.fastas], pooled)
+        self.assertEqual(pooled.getvalue(), ">0|seq1;counts=3\nAAA\n>0|seq2;counts=1\nCCC\n>1|seq1;counts=5\nGGG\nTTT\n")
+
+        outs = [fake_fh() for x in self.fastas]
+        pool_runs.split_fasta_lines(pooled.getvalue().splitlines(True), outs)
+        self.assertEqual([out.getvalue() for out in outs], self.fastas)
+
+    def test_split_uc(self):
+        lines = ["H\t0\t250\t99.2\t+\t0\t0\t250M\t1|seq1;counts=5\t4479944\n",
+            "N\t*\t*\t*\t*\t*\t*\t*\t0|seq2;counts=1\t*\n"]
+        outs = [fake_fh(), fake_fh(), fake_fh()]
+        pool_runs.split_uc_lines(lines, outs)
+        self.assertEqual([out.getvalue() for out in outs], ["N\t*\t*\t*\t*\t*\t*\t*\tseq2;counts=1\t*\n",
+            "H\t0\t250\t99.2\t+\t0\t0\t250M\tseq1;counts=5\t4479944\n", ""])
+
+    def test_unpooled_label(self):
+        self.assertRaises(RuntimeError, pool_runs.split_fasta_lines, [">seq1;counts=3\n", "AAA\n"], [fake_fh()])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
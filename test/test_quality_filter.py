@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+'''
+unit tests for quality_filter.py
+'''
+
+from SmileTrain.test import fake_fh
+import unittest, tempfile, os, shutil
+from SmileTrain import quality_filter, util
+
+
+class TestFilterBatch(unittest.TestCase):
+    def setUp(self):
+        # '5' is Q20 (error 0.01), '+' is Q10 (error 0.1), '#' is Q2
+        self.entries = [('good', 'ACGTACGT', '55555555'), ('bad', 'ACGTACGT', '++++++++'), ('trunc', 'ACGTACGT', '5555#555')]
+
+    def test_maxee(self):
+        '''should drop reads with too many expected errors and truncate at low quality'''
+        fasta, n = quality_filter.filter_batch(self.entries, 2, 0.5)
+        self.assertEqual(fasta, '>good\nACGTACGT\n>trunc\nACGT\n')
+        self.assertEqual(n, 2)
+
+    def test_trunclen(self):
+        '''should truncate to trunclen and drop reads that are too short'''
+        fasta, n = quality_filter.filter_batch(self.entries, 2, 0.5, trunclen=6)
+        self.assertEqual(fasta, '>good\nACGTAC\n')
+
+    def test_bad_quality(self):
+        '''should complain about quality characters out of range'''
+        self.assertRaises(RuntimeError, quality_filter.filter_batch, [('x', 'A', '~')], 2, 1.0)
+
+
+class TestOrderedWriter(unittest.TestCase):
+    def test_correct(self):
+        '''chunks should be written in order no matter when they arrive'''
+        out = fake_fh()
+        writer = quality_filter.OrderedWriter(out)
+        writer.write(2, 'c')
+        writer.write(0, 'a')
+        self.assertEqual(out.getvalue(), 'a')
+        writer.write(1, 'b')
+        writer.close()
+        self.assertEqual(out.getvalue(), 'abc')
+
+    def test_missing(self):
+        writer = quality_filter.OrderedWriter(fake_fh())
+        writer.write(1, 'b')
+        self.assertRaises(RuntimeError, writer.close)
+
+
+class TestFilterFastqs(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fns = [os.path.join(self.tmp_dir, 'q.%d.fst' % i) for i in range(2)]
+        for i, fn in enumerate(self.fns):
+            with open(fn, 'w') as f:
+                f.write("@read%d\nACGT\n+\n5555\n" % i)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_correct(self):
+        '''should combine shards in order'''
+        out = fake_fh()
+        n_in, n_out = quality_filter.filter_fastqs(self.fns, out, 2, 1.0, batch_size=1)
+        self.assertEqual(out.getvalue(), '>read0\nACGT\n>read1\nACGT\n')
+        self.assertEqual((n_in, n_out), (2, 2))
+
+
+class TestFastqEntries(unittest.TestCase):
+    def test_correct(self):
+        entries = list(util.fastq_entries(fake_fh(['@foo/1', 'ACG', '+foo', 'III'])))
+        self.assertEqual(entries, [('foo/1', 'ACG', 'III')])
+
+    def test_raise(self):
+        self.assertRaises(RuntimeError, list, util.fastq_entries(fake_fh(['foo', 'ACG', '+', 'III'])))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
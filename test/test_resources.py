@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+'''
+unit tests for resources.py
+'''
+
+import unittest, tempfile, os, shutil
+from SmileTrain import resources
+
+
+class TestWithFiles(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+        # 100 reads, 10 distinct sequences, 18 bytes per record
+        self.fastq = os.path.join(self.tmp_dir, 'reads.fastq')
+        with open(self.fastq, 'w') as f:
+            for i in range(100):
+                f.write("@r%d\nACGT%d\n+\nIIIII\n" %(i % 10, i % 10))
+
+        self.fasta = os.path.join(self.tmp_dir, 'reads.fasta')
+        with open(self.fasta, 'w') as f:
+            f.write(">a\nACGT\n>b\nTTTT\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_sample_fastq(self):
+        seqs, bytes_per_record = resources.sample_records(self.fastq, 5)
+        self.assertEqual(seqs, ['ACGT0', 'ACGT1', 'ACGT2', 'ACGT3', 'ACGT4'])
+        self.assertEqual(bytes_per_record, 18.0)
+
+    def test_estimate(self):
+        self.assertEqual(resources.estimate_reads([self.fastq]), (100, 10, 5.0))
+        self.assertEqual(resources.estimate_reads([self.fasta]), (2, 2, 4.0))
+
+    def test_shard_count(self):
+        '''should aim for the target size but respect the slot limit'''
+        self.assertEqual(resources.auto_shard_count([self.fastq], shard_mb=0.0005, max_shards=100), 4)
+        self.assertEqual(resources.auto_shard_count([self.fastq], shard_mb=0.0005, max_shards=3), 3)
+        self.assertEqual(resources.auto_shard_count([self.fastq], shard_mb=1, max_shards=100), 1)
+
+    def test_memory(self):
+        '''memory should grow with the unique sequences in profiled stages, and be left to the cluster in others'''
+        self.assertEqual(resources.stage_memory_gb('convert', [self.fastq]), None)
+        old = resources.memory_profiles['dereplicate']
+        resources.memory_profiles['dereplicate'] = (1.0, 0, 1e9 - 5)
+        self.assertEqual(resources.stage_memory_gb('dereplicate', [self.fastq], safety=1.0), 11)
+        self.assertEqual(resources.stage_memory_gb('dereplicate', [self.fastq], n_commands=2, safety=1.0), 6)
+        resources.memory_profiles['dereplicate'] = old
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
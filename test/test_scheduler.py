@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+'''
+unit tests for scheduler.py
+'''
+
+import unittest, tempfile, os, shutil, subprocess, time
+from SmileTrain import scheduler, otu_caller, local_runner
+
+
+class TestTaskGraph(unittest.TestCase):
+    def setUp(self):
+        self.split = scheduler.Task('split', [['echo', 'split']])
+        self.a = scheduler.Task('convert 0', [['echo', 'a']], deps=[self.split])
+        self.b = scheduler.Task('convert 1', [['echo', 'b']], deps=[self.split])
+        self.merge = scheduler.Task('merge 0', [['echo', 'c'], 'echo d'], deps=[self.a])
+
+    def test_ready(self):
+        '''tasks should be released as soon as their own dependencies finish'''
+        graph = scheduler.TaskGraph([self.merge, self.b, self.a, self.split])
+        self.assertEqual(graph.ready(), [self.split])
+
+        graph.start(self.split)
+        graph.finish(self.split)
+        self.assertEqual(graph.ready(), [self.b, self.a])
+
+        graph.start(self.a)
+        graph.finish(self.a)
+        self.assertEqual(graph.ready(), [self.merge, self.b])
+        self.assertFalse(graph.done())
+
+    def test_order(self):
+        graph = scheduler.TaskGraph([self.merge, self.b, self.a, self.split])
+        self.assertEqual(graph.order(), [self.split, self.b, self.a, self.merge])
+
+    def test_missing_dep(self):
+        self.assertRaises(RuntimeError, scheduler.TaskGraph, [self.a])
+
+    def test_cycle(self):
+        self.split.deps = [self.merge]
+        self.assertRaises(RuntimeError, scheduler.TaskGraph, [self.merge, self.b, self.a, self.split])
+
+    def test_command_line(self):
+        self.assertEqual(self.merge.command_line(), 'echo c && echo d')
+
+
+class TestExecuteGraph(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.sub = otu_caller.Submitter(method='local')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_local(self):
+        '''should run tasks after their dependencies and check their outputs'''
+        fn1 = os.path.join(self.tmp_dir, 'one')
+        fn2 = os.path.join(self.tmp_dir, 'two')
+        first = scheduler.Task('first', ['echo hello > %s' % fn1], outputs=[fn1])
+        second = scheduler.Task('second', ['cat %s %s > %s' %(fn1, fn1, fn2)], deps=[first], outputs=[fn2])
+        self.sub.execute_graph([second, first])
+
+        with open(fn2) as f:
+            self.assertEqual(f.read(), 'hello\nhello\n')
+
+    def test_missing_output(self):
+        '''should complain if a task does not make its outputs'''
+        task = scheduler.Task('task', ['true'], outputs=[os.path.join(self.tmp_dir, 'nothing')])
+        self.assertRaises(RuntimeError, self.sub.execute_graph, [task])
+
+    def test_speculate(self):
+        '''a copy of a straggler should finish it, and the straggler should be cancelled'''
+        self.sub.speculate = 2.0
+        self.sub.runner = local_runner.LocalRunner(2)
+
+        fast = []
+        for i in range(2):
+            fn = os.path.join(self.tmp_dir, 'fast%d' % i)
+            fast.append(scheduler.Task('fast %d' % i, ['echo %d > %s' %(i, fn)], outputs=[fn], stage='shard'))
+
+        fn = os.path.join(self.tmp_dir, 'slow')
+        with open(fn, 'w') as f:
+            f.write('in\n')
+
+        winner = fn + '.won'
+        scratch = scheduler.scratch_fn(fn)
+        cmds = [scheduler.scratch_command(['sleep 30', 'echo original > %s' % scratch], [fn], [fn], self.tmp_dir, winner)]
+        copy = lambda snapshots: [scheduler.scratch_command(['echo copy >> %s' % scratch], [(snapshots[fn], fn)], [fn], self.tmp_dir, winner)]
+        slow = scheduler.Task('slow', cmds, outputs=[fn], stage='shard', inputs=[fn], winner=winner, copy=copy)
+
+        start = time.time()
+        self.sub.execute_graph(fast + [slow])
+        self.assertTrue(time.time() - start < 20)
+
+        with open(fn) as f:
+            self.assertEqual(f.read(), 'in\ncopy\n')
+
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['fast0', 'fast1', 'slow'])
+
+
+class TestSpeculator(unittest.TestCase):
+    def setUp(self):
+        self.speculator = scheduler.Speculator(multiple=2.0, min_finished=2)
+        self.copy = lambda snapshots: []
+        self.tasks = [scheduler.Task('shard %d' % i, ['true'], stage='shard', copy=self.copy) for i in range(4)]
+
+    def test_median(self):
+        self.assertEqual(self.speculator.median('shard'), None)
+        for seconds in [3.0, 1.0, 2.0]:
+            self.speculator.finished(self.tasks[0], seconds)
+        self.assertEqual(self.speculator.median('shard'), 2.0)
+
+        self.speculator.finished(self.tasks[0], 10.0)
+        self.assertEqual(self.speculator.median('shard'), 2.5)
+
+    def test_stragglers(self):
+        '''tasks past the multiple of the median should be copied, slowest first, once'''
+        elapsed = {self.tasks[2]: 30.0, self.tasks[3]: 50.0}
+        self.speculator.finished(self.tasks[0], 10.0)
+        self.assertEqual(self.speculator.stragglers(elapsed), [])
+
+        self.speculator.finished(self.tasks[1], 20.0)
+        self.assertEqual(self.speculator.stragglers(elapsed), [self.tasks[3]])
+        self.assertEqual(self.speculator.stragglers(elapsed), [])
+
+        elapsed[self.tasks[2]] = 60.0
+        self.assertEqual(self.speculator.stragglers(elapsed), [self.tasks[2]])
+
+    def test_limits(self):
+        '''only tasks that can be copied and have started, and no more than asked for'''
+        for task in self.tasks[:2]:
+            self.speculator.finished(task, 1.0)
+
+        plain = scheduler.Task('plain', ['true'], stage='shard')
+        other = scheduler.Task('other', ['true'], stage='qfilter', copy=self.copy)
+        elapsed = {plain: 10.0, other: 10.0, self.tasks[2]: None, self.tasks[3]: 10.0}
+        self.assertEqual(self.speculator.stragglers(elapsed, 0), [])
+        self.assertEqual(self.speculator.stragglers(elapsed, 1), [self.tasks[3]])
+
+
+class TestStream(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fifo = os.path.join(self.tmp_dir, 'fifo')
+        self.out = os.path.join(self.tmp_dir, 'out')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_pipes(self):
+        '''background pipelines should feed the main one through named pipes'''
+        cmd = scheduler.stream_command([['cat', self.fifo, '-'], 'tr a b'], self.out, [(['echo aa'], self.fifo)])
+        self.assertEqual(subprocess.call('echo ca | ' + cmd, shell=True), 0)
+
+        with open(self.out) as f:
+            self.assertEqual(f.read(), 'bb\ncb\n')
+        self.assertFalse(os.path.exists(self.fifo))
+
+    def test_fail(self):
+        '''a failure anywhere should fail the line, even if a writer is left waiting'''
+        cmd = scheduler.stream_command(['false', 'cat'], self.out)
+        self.assertEqual(subprocess.call(cmd, shell=True), 1)
+
+        cmd = scheduler.stream_command([['cat', '/nonexistent/file']], self.out, [(['yes'], self.fifo)])
+        self.assertEqual(subprocess.call(cmd, shell=True, stderr=open(os.devnull, 'w')), 1)
+
+        cmd = scheduler.stream_command([['cat', self.fifo]], self.out, [(['echo a', 'false'], self.fifo)])
+        self.assertEqual(subprocess.call(cmd, shell=True), 1)
+
+
+class TestScratch(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.scratch = os.path.join(self.tmp_dir, 'scratch')
+        os.mkdir(self.scratch)
+        self.input = os.path.join(self.tmp_dir, 'in')
+        self.output = os.path.join(self.tmp_dir, 'out')
+        with open(self.input, 'w') as f:
+            f.write('hello\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_copy(self):
+        '''should run in scratch and copy back only the outputs'''
+        cmds = ['tr l L < %s > %s' %(scheduler.scratch_fn(self.input), scheduler.scratch_fn(self.output)), 'touch $SMILETRAIN_SCRATCH/junk']
+        cmd = scheduler.scratch_command(cmds, [self.input], [self.output], self.scratch)
+        self.assertEqual(subprocess.call(cmd, shell=True), 0)
+
+        with open(self.output) as f:
+            self.assertEqual(f.read(), 'heLLo\n')
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['in', 'out', 'scratch'])
+        self.assertEqual(os.listdir(self.scratch), [])
+
+    def test_fail(self):
+        '''a failed command should leave no outputs and no scratch directory'''
+        cmds = ['cp %s %s' %(scheduler.scratch_fn(self.input), scheduler.scratch_fn(self.output)), 'exit 3']
+        cmd = scheduler.scratch_command(cmds, [self.input], [self.output], self.scratch)
+        self.assertEqual(subprocess.call(cmd, shell=True), 3)
+
+        self.assertFalse(os.path.exists(self.output))
+        self.assertEqual(os.listdir(self.scratch), [])
+
+    def test_failed_copy(self):
+        '''if an output cannot be copied back, an input rewritten in place should be left alone'''
+        cmds = ['echo new > %s' % scheduler.scratch_fn(self.input)]
+        cmd = scheduler.scratch_command(cmds, [self.input], [self.input, self.output], self.scratch)
+        self.assertEqual(subprocess.call(cmd, shell=True, stderr=open(os.devnull, 'w')), 1)
+
+        with open(self.input) as f:
+            self.assertEqual(f.read(), 'hello\n')
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['in', 'scratch'])
+
+    def test_winner(self):
+        '''only the first copy to finish should copy back its outputs'''
+        winner = os.path.join(self.tmp_dir, 'won')
+        first, second = [scheduler.scratch_command(['echo %s > %s' %(x, scheduler.scratch_fn(self.output))], [self.input], [self.output], self.scratch, winner) for x in ['first', 'second']]
+        self.assertEqual(subprocess.call(first, shell=True), 0)
+        self.assertEqual(subprocess.call(second, shell=True), scheduler.lost_status)
+
+        with open(self.output) as f:
+            self.assertEqual(f.read(), 'first\n')
+        self.assertTrue(os.path.isdir(winner))
+        self.assertEqual(os.listdir(self.scratch), [])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
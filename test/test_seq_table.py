@@ -11,6 +11,14 @@ class TestFastaToTableAndAbundance(unittest.TestCase):
         table2, abund2 = seq_table.SeqTableWriter.fasta_to_abund(fasta, names)
         self.assertEqual(table, table2)
         self.assertEqual(abund, abund2)
+
+    def test_missing(self):
+        '''sequences dropped from the dereplicated fasta should not be counted'''
+        lines = ['>sample=donor1;1', 'GGG', '>sample=donor1;2', 'AAA', '>sample=donor2;1', 'GGG', '>sample=donor2;2', 'AAA']
+        table, abund = seq_table.SeqTableWriter.fasta_to_abund(fake_fh(lines), {'AAA': 'seqA'})
+        self.assertEqual(table, {'seqA': {'donor1': 1, 'donor2': 1}})
+        self.assertEqual(abund, {'seqA': 2})
+        self.assertRaises(RuntimeError, seq_table.SeqTableWriter.fasta_to_abund, fake_fh(lines), {'AAA': 'seqA'}, True)
     
 class TestTableToSamples(unittest.TestCase):
     def test_correct(self):
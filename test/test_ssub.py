@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+'''
+unit tests for ssub.py
+'''
+
+import unittest, tempfile, os, shutil, stat, subprocess
+from SmileTrain import ssub
+
+coyote_xml = '''<Data>
+<Job><Job_Id>123[].wiley.coyote</Job_Id><Job_Owner>me@wiley.coyote</Job_Owner><job_state>R</job_state></Job>
+<Job><Job_Id>124.wiley.coyote</Job_Id><Job_Owner>you@wiley.coyote</Job_Owner><job_state>Q</job_state></Job>
+<Job><Job_Id>125.wiley.coyote</Job_Id><Job_Owner>me@wiley.coyote</Job_Owner><job_state>C</job_state></Job>
+<Job><Job_Id>126.wiley.coyote</Job_Id><Job_Owner>me@wiley.coyote</Job_Owner><job_state>Q</job_state></Job>
+</Data>'''
+
+zcluster_xml = '''<?xml version='1.0'?>
+<job_info>
+  <queue_info>
+    <job_list state="running"><JB_job_number>11</JB_job_number><JB_owner>me</JB_owner></job_list>
+  </queue_info>
+  <job_info>
+    <job_list state="pending"><JB_job_number>12</JB_job_number><JB_owner>you</JB_owner></job_list>
+    <job_list state="pending"><JB_job_number>13</JB_job_number><JB_owner>me</JB_owner></job_list>
+  </job_info>
+</job_info>'''
+
+
+class TestParse(unittest.TestCase):
+    def test_coyote(self):
+        '''should find our unfinished jobs'''
+        self.assertEqual(ssub.coyote_parse(coyote_xml, 'me'), ['123[]', '126'])
+
+    def test_zcluster(self):
+        self.assertEqual(ssub.zcluster_parse(zcluster_xml, 'me'), ['11', '13'])
+
+    def test_empty(self):
+        '''no output means no jobs'''
+        self.assertEqual(ssub.coyote_parse('', 'me'), [])
+        self.assertEqual(ssub.coyote_parse('\n', 'me'), [])
+
+    def test_cut_off(self):
+        '''xml that was cut off should not look like fewer jobs'''
+        self.assertRaises(ssub.ET.ParseError, ssub.coyote_parse, coyote_xml[:len(coyote_xml) / 2], 'me')
+
+
+class TestPacking(unittest.TestCase):
+    def test_lpt(self):
+        '''the biggest items should be spread out first, and each bin keep the original order'''
+        self.assertEqual(ssub.pack_lpt([1, 5, 4, 3, 3], 2), [[1, 4], [0, 2, 3]])
+        self.assertEqual(ssub.pack_lpt([1, 10, 5], 1), [[0, 1, 2]])
+
+    def test_cost(self):
+        '''cost should scale with input size and the program's weight'''
+        fh, fn = tempfile.mkstemp()
+        os.write(fh, 'x' * 99)
+        os.close(fh)
+
+        self.assertEqual(ssub.command_cost('python lib/merge_pairs.py %s --output out' % fn), 200.0)
+        self.assertEqual(ssub.command_cost('(cat %s) && echo done' % fn), 100.0)
+        os.remove(fn)
+
+    def test_cost_programs(self):
+        '''the program, interpreter, and telemetry wrapper should not count as input'''
+        tmp_dir = tempfile.mkdtemp()
+        script = os.path.join(tmp_dir, 'merge_pairs.py')
+        wrapper = os.path.join(tmp_dir, 'telemetry.py')
+        data = os.path.join(tmp_dir, 'data')
+        for fn, size in [(script, 1000), (wrapper, 500), (data, 99)]:
+            with open(fn, 'w') as f:
+                f.write('x' * size)
+
+        self.assertEqual(ssub.command_cost('python %s %s' %(script, data)), 200.0)
+        self.assertEqual(ssub.command_cost("python %s %s merge 'python %s %s'" %(wrapper, tmp_dir, script, data)), 200.0)
+        self.assertEqual(ssub.command_cost('%s %s; cat %s' %(script, data, script)), 2.0 * (1 + 99 + 1000))
+        shutil.rmtree(tmp_dir)
+
+    def test_write_jobs(self):
+        tmp_dir = tempfile.mkdtemp()
+        s = ssub.Ssub('me', 'coyote', 'speedy', tmp_dir, '/dev/null', n_cpus=2, packing='lpt')
+        big = os.path.join(tmp_dir, 'big')
+        with open(big, 'w') as f:
+            f.write('x' * 1000)
+
+        fns = s.write_jobs(['cat %s' % big, 'echo a', 'echo b'])
+        contents = [[line[2:] for line in open(fn) if line.startswith('{ ')] for fn in fns]
+        self.assertEqual(contents, [['cat %s\n' % big], ['echo a\n', 'echo b\n']])
+        shutil.rmtree(tmp_dir)
+
+    def test_job_status(self):
+        '''a job should run all its commands, and fail if any of them did'''
+        tmp_dir = tempfile.mkdtemp()
+        s = ssub.Ssub('me', 'coyote', 'speedy', tmp_dir, '/dev/null', n_cpus=1)
+        out = os.path.join(tmp_dir, 'out')
+        fns = s.write_jobs(['sh -c "exit 3"', 'echo a > %s' % out, 'true'])
+
+        self.assertEqual(subprocess.call(['bash', fns[0]]), 3)
+        self.assertTrue(os.path.isfile(out))
+        shutil.rmtree(tmp_dir)
+
+
+class FakeSsub():
+    '''reports jobs as running for a set number of queries each'''
+    def __init__(self, polls):
+        self.polls = polls
+        self.queries = []
+
+    def running_jobs(self, job_ids):
+        self.queries.append(sorted(job_ids))
+        running = [job_id for job_id in job_ids if self.polls[job_id] > 0]
+        for job_id in job_ids:
+            self.polls[job_id] -= 1
+        return running
+
+
+class TestJobMonitor(unittest.TestCase):
+    def setUp(self):
+        self.sleeps = []
+        self.fake = FakeSsub({'1': 0, '2': 3, '3': 1})
+        self.monitor = ssub.JobMonitor(self.fake, min_interval=1.0, max_interval=2.0, factor=2.0, sleep=self.sleeps.append)
+
+    def test_wait(self):
+        '''should query only our jobs and back off while nothing finishes'''
+        self.monitor.add('a', ['1', '3'])
+        self.monitor.add('b', ['2'])
+
+        self.assertEqual(self.monitor.wait_any(), ['a'])
+        self.assertEqual(self.fake.queries, [['1', '2', '3'], ['1', '2', '3']])
+
+    def test_backoff(self):
+        self.monitor.add('a', ['1', '3'])
+        self.monitor.add('b', ['2'])
+
+        self.assertEqual(self.monitor.wait_any(), ['a'])
+        self.assertEqual(self.monitor.wait_any(), ['b'])
+        self.assertEqual(self.sleeps, [1.0, 2.0, 1.0, 2.0])
+        self.assertEqual(self.fake.queries[-1], ['2'])
+
+
+class TestPipeline(unittest.TestCase):
+    '''submit pipelines to a fake qsub that logs its arguments'''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmp_dir, 'qsub.log')
+
+        # each call prints the next job id, like 100[].server
+        qsub = os.path.join(self.tmp_dir, 'qsub')
+        with open(qsub, 'w') as f:
+            f.write('#!/bin/bash\n')
+            f.write('echo "$@" >> %s\n' % self.log)
+            f.write('n=$(wc -l < %s)\n' % self.log)
+            f.write('echo "$((99 + n))[].server"\n')
+        os.chmod(qsub, stat.S_IRWXU)
+
+        # no jobs are ever running
+        qstat = os.path.join(self.tmp_dir, 'qstat')
+        with open(qstat, 'w') as f:
+            f.write('#!/bin/bash\n')
+        os.chmod(qstat, stat.S_IRWXU)
+
+        # log cancelled jobs
+        self.qdel_log = os.path.join(self.tmp_dir, 'qdel.log')
+        qdel = os.path.join(self.tmp_dir, 'qdel')
+        with open(qdel, 'w') as f:
+            f.write('#!/bin/bash\necho "$@" >> %s\n' % self.qdel_log)
+        os.chmod(qdel, stat.S_IRWXU)
+
+        self.ssub = ssub.Ssub('me', 'coyote', 'speedy', self.tmp_dir, '/dev/null')
+        self.ssub.submit_cmd = qsub
+        self.ssub.stat_cmd = [qstat, '-x']
+        self.ssub.cancel_cmd = qdel
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def qsub_calls(self):
+        with open(self.log) as f:
+            return [line.split() for line in f]
+
+    def test_coyote(self):
+        '''each stage should depend on the array of the stage before'''
+        job_ids = self.ssub.submit_pipeline([['echo a', 'echo b'], ['echo c'], ['echo d']], wait=False)
+        self.assertEqual(job_ids, [['100[]'], ['101[]'], ['102[]']])
+
+        calls = self.qsub_calls()
+        self.assertEqual(len(calls[0]), 1)
+        self.assertEqual(calls[1][:2], ['-W', 'depend=afterokarray:100[]'])
+        self.assertEqual(calls[2][:2], ['-W', 'depend=afterokarray:101[]'])
+
+    def test_zcluster(self):
+        self.ssub.cluster = 'zcluster'
+        self.assertEqual(self.ssub.dependency_flag(['11', '12']), '-hold_jid 11,12 ')
+        self.assertEqual(self.ssub.dependency_flag([]), '')
+
+    def test_wait(self):
+        '''should wait for the last stage with the fake qstat'''
+        self.ssub.submit_pipeline([['echo a']], wait=True)
+        self.assertEqual(len(self.qsub_calls()), 1)
+
+    def run_task(self, job_id, task):
+        '''run one task of a submitted array script, as the cluster would'''
+        array_fn, n_tasks = self.ssub.arrays[job_id]
+        env = dict(os.environ, PBS_ARRAYID=str(task), PBS_O_WORKDIR=self.tmp_dir)
+        return subprocess.call(['bash', array_fn], env=env)
+
+    def test_task_status(self):
+        '''array tasks should record exit status and stderr, and a failure should cancel the array'''
+        self.ssub.n_cpus = 2
+        job_ids = self.ssub.submit(['echo hi', 'echo oops >&2; exit 3'])
+        self.assertEqual(self.ssub.task_started(job_ids[0], 1), None)
+        self.assertEqual(self.run_task(job_ids[0], 1), 0)
+        self.assertEqual(self.ssub.task_started(job_ids[0], 1), self.ssub.task_statuses(job_ids[0])[1][1])
+        self.assertEqual(self.run_task(job_ids[0], 2), 3)
+
+        statuses = self.ssub.task_statuses(job_ids[0])
+        self.assertEqual(sorted(statuses.keys()), [1, 2])
+        self.assertEqual(statuses[2][0], 3)
+        self.assertEqual(self.ssub.task_stderr(job_ids[0], 2), 'oops\n')
+
+        monitor = ssub.JobMonitor(self.ssub, sleep=lambda x: None)
+        monitor.add('a', job_ids)
+        self.assertEqual(monitor.wait_any(), ['a'])
+        self.assertEqual(monitor.failures['a'], [(job_ids[0], 2, 3)])
+
+        with open(self.qdel_log) as f:
+            self.assertEqual(f.read(), '100[]\n')
+
+    def test_no_fail_fast(self):
+        '''without fail_fast, a failed task should not cancel the rest of the array'''
+        self.ssub.n_cpus = 2
+        job_ids = self.ssub.submit(['exit 1', 'echo hi'])
+        self.run_task(job_ids[0], 1)
+
+        monitor = ssub.JobMonitor(self.ssub, sleep=lambda x: None, fail_fast=False)
+        monitor.add('a', job_ids)
+        self.assertFalse(monitor.check_arrays('a'))
+
+        self.run_task(job_ids[0], 2)
+        self.assertTrue(monitor.check_arrays('a'))
+        self.assertEqual(monitor.failures['a'], [(job_ids[0], 1, 1)])
+        self.assertFalse(os.path.isfile(self.qdel_log))
+
+    def test_failed_query(self):
+        '''a status command that fails without complaining about unknown jobs should be an error'''
+        self.ssub.stat_cmd = ['sh', '-c', 'exit 1']
+        self.assertRaises(RuntimeError, self.ssub.running_jobs)
+        self.ssub.stat_cmd = ['sh', '-c', 'echo "qstat: Unknown Job Id 100[]" >&2; exit 153']
+        self.assertEqual(self.ssub.running_jobs(['100[]']), [])
+
+        # the monitor retries queries that fail, rather than stopping
+        self.ssub.stat_cmd = ['sh', '-c', 'echo "<Data><Job>"']
+        self.assertRaises(RuntimeError, self.ssub.running_jobs)
+
+    def test_wait_raise(self):
+        job_ids = self.ssub.submit(['echo oops >&2; exit 1'])
+        self.run_task(job_ids[0], 1)
+        self.assertRaises(RuntimeError, self.ssub.wait, job_ids)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
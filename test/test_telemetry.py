@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+'''
+unit tests for telemetry.py
+'''
+
+from SmileTrain.test import fake_fh
+import unittest, tempfile, os, shutil, subprocess, json
+from SmileTrain import telemetry, otu_caller
+
+
+class TestMeasure(unittest.TestCase):
+    def test_status(self):
+        record = telemetry.measure('exit 3')
+        self.assertEqual(record['status'], 3)
+        self.assertTrue(record['wall'] >= 0.0)
+
+    def test_io(self):
+        '''should count the bytes the command's children wrote'''
+        fh, fn = tempfile.mkstemp()
+        os.close(fh)
+        record = telemetry.measure('head -c 100000 /dev/zero > %s' % fn)
+        os.remove(fn)
+
+        if telemetry.proc_io() is not None:
+            self.assertTrue(record['wchar'] >= 100000)
+
+    def test_own_peak(self):
+        '''peak memory should be the command's own, not that of commands run before it'''
+        big = telemetry.measure('python -c "x = \' \' * 200000000"')
+        small = telemetry.measure('true')
+        self.assertTrue(big['max_rss_mb'] > 150)
+        self.assertTrue(small['max_rss_mb'] < 50)
+
+
+class TestRecorder(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.recorder = telemetry.Recorder(self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_wrap(self):
+        '''wrapped commands should keep their exit status and leave a record'''
+        self.assertEqual(subprocess.call(self.recorder.wrap("echo 'a b' > /dev/null; exit 2", 'merge'), shell=True), 2)
+
+        self.recorder.collect()
+        self.assertEqual(len(self.recorder.records), 1)
+        self.assertEqual(self.recorder.records[0]['stage'], 'merge')
+        self.assertEqual(self.recorder.records[0]['command'], "echo 'a b' > /dev/null; exit 2")
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+    def test_summary(self):
+        self.recorder.records = [{'stage': 'merge', 'start': 0, 'wall': 2.0, 'user': 1.0, 'sys': 0.5, 'max_rss_mb': 10.0, 'rchar': 3e6, 'wchar': 1e6},
+            {'stage': 'merge', 'start': 1, 'wall': 1.0, 'user': 0.5, 'sys': 0.0, 'max_rss_mb': 20.0, 'rchar': 1e6, 'wchar': 1e6},
+            {'stage': 'other', 'start': 2, 'wall': 1.0, 'user': 0.0, 'sys': 0.0, 'max_rss_mb': 1.0, 'rchar': None, 'wchar': None}]
+        self.recorder.time_stage('merge', 3.5)
+
+        lines = [line.split() for line in self.recorder.summary().split("\n")]
+        self.assertEqual(lines[1], ['merge', '2', '3.5', '3.0', '2.0', '20.0', '4.0', '2.0'])
+        self.assertEqual(lines[2], ['other', '1', '-', '1.0', '0.0', '1.0', '-', '-'])
+
+    def test_write(self):
+        fn = os.path.join(self.tmp_dir, 'metrics')
+        self.recorder.time_stage('merge', 1.0)
+        self.recorder.write(fn)
+
+        with open(fn) as f:
+            self.assertEqual(json.load(f), {'stages': [{'stage': 'merge', 'elapsed': 1.0}], 'commands': []})
+
+
+class TestSubmitter(unittest.TestCase):
+    def test_local(self):
+        '''each local command should be measured under the current stage'''
+        tmp_dir = tempfile.mkdtemp()
+        sub = otu_caller.Submitter(method='local', n_cpus=2)
+        sub.runner.out = fake_fh()
+        sub.telemetry = telemetry.Recorder(tmp_dir)
+        sub.stage = 'primers'
+
+        self.assertEqual(sub.execute([['true'], 'true']), [0, 0])
+        sub.telemetry.collect()
+        self.assertEqual([record['stage'] for record in sub.telemetry.records], ['primers', 'primers'])
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,71 @@
+import unittest
+from SmileTrain.tools import benchmark_kernels
+from SmileTrain.usearch_python import primer as usearch_primer
+from SmileTrain.usearch_python import fastq as usearch_fastq
+
+
+class TestAlternatives(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.inputs = benchmark_kernels.Inputs(n=20)
+
+    def test_same_results(self):
+        '''every alternative should give the same results as the reference'''
+        for k in benchmark_kernels.kernels:
+            for size in k.sizes:
+                args_list = k.inputs(self.inputs, size)
+                name, function, batch = k.implementations[0]
+                expected = benchmark_kernels.call_all(function, batch, args_list)
+                for name, function, batch in k.implementations[1:]:
+                    got = benchmark_kernels.call_all(function, batch, args_list)
+                    self.assertTrue(benchmark_kernels.same(got, expected), "%s %s" %(k.name, name))
+
+    def test_degenerate(self):
+        '''the set versions of MatchPrefix should handle degenerate primer letters'''
+        for seq, primer in [('ACGT', 'MCGT'), ('CCGT', 'MCGT'), ('GCGT', 'MCGT'), ('ANGT', 'ANGT'), ('ACG', 'ACGTT')]:
+            expected = usearch_primer.MatchPrefix(seq, primer)
+            self.assertEqual(benchmark_kernels.match_prefix_sets(seq, primer), expected)
+            self.assertEqual(benchmark_kernels.match_prefix_compiled(seq, primer), expected)
+
+    def test_trunc(self):
+        seq, qual = 'ACGTACGT', 'IIII#III'
+        self.assertEqual(benchmark_kernels.trunc_rec_scan(seq, qual, 2, False), usearch_fastq.TruncRec(seq, qual, 2, False))
+        self.assertEqual(benchmark_kernels.trunc_rec_scan('ACNT', 'IIII', 2, True), ('AC', 'II'))
+
+    def test_parse_errors(self):
+        self.assertRaises(RuntimeError, benchmark_kernels.parse_seq_sid_partition, 'seq0;size=4')
+        self.assertRaises(RuntimeError, benchmark_kernels.sid_to_sample_partition, 'donor1;4')
+
+
+class TestTiming(unittest.TestCase):
+    def test_run_kernel(self):
+        '''should time each implementation at each size, the reference first'''
+        inputs = benchmark_kernels.Inputs(n=5)
+        k = benchmark_kernels.kernel('best_barcode_match')
+        results = benchmark_kernels.run_kernel(k, inputs, min_time=0.0, repeat=1)
+
+        self.assertEqual(len(results), len(k.sizes) * len(k.implementations))
+        self.assertEqual([r['size'] for r in results[::len(k.implementations)]], k.sizes)
+        self.assertEqual(results[0]['implementation'], 'reference')
+        self.assertEqual(results[0]['speedup'], 1.0)
+        self.assertTrue(all([r['ns_per_call'] > 0 and r['same'] for r in results]))
+        self.assertTrue('384 barcodes' in benchmark_kernels.summary(results))
+
+    def test_alternative(self):
+        '''the decorator should add an implementation to a kernel'''
+        k = benchmark_kernels.kernel('parse_uc_line')
+        n = len(k.implementations)
+
+        @benchmark_kernels.alternative('parse_uc_line', 'test')
+        def parse(line):
+            return None
+
+        self.assertEqual(k.implementations[-1], ('test', parse, False))
+        del k.implementations[n:]
+
+    def test_no_kernel(self):
+        self.assertRaises(RuntimeError, benchmark_kernels.kernel, 'lol')
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
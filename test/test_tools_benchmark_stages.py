@@ -0,0 +1,71 @@
+import unittest, tempfile, os, shutil
+from SmileTrain.tools import benchmark_stages
+from SmileTrain import uc2otus
+from SmileTrain.test import fake_fh
+
+
+class TestCompare(unittest.TestCase):
+    def setUp(self):
+        self.baseline = [{'stage': 'index', 'size': 100, 'status': 0, 'reads_per_s': 1000.0, 'max_rss_mb': 20.0},
+            {'stage': 'seq_table', 'size': 100, 'status': 0, 'reads_per_s': 1000.0, 'max_rss_mb': 20.0},
+            {'stage': 'uc2otus', 'size': 100, 'status': 1, 'reads_per_s': 1000.0, 'max_rss_mb': 20.0}]
+
+    def result(self, stage, reads_per_s=1000.0, max_rss_mb=20.0, size=100, status=0):
+        return {'stage': stage, 'size': size, 'status': status, 'reads_per_s': reads_per_s, 'max_rss_mb': max_rss_mb}
+
+    def test_same(self):
+        results = [self.result('index', 900.0, 22.0), self.result('seq_table', 2000.0, 10.0)]
+        self.assertEqual(benchmark_stages.compare(results, self.baseline), [])
+
+    def test_slower(self):
+        results = [self.result('index', 500.0), self.result('seq_table')]
+        regressions = benchmark_stages.compare(results, self.baseline)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith('index at 100'))
+
+    def test_memory(self):
+        '''memory should only be flagged if the rise is large in both ratio and size'''
+        results = [self.result('index', max_rss_mb=40.0), self.result('seq_table', max_rss_mb=24.9)]
+        self.assertEqual(len(benchmark_stages.compare(results, self.baseline, min_rss_mb=5.0)), 1)
+
+    def test_failed(self):
+        '''failures should be flagged, even for stages not in the baseline'''
+        results = [self.result('index', status=1), self.result('uc2otus', status=1), self.result('index', size=1000, status=1)]
+        self.assertEqual(len(benchmark_stages.compare(results, self.baseline)), 3)
+
+    def test_not_in_baseline(self):
+        '''stages not in the baseline, or that failed there, should not be compared'''
+        results = [self.result('uc2otus', 1.0), self.result('index', 1.0, size=1000)]
+        self.assertEqual(benchmark_stages.compare(results, self.baseline), [])
+
+
+class TestMadeUpUc(unittest.TestCase):
+    def test_parse(self):
+        '''made-up .uc lines should be parsed like usearch's'''
+        derep = fake_fh(">seq0;counts=5\nACGT\n>seq1;counts=3\nACGG\n>seq2;counts=2\nACCC\n")
+        lines = list(benchmark_stages.made_up_uc_lines(derep, ['otu1', 'otu2'], miss_every=3))
+        self.assertEqual(uc2otus.parse_uc_lines(lines), {'seq0': 'otu1', 'seq1': 'otu2', 'seq2': 'no_match'})
+
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_results(self):
+        '''should report the named stages, running the ones they need'''
+        report = benchmark_stages.run_benchmarks([30], ['reformat_headers', 'uc2otus'], work_dir=self.tmp_dir)
+        results = report['results']
+
+        self.assertEqual([r['stage'] for r in results], ['reformat_headers', 'uc2otus'])
+        self.assertEqual([r['status'] for r in results], [0, 0])
+        self.assertEqual(results[0]['reads'], 30)
+        self.assertTrue(results[1]['reads'] > 0)
+        self.assertTrue(all([r['max_rss_mb'] > 0 for r in results]))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir, '30', 'otu.counts')))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,148 @@
+import unittest, tempfile, os, shutil, pickle
+from SmileTrain.tools import make_synthetic_dataset
+from SmileTrain import check_fastq_format, map_barcodes
+from Bio import SeqIO
+
+
+class TestMakeDataset(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.kwargs = {'n_otus': 20, 'n_clades': 4, 'n_samples': 3, 'read_length': 100, 'insert_length': 100}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make(self, name, n=50, **kwargs):
+        out_dir = os.path.join(self.tmp_dir, name)
+        options = dict(self.kwargs)
+        options.update(kwargs)
+        dataset = make_synthetic_dataset.make_dataset(out_dir, n, **options)
+        return dataset, out_dir
+
+    def contents(self, out_dir, fn):
+        with open(os.path.join(out_dir, fn)) as f:
+            return f.read()
+
+    def records(self, out_dir, fn):
+        return list(SeqIO.parse(os.path.join(out_dir, fn), 'fastq'))
+
+    def test_deterministic(self):
+        '''the same seed should give the same files, and another seed different ones'''
+        d, a = self.make('a', seed=1)
+        d, b = self.make('b', seed=1)
+        d, c = self.make('c', seed=2)
+
+        for fn in ['forward.fastq', 'reverse.fastq', 'barcodes.txt', 'truth.counts', 'reference/97_otus.fasta']:
+            self.assertEqual(self.contents(a, fn), self.contents(b, fn))
+
+        self.assertNotEqual(self.contents(a, 'forward.fastq'), self.contents(c, 'forward.fastq'))
+
+    def test_formats(self):
+        '''both encodings should be recognized, and have barcodes in the headers'''
+        d, a = self.make('a', fastq_format='illumina18')
+        d, b = self.make('b', fastq_format='illumina13')
+
+        self.assertEqual(check_fastq_format.file_format(os.path.join(a, 'forward.fastq')), 'illumina18')
+        self.assertEqual(check_fastq_format.file_format(os.path.join(b, 'forward.fastq')), 'illumina13')
+
+        # same reads, whatever the encoding
+        for fn in ['forward.fastq', 'reverse.fastq']:
+            self.assertEqual([str(r.seq) for r in self.records(a, fn)], [str(r.seq) for r in self.records(b, fn)])
+
+        forward = self.records(a, 'forward.fastq')[0]
+        reverse = self.records(a, 'reverse.fastq')[0]
+        barcode, direction = map_barcodes.parse_barcode(forward)
+        self.assertEqual(direction, '1')
+        self.assertEqual(map_barcodes.parse_barcode(reverse), (barcode, '2'))
+
+    def test_barcodes(self):
+        '''barcode reads should map to the sample the pair came from'''
+        dataset, out_dir = self.make('a', n=200, chimeras=0.0, q_sd=0.0, index_q=40)
+
+        with open(os.path.join(out_dir, 'barcodes.txt')) as f:
+            barcode_map = map_barcodes.barcode_file_to_dictionary(f)
+
+        counts = dict([(s, 0) for s in dataset.samples])
+        for record in self.records(out_dir, 'forward.fastq'):
+            barcode, direction = map_barcodes.parse_barcode(record)
+            diffs, known = map_barcodes.best_barcode_match(barcode_map.keys(), barcode)
+            self.assertTrue(diffs <= 1)
+            counts[barcode_map[known]] += 1
+
+        self.assertEqual([counts[s] for s in dataset.samples], list(dataset.truth.sum(axis=1)))
+
+    def test_primers(self):
+        '''reads should start with the primers'''
+        dataset, out_dir = self.make('a', q_start=40, q_end=40, q_sd=0.0, forward_primer='ACGTAC', reverse_primer='GGCCTT')
+        for record in self.records(out_dir, 'forward.fastq'):
+            self.assertEqual(str(record.seq)[:6], 'ACGTAC')
+        for record in self.records(out_dir, 'reverse.fastq'):
+            self.assertEqual(str(record.seq)[:6], 'GGCCTT')
+
+    def test_three_file(self):
+        '''three-file output should have the same reads, with the barcodes in their own file'''
+        d, a = self.make('a')
+        d, b = self.make('b', layout='three_file')
+
+        for fn in ['forward.fastq', 'reverse.fastq']:
+            self.assertEqual([str(r.seq) for r in self.records(a, fn)], [str(r.seq) for r in self.records(b, fn)])
+
+        for two, forward, reverse, index in zip(self.records(a, 'forward.fastq'), self.records(b, 'forward.fastq'), self.records(b, 'reverse.fastq'), self.records(b, 'index.fastq')):
+            self.assertEqual(forward.id, reverse.id)
+            self.assertEqual(forward.id, index.id)
+            self.assertEqual(forward.description.split()[1], '1:N:0:1')
+            self.assertEqual(reverse.description.split()[1], '2:N:0:1')
+            self.assertEqual(two.id, "%s#%s/1" %(forward.id, index.seq))
+
+    def test_demultiplexed(self):
+        '''each sample should get its own files, listed in the sample map'''
+        dataset, out_dir = self.make('a', n=100, chimeras=0.0, layout='demultiplexed')
+
+        with open(os.path.join(out_dir, 'samples.txt')) as f:
+            lines = [line.split() for line in f]
+        self.assertEqual([x[2] for x in lines], dataset.samples)
+
+        for (forward, reverse, sample), n in zip(lines, dataset.truth.sum(axis=1)):
+            forward_records = self.records(out_dir, forward)
+            reverse_records = self.records(out_dir, reverse)
+            self.assertEqual(len(forward_records), n)
+            self.assertEqual([r.id[:-2] for r in forward_records], [r.id[:-2] for r in reverse_records])
+            self.assertTrue(all([r.id.endswith('/1') for r in forward_records]))
+
+    def test_reference(self):
+        '''the reference should leave out the novel OTUs, and have a taxonomy for each OTU in it'''
+        dataset, out_dir = self.make('a', sids=[94, 97], novel=0.5)
+        ids = [r.id for r in SeqIO.parse(os.path.join(out_dir, 'reference', '97_otus.fasta'), 'fasta')]
+        self.assertTrue(0 < len(ids) < 20)
+        self.assertEqual(self.contents(out_dir, 'reference/94_otus.fasta'), self.contents(out_dir, 'reference/97_otus.fasta'))
+        self.assertEqual(self.contents(out_dir, 'reference/gold.fasta'), self.contents(out_dir, 'reference/97_otus.fasta'))
+
+        with open(os.path.join(out_dir, 'reference', 'taxonomy.pkl'), 'rb') as f:
+            taxonomies = pickle.load(f)
+        self.assertEqual(sorted(taxonomies.keys()), sorted(ids))
+        self.assertTrue(all([x.startswith('k__Bacteria; p__') for x in taxonomies.values()]))
+
+
+class TestHelpers(unittest.TestCase):
+    def test_reverse_complement(self):
+        self.assertEqual(make_synthetic_dataset.reverse_complement('AACGTM'), 'KACGTT')
+
+    def test_spaced_barcodes(self):
+        rng = make_synthetic_dataset.np.random.RandomState(0)
+        barcodes = make_synthetic_dataset.spaced_barcodes(rng, 20, 8, min_distance=3)
+        self.assertEqual(len(set(barcodes)), 20)
+        for i, a in enumerate(barcodes):
+            for b in barcodes[:i]:
+                self.assertTrue(sum([x != y for x, y in zip(a, b)]) >= 3)
+
+    def test_abundances(self):
+        rng = make_synthetic_dataset.np.random.RandomState(0)
+        for distribution in ['lognormal', 'powerlaw', 'uniform']:
+            weights = make_synthetic_dataset.abundances(rng, 10, distribution, 1.5)
+            self.assertAlmostEqual(weights.sum(), 1.0)
+
+        self.assertRaises(RuntimeError, make_synthetic_dataset.abundances, rng, 10, 'lol', 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+'''
+unit tests for the batch quality kernels in usearch_python/fastq.py
+'''
+
+import unittest
+import numpy as np
+from SmileTrain.usearch_python import fastq
+
+
+class TestQualMatrix(unittest.TestCase):
+    def test_correct(self):
+        '''should pad qualities into a matrix and record lengths'''
+        M, L = fastq.QualMatrix(['II', '+'])
+        self.assertEqual(M.shape, (2, 2))
+        self.assertEqual(list(L), [2, 1])
+
+
+class TestBatchKernels(unittest.TestCase):
+    def setUp(self):
+        # '5' is Q20, '+' is Q10, '#' is Q2
+        self.seqs = ['ACGT', 'ANGT', '']
+        self.quals = ['55+5', '5555', '']
+
+    def test_ee(self):
+        ee = fastq.GetEEBatch(self.quals)
+        self.assertTrue(np.allclose(ee, [0.13, 0.04, 0.0]))
+
+    def test_avg_q(self):
+        self.assertTrue(np.allclose(fastq.GetAvgQBatch(self.quals), [17.5, 20.0, 0.0]))
+
+    def test_trunc_pos(self):
+        '''should find the first low-quality base or N'''
+        self.assertEqual(list(fastq.TruncPosBatch(self.seqs, self.quals, 10, True)), [2, 1, 0])
+
+    def test_trunc_pos_rev(self):
+        '''should find the last low-quality base or N'''
+        self.assertEqual(list(fastq.TruncPosRevBatch(self.seqs, self.quals, 10, True)), [2, 1, 0])
+
+    def test_lengths(self):
+        '''padded matrices should respect the given lengths'''
+        M, L = fastq.QualMatrix(self.quals)
+        self.assertTrue(np.allclose(fastq.GetEEBatch(M, np.array([2, 1, 0])), [0.02, 0.01, 0.0]))
+
+    def test_bad_quality(self):
+        self.assertRaises(RuntimeError, fastq.GetEEBatch, ['~'])
+
+
+class TestScalarWrappers(unittest.TestCase):
+    def test_ee(self):
+        self.assertAlmostEqual(fastq.GetEE('55+5'), 0.13)
+
+    def test_trunc_rec(self):
+        self.assertEqual(fastq.TruncRec('ACGT', '55+5', 10, False), ('AC', '55'))
+        self.assertEqual(fastq.TruncRecRev('ACGT', '55+5', 10, False), ('GT', '+5'))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
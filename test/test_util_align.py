@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+'''
+unit tests for util_align.py
+'''
+
+import unittest
+from SmileTrain import util_align
+from SmileTrain.tools import count_mismatches
+
+
+class TestEditDistance(unittest.TestCase):
+    def test_identical(self):
+        '''identical sequences should have distance zero'''
+        self.assertEqual(util_align.edit_distance('ACGTACGT', 'ACGTACGT'), 0)
+
+    def test_mismatch_and_indel(self):
+        '''should count one mismatch and one deletion'''
+        self.assertEqual(util_align.edit_distance('ACGTACGT', 'ACGAACG'), 2)
+
+    def test_empty(self):
+        '''distance to an empty sequence is the other length'''
+        self.assertEqual(util_align.edit_distance('', 'ACG'), 3)
+        self.assertEqual(util_align.edit_distance('ACG', ''), 3)
+
+    def test_band_cap(self):
+        '''distances above the band should be reported as band + 1'''
+        self.assertEqual(util_align.edit_distance('AAAAAAAA', 'CCCCCCCC', band=2), 3)
+        self.assertEqual(util_align.edit_distance('AAAAAAAA', 'AAAAAAAACC', band=1), 2)
+
+    def test_band_exact(self):
+        '''distances within the band should be exact'''
+        self.assertEqual(util_align.edit_distance('ACGTTGCA', 'ACGTGCA', band=2), 1)
+
+
+class TestEditDistances(unittest.TestCase):
+    def test_one_vs_many(self):
+        '''should align one query against targets of different lengths'''
+        targets = ['ACGTACGT', 'ACGTACG', 'TTGTACGTA', '']
+        self.assertEqual(list(util_align.edit_distances('ACGTACGT', targets)), [0, 1, 3, 8])
+
+    def test_no_targets(self):
+        '''should return an empty array'''
+        self.assertEqual(len(util_align.edit_distances('ACGT', [])), 0)
+
+
+class TestMyersDistance(unittest.TestCase):
+    def test_agrees_with_dp(self):
+        '''bit-parallel distances should match the dynamic programming ones'''
+        pairs = [('ACGTACGT', 'ACGAACG'), ('GATTACA', 'GCATGCT'), ('', 'AC'), ('AAAA', 'TTTTTT')]
+        for a, b in pairs:
+            self.assertEqual(util_align.myers_distance(a, b), util_align.edit_distance(a, b))
+
+
+class TestIdentity(unittest.TestCase):
+    def test_identity(self):
+        '''identity should be relative to the longer sequence'''
+        self.assertAlmostEqual(util_align.identity(3, 100, 97), 0.97)
+
+    def test_max_differences(self):
+        '''97% of 250 bases allows 7 differences'''
+        self.assertEqual(util_align.max_differences(97, 250, 248), 7)
+
+
+class TestCountMismatches(unittest.TestCase):
+    def test_distances_to_first(self):
+        self.assertEqual(count_mismatches.distances_to_first(['ACGT', 'ACCT', 'AGT']), [0, 1, 1])
+
+    def test_distance_matrix(self):
+        seqs = ['ACGT', 'ACCT', 'TTTT']
+        expected = [[0, 1, 3], [1, 0, 3], [3, 3, 0]]
+        self.assertEqual(count_mismatches.distance_matrix(seqs), expected)
+        self.assertEqual(count_mismatches.distance_matrix(seqs, myers=True), expected)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+'''
+unit tests for worker.py
+'''
+
+from SmileTrain.test import fake_fh
+import unittest, tempfile, os, shutil
+from SmileTrain import worker, otu_caller, telemetry
+
+
+class TestScriptCall(unittest.TestCase):
+    def setUp(self):
+        self.script = os.path.join(worker.library_dir, 'split_fastq.py')
+
+    def test_list(self):
+        self.assertEqual(worker.script_call(['python', self.script, 'a.fq', 4]), (self.script, ['a.fq', '4']))
+
+    def test_string(self):
+        self.assertEqual(worker.script_call('python %s a.fq 4' % self.script), (self.script, ['a.fq', '4']))
+
+    def test_shell(self):
+        '''shell lines and other programs should go to a shell'''
+        self.assertEqual(worker.script_call('python %s a.fq 4 > log' % self.script), None)
+        self.assertEqual(worker.script_call(['mv', 'a', 'b']), None)
+        self.assertEqual(worker.script_call(['python', '/elsewhere/split_fastq.py', 'a.fq']), None)
+
+
+class TestRun(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_fork(self):
+        '''scripts should see their arguments, and their exit status should come back'''
+        script = os.path.join(self.tmp_dir, 'script.py')
+        out = os.path.join(self.tmp_dir, 'out')
+        with open(script, 'w') as f:
+            f.write("import sys\n")
+            f.write("if __name__ == '__main__':\n")
+            f.write("    open(sys.argv[1], 'w').write(' '.join(sys.argv[2:]))\n")
+            f.write("    sys.exit(int(sys.argv[2]))\n")
+
+        self.assertEqual(telemetry.wait_for(worker.fork_script(script, [out, '3', 'x']))[0], 3)
+        with open(out) as f:
+            self.assertEqual(f.read(), '3 x')
+
+    def test_exception(self):
+        script = os.path.join(self.tmp_dir, 'script.py')
+        with open(script, 'w') as f:
+            f.write("import sys\nsys.stderr = open('/dev/null', 'w')\nraise ValueError\n")
+
+        self.assertEqual(telemetry.wait_for(worker.fork_script(script, []))[0], 1)
+
+
+class TestQueue(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.queue = worker.TaskQueue(os.path.join(self.tmp_dir, 'queue'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_claim(self):
+        '''each command should be claimed once, in order'''
+        self.queue.put(10, 'true')
+        self.queue.put(2, ['false'])
+        self.assertEqual(self.queue.claim(), (2, {'command': ['false'], 'record_dir': None, 'stage': None}))
+        self.assertEqual(self.queue.claim()[0], 10)
+        self.assertEqual(self.queue.claim(), None)
+
+    def test_serve(self):
+        log = os.path.join(self.tmp_dir, 'log')
+        self.queue.put(0, 'echo a >> %s' % log)
+        self.queue.put(1, 'exit 4')
+        self.queue.put(2, 'echo b >> %s' % log)
+        self.queue.cancel(2)
+
+        worker.serve(self.queue, exit_when_idle=True)
+        self.assertEqual([self.queue.status(i) for i in range(3)], [0, 4, None])
+        with open(log) as f:
+            self.assertEqual(f.read(), 'a\n')
+
+
+class TestSubmitter(unittest.TestCase):
+    def test_local(self):
+        '''local workers should run commands across stages and retry failures'''
+        tmp_dir = tempfile.mkdtemp()
+        flag = os.path.join(tmp_dir, 'flag')
+
+        sub = otu_caller.Submitter(method='local', n_cpus=2, retries=1, workers=True)
+        sub.runner.out = fake_fh()
+        self.assertEqual(sub.execute([['true'], 'true']), [0, 0])
+        self.assertEqual(sub.execute(['test -e %s || (touch %s; exit 1)' %(flag, flag)]), [0])
+        self.assertRaises(RuntimeError, sub.execute, ['false'])
+
+        queue_dir = sub.queue.dir
+        sub.close()
+        self.assertFalse(os.path.exists(queue_dir))
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+
+'''
+Time the inner loops of the pipeline on representative inputs, and compare alternative
+implementations of them head to head.
+
+Each kernel has a reference implementation (the one the pipeline uses) and any number of
+alternatives. The inputs come from a synthetic dataset (see make_synthetic_dataset.py),
+so they have realistic lengths, qualities, and error rates. Every implementation is
+called on the same inputs; the time per call is reported in nanoseconds, along with its
+speedup over the reference and whether it gave the same results. Kernels whose cost
+grows with the number of barcodes or primers are timed at several numbers of them.
+
+To try a new implementation, add it to a kernel with the alternative decorator, e.g.,
+
+    @alternative('match_prefix', 'mine')
+    def match_prefix_mine(seq, primer):
+        ...
+
+and run this script. An alternative marked batch=True is called once with the whole list
+of inputs (each a tuple of arguments) and returns the list of results; its time is
+reported per input.
+'''
+
+import argparse, sys, os, json, time, timeit, string
+from itertools import izip
+sys.path.append(os.path.normpath(os.path.abspath(__file__) + '/../..'))
+from SmileTrain import util, util_primer, util_index, map_barcodes, uc2otus
+from SmileTrain.usearch_python import primer as usearch_primer
+from SmileTrain.usearch_python import fastq as usearch_fastq
+from SmileTrain.tools import make_synthetic_dataset
+
+
+class Kernel():
+    '''a function to time, its alternatives, and how to make its inputs'''
+
+    def __init__(self, name, reference, inputs, sizes=[None], size_label=None):
+        '''
+        name : string
+        reference : function
+            the implementation the pipeline uses
+        inputs : function
+            (Inputs, size) -> list of tuples of arguments
+        sizes : list (default [None])
+            sizes to time the kernel at, e.g., numbers of barcodes
+        size_label : string (optional)
+            what the sizes are numbers of
+        '''
+
+        self.name = name
+        self.implementations = [('reference', reference, False)]
+        self.inputs = inputs
+        self.sizes = sizes
+        self.size_label = size_label
+
+    def add(self, name, function, batch=False):
+        self.implementations.append((name, function, batch))
+
+kernels = []
+
+def kernel(name):
+    '''the kernel with some name'''
+    for k in kernels:
+        if k.name == name:
+            return k
+
+    raise RuntimeError("no kernel named %s" %(name))
+
+def alternative(kernel_name, name, batch=False):
+    '''decorator that adds a function as an alternative implementation of a kernel'''
+    def decorator(function):
+        kernel(kernel_name).add(name, function, batch)
+        return function
+
+    return decorator
+
+
+class Inputs():
+    '''representative inputs, drawn from a synthetic dataset'''
+
+    def __init__(self, n=200, seed=0):
+        '''
+        n : int
+            number of inputs for each kernel
+        seed : int
+        '''
+
+        self.n = n
+        self.seed = seed
+
+        dataset = make_synthetic_dataset.Dataset(seed=seed)
+        self.primer = dataset.forward_primer
+        self.samples = dataset.samples
+        self.otu_ids = dataset.otu_ids
+
+        self.reads = []
+        self.quals = []
+        for i, sample, barcode, barcode_quals, forward, forward_quals, reverse, reverse_quals in dataset.pairs(n):
+            self.reads.append(forward)
+            self.quals.append((forward_quals + usearch_fastq.ASCII_Offset).astype('uint8').tostring())
+
+        self.barcode_sets = {}
+        self.primer_sets = {}
+
+    def barcodes(self, n):
+        '''n known barcodes, and barcode reads of them with errors'''
+        if n not in self.barcode_sets:
+            dataset = make_synthetic_dataset.Dataset(seed=self.seed, n_samples=n)
+            reads = [pair[2] for pair in dataset.pairs(self.n)]
+            self.barcode_sets[n] = (dataset.barcodes, reads)
+
+        return self.barcode_sets[n]
+
+    def primers(self, n):
+        '''the primer, and n - 1 others that are mutants of it'''
+        if n not in self.primer_sets:
+            rng = make_synthetic_dataset.np.random.RandomState(self.seed)
+            resolved = make_synthetic_dataset.resolve_primer(rng, self.primer)
+            self.primer_sets[n] = [self.primer] + [make_synthetic_dataset.mutate(rng, resolved, 0.3) for i in range(n - 1)]
+
+        return self.primer_sets[n]
+
+
+def search_primers(seq, primers, mismatches=util_primer.mismatches, window=15):
+    '''
+    the primer that best matches the start of a sequence
+
+    returns : tuple
+        (differences, primer index, primer start index)
+    '''
+
+    return min([(d, i, start) for i, (start, d) in enumerate([mismatches(seq, primer, window) for primer in primers])])
+
+kernels += [Kernel('match_prefix', usearch_primer.MatchPrefix,
+        lambda inputs, size: [(read, inputs.primer) for read in inputs.reads]),
+    Kernel('best_match', usearch_primer.BestMatch,
+        lambda inputs, size: [(read[:len(inputs.primer) + 15], inputs.primer) for read in inputs.reads]),
+    Kernel('mismatches', util_primer.mismatches,
+        lambda inputs, size: [(read, inputs.primer, 15) for read in inputs.reads]),
+    Kernel('search_primers', search_primers,
+        lambda inputs, size: [(read, inputs.primers(size)) for read in inputs.reads], [1, 4, 16], 'primers'),
+    Kernel('best_barcode_match', map_barcodes.best_barcode_match,
+        lambda inputs, size: [(inputs.barcodes(size)[0], read) for read in inputs.barcodes(size)[1]], [8, 96, 384], 'barcodes'),
+    Kernel('get_ee', usearch_fastq.GetEE,
+        lambda inputs, size: [(qual,) for qual in inputs.quals]),
+    Kernel('trunc_rec', usearch_fastq.TruncRec,
+        lambda inputs, size: [(read, qual, 15, False) for read, qual in zip(inputs.reads, inputs.quals)]),
+    Kernel('parse_index_line', util_index.parse_index_line,
+        lambda inputs, size: [("%s\tseq%d\t%d\n" %(inputs.samples[i % len(inputs.samples)], i, i % 50 + 1),) for i in range(inputs.n)]),
+    Kernel('parse_seq_sid', util_index.parse_seq_sid,
+        lambda inputs, size: [("seq%d;counts=%d" %(i, i % 50 + 1),) for i in range(inputs.n)]),
+    Kernel('sid_to_sample', util_index.sid_to_sample,
+        lambda inputs, size: [("sample=%s;%d" %(inputs.samples[i % len(inputs.samples)], i + 1),) for i in range(inputs.n)]),
+    Kernel('parse_uc_line', uc2otus.parse_uc_line,
+        lambda inputs, size: [("H\t%d\t253\t99.6\t+\t0\t0\t253M\tseq%d;counts=%d\t%s\n" %(i, i, i % 50 + 1, inputs.otu_ids[i % len(inputs.otu_ids)]),) for i in range(inputs.n)])]
+
+
+# alternatives
+
+# the letters each primer letter matches, taken from MatchLetter itself
+primer_letters = 'ACGTMRWSYKVHDBXN'
+letter_matches = dict([(b, frozenset([a for a in string.ascii_uppercase if usearch_primer.MatchLetter(a, b)])) for b in primer_letters])
+
+@alternative('match_prefix', 'sets')
+def match_prefix_sets(seq, primer):
+    '''MatchPrefix with a set of matching letters for each primer letter'''
+    return sum([a not in letter_matches[b] for a, b in izip(seq, primer)])
+
+compiled_primers = {}
+
+@alternative('match_prefix', 'compiled')
+def match_prefix_compiled(seq, primer):
+    '''MatchPrefix with the primer's sets of matching letters looked up once'''
+    if primer not in compiled_primers:
+        compiled_primers[primer] = [letter_matches[b] for b in primer]
+
+    return sum([a not in s for a, s in izip(seq, compiled_primers[primer])])
+
+@alternative('best_match', 'compiled')
+def best_match_compiled(seq, primer):
+    best_pos, best_diffs = -1, len(primer)
+    for pos in range(len(seq) - len(primer) + 1):
+        d = match_prefix_compiled(seq[pos:], primer)
+        if d < best_diffs:
+            best_pos, best_diffs = pos, d
+
+    return best_pos, best_diffs
+
+@alternative('mismatches', 'compiled')
+def mismatches_compiled(seq, primer, w):
+    '''util_primer.mismatches, with compiled primers and without copying the sequence'''
+    if primer not in compiled_primers:
+        compiled_primers[primer] = [letter_matches[b] for b in primer]
+
+    sets = compiled_primers[primer]
+    seq = str(seq)
+    best_i, best_d = 0, len(seq)
+    for i in range(w):
+        d = sum([a not in s for a, s in izip(seq[i:i + len(sets)], sets)])
+        if d < best_d:
+            best_i, best_d = i, d
+
+    return (best_i, best_d)
+
+@alternative('search_primers', 'compiled')
+def search_primers_compiled(seq, primers):
+    return search_primers(seq, primers, mismatches_compiled)
+
+@alternative('best_barcode_match', 'hamming')
+def best_barcode_match_hamming(known_barcodes, barcode):
+    '''best_barcode_match counting unequal letters, for barcodes without degenerate letters'''
+    return min([(sum([a != b for a, b in izip(barcode, known)]), known) for known in known_barcodes], key=lambda x: x[0])
+
+@alternative('best_barcode_match', 'exact_first')
+def best_barcode_match_exact_first(known_barcodes, barcode):
+    '''best_barcode_match that first looks for the barcode read among the known barcodes'''
+    if barcode in known_barcodes:
+        return 0, barcode
+    else:
+        return best_barcode_match_hamming(known_barcodes, barcode)
+
+# error probability of each quality character, for each ascii offset
+error_probs = {}
+
+@alternative('get_ee', 'table')
+def get_ee_table(qual):
+    '''GetEE summing a python list of error probabilities'''
+    if usearch_fastq.ASCII_Offset not in error_probs:
+        error_probs[usearch_fastq.ASCII_Offset] = usearch_fastq.GetTables()[1].tolist()
+
+    probs = error_probs[usearch_fastq.ASCII_Offset]
+    return sum([probs[ord(c)] for c in qual])
+
+@alternative('get_ee', 'batch', batch=True)
+def get_ee_batch(inputs):
+    return list(usearch_fastq.GetEEBatch([qual for qual, in inputs]))
+
+@alternative('trunc_rec', 'scan')
+def trunc_rec_scan(seq, qual, trunc_q, trunc_n):
+    '''TruncRec looking at one quality character at a time'''
+    worst = chr(usearch_fastq.ASCII_Offset + trunc_q)
+    for i, c in enumerate(qual):
+        if c <= worst or (trunc_n and seq[i] == 'N'):
+            return seq[:i], qual[:i]
+
+    return seq, qual
+
+@alternative('trunc_rec', 'batch', batch=True)
+def trunc_rec_batch(inputs):
+    seqs, quals, trunc_qs, trunc_ns = zip(*inputs)
+    positions = usearch_fastq.TruncPosBatch(seqs, quals, trunc_qs[0], trunc_ns[0])
+    return [(seq[:i], qual[:i]) for seq, qual, i in zip(seqs, quals, positions)]
+
+@alternative('parse_seq_sid', 'partition')
+def parse_seq_sid_partition(sid):
+    label, sep, counts = sid.rpartition(';counts=')
+    if sep == '' or not counts.isdigit():
+        raise RuntimeError("sequence id did not parse: %s" % sid)
+
+    return label
+
+@alternative('sid_to_sample', 'partition')
+def sid_to_sample_partition(sid):
+    sample, sep, number = sid.rpartition(';')
+    if not sample.startswith('sample=') or not number.isdigit():
+        raise RuntimeError("fasta at line did not parse: %s" % sid)
+
+    return sample[len('sample='):]
+
+@alternative('parse_index_line', 'rsplit')
+def parse_index_line_rsplit(line):
+    sample, seq, abund = line.rsplit(None, 2)
+    return [sample, seq, int(abund)]
+
+@alternative('parse_uc_line', 'split_tab')
+def parse_uc_line_split_tab(line):
+    '''parse_uc_line for tab-separated lines, splitting only as far as the OTU field'''
+    fields = line.split('\t', 10)
+    return (fields[0], fields[8], fields[9].rstrip())
+
+
+def same(a, b):
+    '''are two results the same, allowing for rounding of floats?'''
+    if isinstance(a, float) or isinstance(b, float):
+        return abs(a - b) <= 1e-9 * max(1.0, abs(a), abs(b))
+    elif isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all([same(x, y) for x, y in zip(a, b)])
+    else:
+        return a == b
+
+def call_all(function, batch, args_list):
+    '''results of an implementation on a list of inputs'''
+    if batch:
+        return function(args_list)
+    else:
+        return [function(*args) for args in args_list]
+
+def time_per_call(function, batch, args_list, min_time=0.2, repeat=3):
+    '''
+    Seconds per input, the best of some repeats of calling an implementation on all the
+    inputs as many times as takes at least min_time
+
+    returns : float
+    '''
+
+    timer = timeit.Timer(lambda: call_all(function, batch, args_list))
+
+    loops = 1
+    while True:
+        elapsed = timer.timeit(loops)
+        if elapsed >= min_time or loops >= 1e6:
+            break
+
+        loops *= 10
+
+    best = min([elapsed] + timer.repeat(repeat - 1, loops))
+    return best / loops / len(args_list)
+
+def run_kernel(k, inputs, min_time=0.2, repeat=3):
+    '''
+    Time every implementation of a kernel at each of its sizes
+
+    returns : list of dicts
+        kernel, size, implementation, ns per call, speedup over the reference, and
+        whether its results were the same as the reference's
+    '''
+
+    results = []
+    for size in k.sizes:
+        args_list = k.inputs(inputs, size)
+        expected = None
+        reference_ns = None
+        for name, function, batch in k.implementations:
+            got = call_all(function, batch, args_list)
+            if expected is None:
+                expected = got
+
+            ns = 1e9 * time_per_call(function, batch, args_list, min_time, repeat)
+            if reference_ns is None:
+                reference_ns = ns
+
+            results.append({'kernel': k.name, 'size': size, 'size_label': k.size_label, 'implementation': name, 'ns_per_call': ns,
+                'speedup': reference_ns / ns, 'same': same(got, expected)})
+
+    return results
+
+def summary(results):
+    '''table of the timings'''
+    header = ['kernel', 'size', 'implementation', 'ns/call', 'speedup', 'same']
+    rows = [header]
+    for r in results:
+        rows.append([r['kernel'], '-' if r['size'] is None else "%d %s" %(r['size'], r['size_label']), r['implementation'],
+            "%.0f" %(r['ns_per_call']), "%.2f" %(r['speedup']), 'yes' if r['same'] else 'NO'])
+
+    widths = [max([len(row[i]) for row in rows]) for i in range(len(header))]
+    lines = ["  ".join([row[0].ljust(widths[0]), row[1].rjust(widths[1]), row[2].ljust(widths[2])] + [x.rjust(w) for x, w in zip(row[3:], widths[3:])]) for row in rows]
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the inner loops and their alternatives', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--kernels', default=[k.name for k in kernels], nargs='+', choices=[k.name for k in kernels], help='kernels to time')
+    parser.add_argument('--n', default=200, type=int, help='number of inputs for each kernel')
+    parser.add_argument('--min_time', default=0.2, type=float, help='minimum seconds for each timing')
+    parser.add_argument('--repeat', default=3, type=int, help='timings of each implementation (the best is reported)')
+    parser.add_argument('--seed', default=0, type=int, help='seed for the inputs')
+    parser.add_argument('--output', '-o', default=None, help='json file for the results')
+    args = parser.parse_args()
+
+    inputs = Inputs(args.n, args.seed)
+
+    results = []
+    for name in args.kernels:
+        results += run_kernel(kernel(name), inputs, args.min_time, args.repeat)
+
+    print summary(results)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'n': args.n, 'seed': args.seed, 'time': time.time(), 'results': results}, f, indent=2, sort_keys=True)
+
+    if not all([r['same'] for r in results]):
+        util.message("some alternatives gave different results from the reference")
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+'''
+Benchmark the pipeline's stage scripts on synthetic datasets of several sizes, and flag
+regressions against a baseline.
+
+For each size, a dataset is made with make_synthetic_dataset.py (the same seed gives the
+same reads), and each stage script is run on it in its own process, under telemetry.py,
+which records the wall time and peak memory. Stages that need the output of earlier
+steps (e.g., derep_fulllength needs a quality-filtered fasta) get it from the steps that
+make it; the .uc that uc2otus reads, which would come from usearch, is made up from the
+dereplicated sequences.
+
+The results are written as json. If there is a baseline (by default, the one committed
+next to this script), each stage is compared to it: a stage that processes reads more
+slowly, or uses more memory, than the baseline by more than the tolerance is flagged,
+and the script exits with status 1. A stage that fails is always flagged. Timings depend
+on the machine, so a baseline is only meaningful on the machine it was made on; make a
+new one with --save_baseline, which refuses to save results with failed stages.
+'''
+
+import argparse, sys, os, json, time, socket, platform, tempfile, shutil, subprocess, pipes
+sys.path.append(os.path.normpath(os.path.abspath(__file__) + '/../..'))
+from SmileTrain import util, telemetry
+from SmileTrain.tools import make_synthetic_dataset
+
+library = os.path.normpath(os.path.dirname(os.path.abspath(__file__)) + '/..')
+default_baseline = os.path.join(library, 'tools', 'benchmark_baseline.json')
+
+# stages in the order they are run: (name, script, arguments, input and its format). the
+# input is what the reads per second are counted in
+stages = [('split_fastq', 'split_fastq.py', ['forward.fastq', '2'], ('forward.fastq', 'fastq')),
+    ('convert_fastq', 'convert_fastq.py', ['illumina13/forward.fastq', '-o', 'converted.fastq'], ('illumina13/forward.fastq', 'fastq')),
+    ('intersect_reads', 'tools/intersect_reads.py', ['forward.fastq', 'reverse.fastq', 'intersect.1.fastq', 'intersect.2.fastq'], ('forward.fastq', 'fastq')),
+    ('fastq_quality_report', 'tools/fastq_quality_report.py', ['forward.fastq'], ('forward.fastq', 'fastq')),
+    ('remove_primers', 'remove_primers.py', ['forward.fastq', 'PRIMER', '-m', '2', '-o', 'primers.fastq'], ('forward.fastq', 'fastq')),
+    ('map_barcodes', 'map_barcodes.py', ['forward.fastq', 'barcodes.txt', '-m', '1', '-o', 'demultiplexed.fastq'], ('forward.fastq', 'fastq')),
+    ('reformat_headers', 'reformat_headers.py', ['samples.fastq', '-o', 'reformatted.fastq'], ('samples.fastq', 'fastq')),
+    ('derep_fulllength', 'derep_fulllength.py', ['q.fst', '-o', 'q.derep.fst'], ('q.fst', 'fasta')),
+    ('index', 'index.py', ['q.fst', 'q.derep.fst', '-o', 'q.index'], ('q.fst', 'fasta')),
+    ('seq_table', 'seq_table.py', ['q.fst', 'q.derep.fst', '-o', 'seq.counts'], ('q.fst', 'fasta')),
+    ('uc2otus', 'uc2otus.py', ['otus.uc', 'q.index', '-o', 'otu.counts'], ('otus.uc', 'uc'))]
+stage_names = [stage[0] for stage in stages]
+
+# stages whose outputs other stages read
+requires = {'derep_fulllength': ['map_barcodes'], 'index': ['derep_fulllength'], 'seq_table': ['derep_fulllength'],
+    'uc2otus': ['index']}
+
+def count_entries(fn, fmt):
+    '''number of entries in a fastq, fasta, or .uc file'''
+    with open(fn) as f:
+        if fmt == 'fastq':
+            return sum(1 for line in f) / 4
+        elif fmt == 'fasta':
+            return sum(1 for line in f if line.startswith('>'))
+        else:
+            return sum(1 for line in f if not line.startswith('#'))
+
+def made_up_uc_lines(derep_lines, otu_ids, miss_every=10):
+    '''
+    .uc lines for dereplicated sequences, as usearch_global would write them, hitting the
+    OTUs in turn, with every so often a miss
+
+    derep_lines : iterator of strings
+        dereplicated fasta
+    otu_ids : list of strings
+
+    yields : strings
+    '''
+
+    labels = [line[1:].strip() for line in derep_lines if line.startswith('>')]
+    for i, label in enumerate(labels):
+        if i % miss_every == miss_every - 1:
+            yield "\t".join(['N', '*', '*', '*', '*', '*', '*', '*', label, '*']) + "\n"
+        else:
+            yield "\t".join(['H', str(i % len(otu_ids)), '253', '99.6', '+', '0', '0', '253M', label, otu_ids[i % len(otu_ids)]]) + "\n"
+
+
+class Benchmark():
+    '''runs the stages on a dataset of one size'''
+
+    def __init__(self, size, work_dir, seed=0, python=sys.executable):
+        '''
+        size : int
+            number of read pairs
+        work_dir : string
+            directory for the dataset and outputs, which should be empty
+        seed : int
+        python : string (default this interpreter)
+            python that runs the stage scripts
+        '''
+
+        self.size = size
+        self.work_dir = work_dir
+        self.seed = seed
+        self.python = python
+        self.record_dir = os.path.join(work_dir, 'records')
+        os.makedirs(self.record_dir)
+
+    def fn(self, fn):
+        return os.path.join(self.work_dir, fn)
+
+    def prepare(self):
+        '''make the datasets, and the inputs that no benchmarked stage makes'''
+        dataset = make_synthetic_dataset.make_dataset(self.work_dir, self.size, seed=self.seed)
+        self.primer = dataset.forward_primer
+        make_synthetic_dataset.make_dataset(self.fn('illumina13'), self.size, fastq_format='illumina13', seed=self.seed)
+
+        # reads with the sample names in the headers, like concatenated demultiplexed files
+        samples_dir = self.fn('demultiplexed')
+        make_synthetic_dataset.make_dataset(samples_dir, self.size, layout='demultiplexed', seed=self.seed)
+        with open(self.fn('samples.fastq'), 'w') as out:
+            for sample in dataset.samples:
+                with open(os.path.join(samples_dir, '%s.F.fastq' %(sample))) as f:
+                    for i, line in enumerate(f):
+                        if i % 4 == 0:
+                            line = "%s#%s/1\n" %(line.rstrip()[:-2], sample)
+                        out.write(line)
+
+        self.otu_ids = [dataset.otu_ids[i] for i in range(len(dataset.otus)) if dataset.in_reference[i]]
+
+    def prepare_stage(self, name):
+        '''make the inputs of a stage from the outputs of the ones before it'''
+        if name == 'derep_fulllength':
+            self.run('quality_filter', ['quality_filter.py', 'demultiplexed.fastq', '-o', 'q.fst'])
+        elif name == 'uc2otus':
+            with open(self.fn('q.derep.fst')) as f, open(self.fn('otus.uc'), 'w') as out:
+                out.writelines(made_up_uc_lines(f, self.otu_ids))
+
+    def run(self, name, words):
+        '''
+        run a script in the work directory under telemetry.py, discarding what it prints
+
+        returns : dict
+            telemetry record
+        '''
+
+        words = [x.replace('PRIMER', self.primer) for x in words]
+        cmd = " ".join([pipes.quote(self.python), pipes.quote(os.path.join(library, words[0]))] + [pipes.quote(x) for x in words[1:]])
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call([self.python, telemetry.script_fn, self.record_dir, name, cmd], cwd=self.work_dir, stdout=devnull)
+
+        recorder = telemetry.Recorder(self.record_dir)
+        recorder.collect()
+        record, = recorder.records
+        return record
+
+    def results(self, names=stage_names, repeats=1):
+        '''
+        run the stages
+
+        names : list of strings
+            stages to run; the ones whose inputs come from stages not named still run,
+            but are not reported
+        repeats : int
+            times to run each stage; the fastest run is reported
+
+        returns : list of dicts
+            stage, size, status, reads, wall seconds, reads per second, and peak memory (MB)
+        '''
+
+        self.prepare()
+
+        # the named stages and the ones they need
+        needed = set()
+        queue = list(names)
+        while len(queue) > 0:
+            name = queue.pop()
+            if name not in needed:
+                needed.add(name)
+                queue += requires.get(name, [])
+
+        results = []
+        for name, script, args, (input_fn, fmt) in stages:
+            if name not in needed:
+                continue
+
+            self.prepare_stage(name)
+            records = [self.run(name, [script] + args) for i in range(repeats)]
+            record = min(records, key=lambda record: record['wall'])
+
+            if name not in names:
+                continue
+
+            reads = count_entries(self.fn(input_fn), fmt)
+            results.append({'stage': name, 'size': self.size, 'status': record['status'], 'reads': reads,
+                'wall': record['wall'], 'reads_per_s': reads / max(record['wall'], 1e-6), 'max_rss_mb': record['max_rss_mb']})
+
+            if record['status'] != 0:
+                util.message("stage %s failed at size %d (status %s)" %(name, self.size, record['status']))
+
+        return results
+
+
+def run_benchmarks(sizes, names=stage_names, repeats=1, seed=0, work_dir=None):
+    '''
+    Benchmark the stages at each size
+
+    sizes : list of ints
+        numbers of read pairs
+    work_dir : string (optional)
+        directory to keep the datasets and outputs in. By default, a temporary
+        directory that is removed afterward.
+
+    returns : dict
+        host, python, seed, time, and results (see Benchmark.results)
+    '''
+
+    top_dir = work_dir
+    if top_dir is None:
+        top_dir = tempfile.mkdtemp(prefix='.SmileTrain.benchmark.')
+
+    try:
+        results = []
+        for size in sizes:
+            util.message("Benchmarking %d read pairs" %(size))
+            results += Benchmark(size, os.path.join(top_dir, str(size)), seed).results(names, repeats)
+    finally:
+        if work_dir is None:
+            shutil.rmtree(top_dir)
+
+    return {'host': socket.gethostname(), 'python': platform.python_version(), 'seed': seed,
+        'time': time.time(), 'results': results}
+
+def compare(results, baseline, tolerance=0.25, min_rss_mb=5.0):
+    '''
+    Find the stages that failed, or that got worse than the baseline
+
+    results, baseline : lists of dicts
+        see Benchmark.results
+    tolerance : float
+        fraction by which reads per second can fall, or memory can rise, before it is a
+        regression
+    min_rss_mb : float
+        memory rises smaller than this are not regressions
+
+    returns : list of strings
+        descriptions of the regressions
+    '''
+
+    base = dict([((r['stage'], r['size']), r) for r in baseline if r['status'] == 0])
+
+    regressions = []
+    for r in results:
+        if r['status'] != 0:
+            regressions.append("%s at %d: failed (status %s)" %(r['stage'], r['size'], r['status']))
+            continue
+
+        key = (r['stage'], r['size'])
+        if key not in base:
+            continue
+
+        b = base[key]
+        if r['reads_per_s'] < (1.0 - tolerance) * b['reads_per_s']:
+            regressions.append("%s at %d: %.0f reads/s, baseline %.0f" %(r['stage'], r['size'], r['reads_per_s'], b['reads_per_s']))
+
+        if r['max_rss_mb'] > (1.0 + tolerance) * b['max_rss_mb'] and r['max_rss_mb'] - b['max_rss_mb'] > min_rss_mb:
+            regressions.append("%s at %d: %.1f MB peak memory, baseline %.1f" %(r['stage'], r['size'], r['max_rss_mb'], b['max_rss_mb']))
+
+    return regressions
+
+def summary(results, baseline=[]):
+    '''table of the results, with the baseline's reads per second for comparison'''
+    base = dict([((r['stage'], r['size']), r) for r in baseline])
+
+    header = ['stage', 'size', 'status', 'wall s', 'reads/s', 'baseline', 'max rss MB']
+    rows = [header]
+    for r in results:
+        b = base.get((r['stage'], r['size']))
+        rows.append([r['stage'], str(r['size']), str(r['status']), "%.2f" %(r['wall']), "%.0f" %(r['reads_per_s']),
+            "%.0f" %(b['reads_per_s']) if b is not None else '-', "%.1f" %(r['max_rss_mb'])])
+
+    widths = [max([len(row[i]) for row in rows]) for i in range(len(header))]
+    lines = ["  ".join([row[0].ljust(widths[0])] + [x.rjust(w) for x, w in zip(row[1:], widths[1:])]) for row in rows]
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the stage scripts on synthetic data', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--sizes', default=[1000, 10000], type=int, nargs='+', help='numbers of read pairs')
+    parser.add_argument('--stages', default=stage_names, nargs='+', choices=stage_names, help='stages to benchmark')
+    parser.add_argument('--repeats', default=1, type=int, help='times to run each stage (the fastest is reported)')
+    parser.add_argument('--seed', default=0, type=int, help='seed for the datasets')
+    parser.add_argument('--output', '-o', default=None, help='json file for the results')
+    parser.add_argument('--baseline', default=default_baseline, help='json results to compare to')
+    parser.add_argument('--tolerance', default=0.25, type=float, help='fraction worse than the baseline that is flagged')
+    parser.add_argument('--save_baseline', action='store_true', help='write the results to the baseline, rather than comparing')
+    parser.add_argument('--work_dir', default=None, help='directory to keep the datasets and outputs in (default: temporary)')
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.sizes, args.stages, args.repeats, args.seed, args.work_dir)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        failed = ["%s at %d" %(r['stage'], r['size']) for r in report['results'] if r['status'] != 0]
+        if len(failed) > 0:
+            print summary(report['results'])
+            util.message("not saving the baseline, because some stages failed: %s" %(", ".join(failed)))
+            sys.exit(1)
+
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+        print summary(report['results'])
+        sys.exit(0)
+
+    baseline = []
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    else:
+        util.message("no baseline at %s" %(args.baseline))
+
+    print summary(report['results'], baseline)
+
+    regressions = compare(report['results'], baseline, args.tolerance)
+    if len(regressions) > 0:
+        util.message("Regressions against the baseline:\n" + "\n".join(regressions))
+        sys.exit(1)
@@ -1,32 +1,89 @@
 #!/usr/bin/env python
 
 '''
-Count the number of differences between the first sequence in a fasta file and the
-following sequences. If the two sequences are not the same length, you'll get a fractional
-answer.
+Count the number of differences (edit distance: mismatches plus indels) between sequences
+in a fasta file.
+
+By default, every sequence is compared to the first sequence in the file. With --all, every
+pair of sequences is compared and a tab-separated distance matrix is output.
 '''
 
+import argparse, sys, os
+sys.path.append(os.path.normpath(os.path.abspath(__file__) + '/../..'))
+from SmileTrain import util_align
 from Bio import SeqIO
-import argparse, difflib
+
+def distances_to_first(seqs, band=None):
+    '''
+    Edit distances between the first sequence and every sequence
+
+    seqs : list of strings
+        sequences
+    band : int or None (default None)
+        alignment band; distances above the band are reported as band + 1
+
+    returns : list of ints
+        distances, the first of which is 0
+    '''
+    return list(util_align.edit_distances(seqs[0], seqs, band))
+
+def distance_matrix(seqs, band=None, myers=False):
+    '''
+    Edit distances between every pair of sequences
+
+    seqs : list of strings
+        sequences
+    band : int or None (default None)
+        alignment band; distances above the band are reported as band + 1
+    myers : bool (default False)
+        use the bit-parallel Myers kernel (band is ignored)?
+
+    returns : list of lists of ints
+        symmetric distance matrix
+    '''
+
+    n = len(seqs)
+    matrix = [[0] * n for i in range(n)]
+    for i in range(n):
+        if myers:
+            row = [util_align.myers_distance(seqs[i], seqs[j]) for j in range(i + 1, n)]
+        else:
+            row = util_align.edit_distances(seqs[i], seqs[i + 1:], band)
+
+        for j, d in zip(range(i + 1, n), row):
+            matrix[i][j] = matrix[j][i] = int(d)
+
+    return matrix
 
 
 if __name__ == '__main__':
     # parse command line arguments
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(description='Count differences between sequences in a fasta', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('fasta', help='input fasta')
+    parser.add_argument('--all', '-a', action='store_true', help='compare all pairs of sequences, not just to the first?')
+    parser.add_argument('--band', '-b', type=int, default=None, help='alignment band (distances above band are reported as band+1)')
+    parser.add_argument('--myers', action='store_true', help='use the bit-parallel kernel (ignores band)')
     args = parser.parse_args()
-    
-    target = None
-    max_fraction = 0.0
-    for record in SeqIO.parse(args.fasta, 'fasta'):
-        if target is None:
-            target = str(record.seq)
-            l = len(target)
-        
-        d = difflib.SequenceMatcher(a=target, b=str(record.seq), autojunk=False)
-        fraction = l*(1.0 - d.ratio())
-        print "{}\t{}".format(record.id, fraction)
-        
-        max_fraction = max(fraction, max_fraction)
-    
-    print "max\t{}".format(max_fraction)
\ No newline at end of file
+
+    records = list(SeqIO.parse(args.fasta, 'fasta'))
+    ids = [record.id for record in records]
+    seqs = [str(record.seq) for record in records]
+
+    if len(seqs) == 0:
+        raise RuntimeError("no sequences found in %s" % args.fasta)
+
+    if args.all:
+        matrix = distance_matrix(seqs, args.band, args.myers)
+        print "\t".join([''] + ids)
+        for rid, row in zip(ids, matrix):
+            print "\t".join([rid] + [str(d) for d in row])
+    else:
+        if args.myers:
+            distances = [util_align.myers_distance(seqs[0], seq) for seq in seqs]
+        else:
+            distances = distances_to_first(seqs, args.band)
+
+        for rid, d in zip(ids, distances):
+            print "{}\t{}".format(rid, d)
+
+        print "max\t{}".format(max(distances))
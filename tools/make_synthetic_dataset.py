@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+
+'''
+Make a synthetic 16S amplicon dataset, for benchmarking the pipeline on realistic inputs
+of any size.
+
+A mini reference database of OTUs is made from a few random "clade" sequences, each OTU
+a mutant of its clade's sequence. Each sample has its own random abundances of some of
+the OTUs. Each read pair comes from one sample: an amplicon of one of its OTUs (or, for
+a fraction of the pairs, a chimera of two) between the primers is read from both ends,
+with quality scores that fall along the read and substitution errors at the rate those
+scores imply. The barcode read gets errors the same way.
+
+Output, in the output directory:
+    forward.fastq, reverse.fastq : the reads, in one of the layouts
+        two_file: @location#BARCODE/1 headers, the format the pipeline takes
+        three_file: @location 1:N:0:1 headers, plus index.fastq with the barcode reads
+        demultiplexed: one sample.F.fastq and sample.R.fastq per sample, with
+            @location/1 headers, and samples.txt mapping them to the samples (instead
+            of forward.fastq and reverse.fastq)
+    barcodes.txt : the barcode mapping file
+    reference/ : the mini reference, laid out like Greengenes and gold
+        97_otus.fasta (one per --sids), taxonomy.pkl, gold.fasta
+    truth.counts : the number of non-chimeric pairs from each OTU in each sample
+
+The reads are the same for a given seed, whatever the layout or quality encoding.
+'''
+
+import argparse, sys, os, string, pickle
+sys.path.append(os.path.normpath(os.path.abspath(__file__) + '/../..'))
+from SmileTrain import util
+
+import numpy as np
+
+bases = 'ACGT'
+complement = string.maketrans('ACGTMRWSYKVHDBN', 'TGCAKYWSRMBDHVN')
+iupac = {'M': 'AC', 'R': 'AG', 'W': 'AT', 'S': 'CG', 'Y': 'CT', 'K': 'GT', 'V': 'ACG', 'H': 'ACT',
+    'D': 'AGT', 'B': 'CGT', 'N': 'ACGT'}
+
+# 2-bit codes for bases
+base_codes = np.zeros(256, dtype=np.uint8)
+for code, base in enumerate(bases):
+    base_codes[ord(base)] = code
+code_bases = np.array([ord(x) for x in bases], dtype=np.uint8)
+
+# range of quality scores (both encodings can hold these)
+min_q = 2
+max_q = 40
+ascii_offsets = {'illumina18': 33, 'illumina13': 64}
+
+def reverse_complement(seq):
+    return seq.translate(complement)[::-1]
+
+def random_seq(rng, length):
+    '''random sequence of some length'''
+    return code_bases[rng.randint(0, 4, size=length)].tostring()
+
+def substitute(rng, codes, p):
+    '''
+    Change some bases to other bases, in place
+
+    codes : int array
+        2-bit codes of bases
+    p : float or float array like codes
+        probability of changing each base
+    '''
+
+    hit = rng.random_sample(codes.shape) < p
+    codes[hit] = (codes[hit] + rng.randint(1, 4, size=np.count_nonzero(hit))) % 4
+
+def mutate(rng, seq, rate):
+    '''copy of a sequence with each base changed with some probability'''
+    codes = base_codes[np.fromstring(seq, dtype=np.uint8)]
+    substitute(rng, codes, rate)
+    return code_bases[codes].tostring()
+
+def resolve_primer(rng, primer):
+    '''primer with each degenerate base replaced by one of the bases it stands for'''
+    return ''.join([rng.choice(list(iupac[x])) if x in iupac else x for x in primer])
+
+def spaced_barcodes(rng, n, length, min_distance=3, max_tries=100000):
+    '''
+    Random barcodes that all differ at some number of positions
+
+    returns : list of strings
+    '''
+
+    barcodes = []
+    for i in range(max_tries):
+        if len(barcodes) == n:
+            return barcodes
+
+        barcode = random_seq(rng, length)
+        if all([sum([a != b for a, b in zip(barcode, x)]) >= min_distance for x in barcodes]):
+            barcodes.append(barcode)
+
+    raise RuntimeError("could not find %d barcodes of length %d that differ at %d positions" %(n, length, min_distance))
+
+def abundances(rng, n, distribution, param):
+    '''
+    Random relative abundances
+
+    n : int
+        number of OTUs
+    distribution : string
+        'lognormal' (param is sigma), 'powerlaw' (param is the exponent of the rank), or
+        'uniform'
+
+    returns : float array
+        sums to 1
+    '''
+
+    if distribution == 'lognormal':
+        weights = rng.lognormal(0.0, param, size=n)
+    elif distribution == 'powerlaw':
+        weights = (1.0 + rng.permutation(n)) ** -param
+    elif distribution == 'uniform':
+        weights = np.ones(n)
+    else:
+        raise RuntimeError("unrecognized abundance distribution: %s" % distribution)
+
+    return weights / weights.sum()
+
+def qualities(rng, n, length, q_start, q_end, q_sd):
+    '''
+    Quality scores that fall linearly along the reads, with normal noise
+
+    returns : int array
+        n rows, length columns
+    '''
+
+    mean = np.linspace(q_start, q_end, length)
+    q = np.round(mean + rng.normal(0.0, q_sd, size=(n, length)))
+    return np.clip(q, min_q, max_q).astype(np.uint8)
+
+def sequence(rng, templates, quals):
+    '''
+    Read some templates with errors at the rates implied by the quality scores
+
+    templates : list of strings
+        all as long as the quality rows
+    quals : int array
+
+    returns : list of strings
+    '''
+
+    codes = base_codes[np.fromstring(''.join(templates), dtype=np.uint8)].reshape(quals.shape)
+    substitute(rng, codes, 10.0 ** (-quals.astype(np.float64) / 10.0))
+    return [code_bases[row].tostring() for row in codes]
+
+
+class Dataset():
+    '''the reference, samples, and read pairs of a synthetic dataset'''
+
+    def __init__(self, seed=0, n_otus=100, n_clades=10, divergence=0.05, novel=0.1, n_samples=10,
+        richness=0.5, distribution='lognormal', param=1.5, depth_sigma=0.5, chimeras=0.02,
+        forward_primer='GTGCCAGCMGCCGCGGTAA', reverse_primer='GGACTACHVGGGTWTCTAAT', insert_length=253,
+        read_length=250, spacer=0, barcode_length=12, q_start=38, q_end=25, q_sd=4.0, index_q=35):
+        '''
+        seed : int
+            seed for the random numbers; everything about the dataset follows from it
+        n_otus, n_clades : int
+            number of OTUs, and of the random sequences they are mutants of
+        divergence : float
+            fraction of bases that differ between an OTU and its clade's sequence
+        novel : float
+            fraction of OTUs left out of the reference
+        n_samples : int
+        richness : float
+            fraction of the OTUs present in each sample
+        distribution, param : string, float
+            abundances of the OTUs in each sample (see abundances)
+        depth_sigma : float
+            sigma of the lognormal fraction of the read pairs from each sample
+        chimeras : float
+            fraction of the read pairs from chimeras of two OTUs in a sample
+        forward_primer, reverse_primer : string
+            primers, which may have degenerate bases; the reverse primer is read at the
+            start of the reverse read
+        insert_length : int
+            length of the OTU sequences, between the primers
+        read_length : int
+        spacer : int
+            maximum number of random bases before the primer in each read
+        barcode_length : int
+        q_start, q_end, q_sd : float
+            mean quality at the start and end of each read, and its standard deviation
+        index_q : float
+            mean quality of the barcode reads (with standard deviation q_sd)
+        '''
+
+        self.rng = np.random.RandomState(seed)
+        self.forward_primer = forward_primer
+        self.reverse_primer = reverse_primer
+        self.read_length = read_length
+        self.spacer = spacer
+        self.q_start = q_start
+        self.q_end = q_end
+        self.q_sd = q_sd
+        self.index_q = index_q
+        self.chimeras = chimeras
+
+        if len(forward_primer) + insert_length + len(reverse_primer) < read_length:
+            raise RuntimeError("reads of length %d would run off the end of the amplicon" %(read_length))
+
+        # the OTUs, their taxonomies, and which are in the reference
+        roots = [random_seq(self.rng, insert_length) for i in range(n_clades)]
+        self.otu_clades = self.rng.randint(0, n_clades, size=n_otus)
+        self.otus = [mutate(self.rng, roots[c], divergence) for c in self.otu_clades]
+        self.otu_ids = [str(1000 + i) for i in range(n_otus)]
+        self.in_reference = self.rng.random_sample(n_otus) >= novel
+
+        # the samples: barcodes, share of the reads, and OTU abundances
+        self.samples = ['sample%d' %(i + 1) for i in range(n_samples)]
+        self.barcodes = spaced_barcodes(self.rng, n_samples, barcode_length)
+        self.depths = abundances(self.rng, n_samples, 'lognormal', depth_sigma)
+
+        self.weights = np.zeros((n_samples, n_otus))
+        n_present = max(1, int(round(richness * n_otus)))
+        for i in range(n_samples):
+            present = self.rng.permutation(n_otus)[:n_present]
+            self.weights[i, present] = abundances(self.rng, n_present, distribution, param)
+
+        self.cumulative = np.cumsum(self.weights, axis=1)
+
+        self.truth = np.zeros((n_samples, n_otus), dtype=int)
+
+    def taxonomy(self, otu):
+        '''made-up Greengenes-style taxonomy, shared by the OTUs of a clade'''
+        c = self.otu_clades[otu]
+        return 'k__Bacteria; p__Synth%d; c__Synth%d; o__Synth%d; f__Synth%d; g__Synth%d; s__' %(c % 3, c % 5, c % 7, c, c)
+
+    def templates(self, sample, otu, other=None):
+        '''
+        the forward and reverse templates (as long as the reads) of an amplicon, which is a
+        chimera of otu then other if other is given
+        '''
+
+        insert = self.otus[otu]
+        if other is not None:
+            k = self.rng.randint(len(insert) / 4, 3 * len(insert) / 4)
+            insert = insert[:k] + self.otus[other][k:]
+
+        forward_primer = resolve_primer(self.rng, self.forward_primer)
+        reverse_primer = resolve_primer(self.rng, self.reverse_primer)
+        amplicon = forward_primer + insert + reverse_complement(reverse_primer)
+
+        forward = random_seq(self.rng, self.rng.randint(0, self.spacer + 1)) + amplicon
+        reverse = random_seq(self.rng, self.rng.randint(0, self.spacer + 1)) + reverse_complement(amplicon)
+        return forward[:self.read_length], reverse[:self.read_length]
+
+    def pairs(self, n, batch_size=10000):
+        '''
+        The read pairs, made a batch at a time
+
+        n : int
+            number of read pairs
+
+        yields : tuples
+            (pair number, sample index, barcode read, barcode qualities, forward read,
+            forward qualities, reverse read, reverse qualities), where qualities are int
+            arrays
+        '''
+
+        for start in range(0, n, batch_size):
+            m = min(batch_size, n - start)
+            samples = self.rng.choice(len(self.samples), size=m, p=self.depths)
+            draws = self.rng.random_sample((m, 2))
+            chimeric = self.rng.random_sample(m) < self.chimeras
+
+            forward_templates = []
+            reverse_templates = []
+            for sample, (a, b), chimera in zip(samples, draws, chimeric):
+                otu = min(np.searchsorted(self.cumulative[sample], a, side='right'), len(self.otus) - 1)
+                if chimera:
+                    other = min(np.searchsorted(self.cumulative[sample], b, side='right'), len(self.otus) - 1)
+                    forward, reverse = self.templates(sample, otu, other)
+                else:
+                    forward, reverse = self.templates(sample, otu)
+                    self.truth[sample, otu] += 1
+
+                forward_templates.append(forward)
+                reverse_templates.append(reverse)
+
+            barcode_quals = qualities(self.rng, m, len(self.barcodes[0]), self.index_q, self.index_q, self.q_sd)
+            barcode_reads = sequence(self.rng, [self.barcodes[s] for s in samples], barcode_quals)
+            forward_quals = qualities(self.rng, m, self.read_length, self.q_start, self.q_end, self.q_sd)
+            forward_reads = sequence(self.rng, forward_templates, forward_quals)
+            reverse_quals = qualities(self.rng, m, self.read_length, self.q_start, self.q_end, self.q_sd)
+            reverse_reads = sequence(self.rng, reverse_templates, reverse_quals)
+
+            for i in range(m):
+                yield (start + i, samples[i], barcode_reads[i], barcode_quals[i], forward_reads[i],
+                    forward_quals[i], reverse_reads[i], reverse_quals[i])
+
+    def write_reference(self, ref_dir, sids=[97]):
+        '''write the OTUs in the reference as n_otus.fasta files, a taxonomy pickle, and a gold fasta'''
+        if not os.path.isdir(ref_dir):
+            os.makedirs(ref_dir)
+
+        entries = [">%s\n%s\n" %(self.otu_ids[i], self.otus[i]) for i in range(len(self.otus)) if self.in_reference[i]]
+        for fn in ['%d_otus.fasta' %(sid) for sid in sids] + ['gold.fasta']:
+            with open(os.path.join(ref_dir, fn), 'w') as f:
+                f.write("".join(entries))
+
+        taxonomies = dict([(self.otu_ids[i], self.taxonomy(i)) for i in range(len(self.otus)) if self.in_reference[i]])
+        with open(os.path.join(ref_dir, 'taxonomy.pkl'), 'wb') as f:
+            pickle.dump(taxonomies, f)
+
+    def write_barcodes(self, output):
+        for sample, barcode in zip(self.samples, self.barcodes):
+            output.write("%s\t%s\n" %(sample, barcode))
+
+    def write_truth(self, output):
+        '''true pair counts, in the format of a sequence table'''
+        output.write("sequence_id\t" + "\t".join(self.samples) + "\n")
+        for otu in range(len(self.otus)):
+            output.write(self.otu_ids[otu] + "\t" + "\t".join([str(x) for x in self.truth[:, otu]]) + "\n")
+
+
+def location(i, fastq_format):
+    '''a made-up instrument location for the i-th pair'''
+    x, y = 1000 + i / 20000, 1000 + i % 20000
+    if fastq_format == 'illumina13':
+        return "HWI-SYNTH:1:1:%d:%d" %(x, y)
+    else:
+        return "M00000:1:000000000-SYNTH:1:1101:%d:%d" %(x, y)
+
+def fastq_entry(label, seq, quals, offset):
+    return "@%s\n%s\n+\n%s\n" %(label, seq, (quals + offset).astype(np.uint8).tostring())
+
+def write_reads(dataset, n, out_dir, layout='two_file', fastq_format='illumina18'):
+    '''
+    Write the read pairs in one of the layouts
+
+    dataset : Dataset
+    n : int
+        number of read pairs
+    out_dir : string
+    layout : string
+        'two_file', 'three_file', or 'demultiplexed'
+    fastq_format : string
+        'illumina18' or 'illumina13'
+    '''
+
+    offset = ascii_offsets[fastq_format]
+    fn = lambda x: os.path.join(out_dir, x)
+
+    if layout == 'demultiplexed':
+        names = [('%s.F.fastq' %(s), '%s.R.fastq' %(s)) for s in dataset.samples]
+        with open(fn('samples.txt'), 'w') as f:
+            for (forward, reverse), sample in zip(names, dataset.samples):
+                f.write("%s\t%s\t%s\n" %(forward, reverse, sample))
+
+        outs = [(open(fn(forward), 'w'), open(fn(reverse), 'w')) for forward, reverse in names]
+    elif layout in ['two_file', 'three_file']:
+        outs = [open(fn('forward.fastq'), 'w'), open(fn('reverse.fastq'), 'w')]
+        if layout == 'three_file':
+            outs.append(open(fn('index.fastq'), 'w'))
+    else:
+        raise RuntimeError("unrecognized layout: %s" % layout)
+
+    try:
+        for i, sample, barcode, barcode_quals, forward, forward_quals, reverse, reverse_quals in dataset.pairs(n):
+            loc = location(i, fastq_format)
+            if layout == 'two_file':
+                outs[0].write(fastq_entry("%s#%s/1" %(loc, barcode), forward, forward_quals, offset))
+                outs[1].write(fastq_entry("%s#%s/2" %(loc, barcode), reverse, reverse_quals, offset))
+            elif layout == 'three_file':
+                outs[0].write(fastq_entry("%s 1:N:0:1" %(loc), forward, forward_quals, offset))
+                outs[1].write(fastq_entry("%s 2:N:0:1" %(loc), reverse, reverse_quals, offset))
+                outs[2].write(fastq_entry("%s 1:N:0:1" %(loc), barcode, barcode_quals, offset))
+            else:
+                outs[sample][0].write(fastq_entry("%s/1" %(loc), forward, forward_quals, offset))
+                outs[sample][1].write(fastq_entry("%s/2" %(loc), reverse, reverse_quals, offset))
+    finally:
+        for out in util.listify(outs):
+            for f in util.listify(out):
+                f.close()
+
+def make_dataset(out_dir, n, layout='two_file', fastq_format='illumina18', sids=[97], **kwargs):
+    '''
+    Write a whole dataset into a directory
+
+    out_dir : string
+    n : int
+        number of read pairs
+    layout, fastq_format : string
+        see write_reads
+    sids : list of ints
+        OTU identities to name reference fastas for
+    kwargs :
+        options for Dataset
+
+    returns : Dataset
+    '''
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    dataset = Dataset(**kwargs)
+    write_reads(dataset, n, out_dir, layout, fastq_format)
+    dataset.write_reference(os.path.join(out_dir, 'reference'), sids)
+
+    with open(os.path.join(out_dir, 'barcodes.txt'), 'w') as f:
+        dataset.write_barcodes(f)
+
+    with open(os.path.join(out_dir, 'truth.counts'), 'w') as f:
+        dataset.write_truth(f)
+
+    return dataset
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Make a synthetic 16S amplicon dataset', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('out_dir', help='output directory')
+    parser.add_argument('--reads', '-n', default=10000, type=int, help='number of read pairs')
+    parser.add_argument('--seed', default=0, type=int, help='random seed')
+    parser.add_argument('--layout', choices=['two_file', 'three_file', 'demultiplexed'], default='two_file', help='how the reads are laid out in files')
+    parser.add_argument('--format', choices=['illumina18', 'illumina13'], default='illumina18', help='quality encoding and headers')
+    parser.add_argument('--sids', default=[97], type=int, nargs='+', help='OTU identities to name reference fastas for')
+
+    group = parser.add_argument_group('community')
+    group.add_argument('--samples', default=10, type=int, help='number of samples')
+    group.add_argument('--otus', default=100, type=int, help='number of OTUs')
+    group.add_argument('--clades', default=10, type=int, help='number of random sequences the OTUs are mutants of')
+    group.add_argument('--divergence', default=0.05, type=float, help='fraction of bases that differ between an OTU and its clade sequence')
+    group.add_argument('--novel', default=0.1, type=float, help='fraction of OTUs left out of the reference')
+    group.add_argument('--richness', default=0.5, type=float, help='fraction of OTUs present in each sample')
+    group.add_argument('--abundance', choices=['lognormal', 'powerlaw', 'uniform'], default='lognormal', help='distribution of OTU abundances in each sample')
+    group.add_argument('--abundance_param', default=1.5, type=float, help='sigma of lognormal, or exponent of powerlaw, abundances')
+    group.add_argument('--depth_sigma', default=0.5, type=float, help='sigma of the lognormal share of reads from each sample')
+    group.add_argument('--chimeras', default=0.02, type=float, help='fraction of pairs from chimeric amplicons')
+
+    group = parser.add_argument_group('amplicon')
+    group.add_argument('--forward_primer', '-p', default='GTGCCAGCMGCCGCGGTAA', help='forward primer')
+    group.add_argument('--reverse_primer', '-q', default='GGACTACHVGGGTWTCTAAT', help='reverse primer')
+    group.add_argument('--insert_length', default=253, type=int, help='length of amplicon between the primers')
+    group.add_argument('--barcode_length', default=12, type=int, help='length of barcodes')
+    group.add_argument('--spacer', default=0, type=int, help='maximum number of random bases before the primer')
+
+    group = parser.add_argument_group('error profile')
+    group.add_argument('--read_length', default=250, type=int, help='length of the reads')
+    group.add_argument('--q_start', default=38.0, type=float, help='mean quality at the start of the reads')
+    group.add_argument('--q_end', default=25.0, type=float, help='mean quality at the end of the reads')
+    group.add_argument('--q_sd', default=4.0, type=float, help='standard deviation of the qualities')
+    group.add_argument('--index_q', default=35.0, type=float, help='mean quality of barcode reads')
+    args = parser.parse_args()
+
+    make_dataset(args.out_dir, args.reads, args.layout, args.format, args.sids, seed=args.seed,
+        n_otus=args.otus, n_clades=args.clades, divergence=args.divergence, novel=args.novel,
+        n_samples=args.samples, richness=args.richness, distribution=args.abundance,
+        param=args.abundance_param, depth_sigma=args.depth_sigma, chimeras=args.chimeras,
+        forward_primer=args.forward_primer, reverse_primer=args.reverse_primer,
+        insert_length=args.insert_length, read_length=args.read_length, spacer=args.spacer,
+        barcode_length=args.barcode_length, q_start=args.q_start, q_end=args.q_end,
+        q_sd=args.q_sd, index_q=args.index_q)
+
+    util.message("Wrote %d read pairs to %s; use -p %s -q %s -b barcodes.txt" %(args.reads, args.out_dir, args.forward_primer, args.reverse_primer))
@@ -1,5 +1,6 @@
 import sys
 import math
+import numpy
 
 # WARNING
 # FASTQ formats differ:
@@ -23,6 +24,99 @@ def SetIllumina():
 	Q_Min = 0
 	Q_Max = 41
 	
+# Lookup tables indexed by quality character, built for each
+# (ASCII_Offset, Q_Min, Q_Max) on first use. Characters outside
+# the valid range map to IntQual -1 and Prob nan.
+Tables = {}
+
+def GetTables():
+	global Tables
+	Key = (ASCII_Offset, Q_Min, Q_Max)
+	if Key not in Tables:
+		IntQual = numpy.full(256, -1, dtype=numpy.int64)
+		Prob = numpy.full(256, numpy.nan)
+		iq = numpy.arange(Q_Min, Q_Max+1)
+		IntQual[ASCII_Offset + iq] = iq
+		Prob[ASCII_Offset + iq] = 10**(-iq/10.0)
+		Tables[Key] = (IntQual, Prob)
+	return Tables[Key]
+
+def QualMatrix(Quals):
+	L = numpy.array([len(Qual) for Qual in Quals], dtype=numpy.int64)
+	W = 0
+	if len(L) > 0:
+		W = L.max()
+	M = numpy.full((len(Quals), W), ASCII_Offset + Q_Max, dtype=numpy.uint8)
+	for i in range(0, len(Quals)):
+		M[i, :L[i]] = numpy.frombuffer(Quals[i], dtype=numpy.uint8)
+	return M, L
+
+def BatchMatrix(Quals, Lengths):
+	if isinstance(Quals, numpy.ndarray):
+		M = Quals
+		if Lengths is None:
+			Lengths = numpy.full(M.shape[0], M.shape[1], dtype=numpy.int64)
+	else:
+		M, Lengths = QualMatrix(Quals)
+	Valid = numpy.arange(M.shape[1]) < Lengths[:, numpy.newaxis]
+	return M, Lengths, Valid
+
+def BatchIntQuals(M, Valid):
+	IntQual, Prob = GetTables()
+	IQ = IntQual[M]
+	Bad = Valid & (IQ < 0)
+	if Bad.any():
+		r, i = numpy.argwhere(Bad)[0]
+		c = chr(M[r, i])
+		raise RuntimeError("quality character %r (ascii %d) out of range Q_Min %d Q_Max %d" % (c, ord(c), Q_Min, Q_Max))
+	return IQ
+
+def GetEEBatch(Quals, Lengths=None):
+	M, Lengths, Valid = BatchMatrix(Quals, Lengths)
+	BatchIntQuals(M, Valid)
+	IntQual, Prob = GetTables()
+	return numpy.where(Valid, Prob[M], 0.0).sum(axis=1)
+
+def GetAvgQBatch(Quals, Lengths=None):
+	M, Lengths, Valid = BatchMatrix(Quals, Lengths)
+	IQ = BatchIntQuals(M, Valid)
+	SumQ = numpy.where(Valid, IQ, 0).sum(axis=1)
+	return SumQ/numpy.maximum(Lengths, 1).astype(float)
+
+def GetAvgPBatch(Quals, Lengths=None):
+	EE = GetEEBatch(Quals, Lengths)
+	if Lengths is None:
+		Lengths = numpy.array([len(Qual) for Qual in Quals])
+	return EE/numpy.maximum(Lengths, 1)
+
+def TruncMask(Seqs, M, Valid, TruncQ, TruncN):
+	IQ = BatchIntQuals(M, Valid)
+	Trunc = Valid & (IQ <= TruncQ)
+	if TruncN:
+		S, SL = QualMatrix(Seqs)
+		Trunc |= Valid & (S == ord('N'))
+	return Trunc
+
+# Position of the first base with quality <= TruncQ (or the
+# first N if TruncN), or the read length if there is none.
+def TruncPosBatch(Seqs, Quals, TruncQ, TruncN, Lengths=None):
+	M, Lengths, Valid = BatchMatrix(Quals, Lengths)
+	if M.shape[1] == 0:
+		return Lengths
+	Trunc = TruncMask(Seqs, M, Valid, TruncQ, TruncN)
+	return numpy.where(Trunc.any(axis=1), Trunc.argmax(axis=1), Lengths)
+
+# Position of the last base with quality <= TruncQ (or the last
+# N if TruncN), or 0 if there is none.
+def TruncPosRevBatch(Seqs, Quals, TruncQ, TruncN, Lengths=None):
+	M, Lengths, Valid = BatchMatrix(Quals, Lengths)
+	if M.shape[1] == 0:
+		return numpy.zeros(len(Lengths), dtype=numpy.int64)
+	Trunc = TruncMask(Seqs, M, Valid, TruncQ, TruncN)
+	W = M.shape[1]
+	Last = W - 1 - Trunc[:, ::-1].argmax(axis=1)
+	return numpy.where(Trunc.any(axis=1), Last, 0)
+
 def GetLine():
 	global File
 
@@ -41,8 +135,7 @@ def CharToIntQual(c):
 	ic = ord(c)
 	iq = ic - ASCII_Offset
 	if iq < Q_Min or iq > Q_Max:
-		print >> sys.stderr, "c=%c ic=%d iq=%d Q_Min %d Q_Max %d" % (c, ic, iq, Q_Min, Q_Max)
-		assert False
+		raise RuntimeError("quality character %r (ascii %d, Q %d) out of range Q_Min %d Q_Max %d" % (c, ic, iq, Q_Min, Q_Max))
 
 	return iq
 
@@ -53,10 +146,10 @@ def ProbToIntQual(P):
 	return -10*math.log10(P)
 
 def CharToProb(c):
-	ic = ord(c)
-	iq = ic - ASCII_Offset
-	assert iq >= Q_Min and iq <= Q_Max
-	return 10**(-iq/10.0)
+	IntQual, Prob = GetTables()
+	P = Prob[ord(c)]
+	assert not numpy.isnan(P)
+	return float(P)
 
 def GetRec(File):
 	Line = File.readline()
@@ -76,27 +169,12 @@ def GetRec(File):
 	return Label, Seq, Qual
 
 def TruncRec(Seq, Qual, TruncQ, TruncN):
-	L = len(Seq)
-	for i in range(0, L):
-		q = Qual[i]
-		iq = CharToIntQual(q)
-		if iq <= TruncQ:
-			return Seq[:i], Qual[:i]
-		if TruncN and Seq[i] == 'N':
-			return Seq[:i], Qual[:i]
-	return Seq, Qual
+	i = TruncPosBatch([Seq], [Qual], TruncQ, TruncN)[0]
+	return Seq[:i], Qual[:i]
 
 def TruncRecRev(Seq, Qual, TruncQ, TruncN):
-	L = len(Seq)
-	for k in range(0, L):
-		i = L - k - 1
-		q = Qual[i]
-		iq = CharToIntQual(q)
-		if iq <= TruncQ:
-			return Seq[i:], Qual[i:]
-		if TruncN and Seq[i] == 'N':
-			return Seq[i:], Qual[i:]
-	return Seq, Qual
+	i = TruncPosRevBatch([Seq], [Qual], TruncQ, TruncN)[0]
+	return Seq[i:], Qual[i:]
 
 def GetRecTruncQual(File, MinQ):
 	Label, Seq, Qual = GetRec(File)
@@ -152,37 +230,10 @@ def PrintTable():
 		print "%c  %2d  %7.5f" % (IntQualToChar(iq), iq, 10**(-iq/10.0))
 
 def GetAvgQ(Qual):
-	SumQ = 0
-	L = len(Qual)
-	if L == 0:
-		return 0.0
-
-	for q in Qual:
-		iq = CharToIntQual(q)
-		SumQ += iq
-
-	return float(SumQ)/L
+	return float(GetAvgQBatch([Qual])[0])
 
 def GetAvgP(Qual):
-	SumP = 0
-	L = len(Qual)
-	if L == 0:
-		return 0.0
-
-	for q in Qual:
-		P = CharToProb(q)
-		SumP += P
-
-	return float(SumP)/L
+	return float(GetAvgPBatch([Qual])[0])
 
 def GetEE(Qual):
-	SumP = 0
-	L = len(Qual)
-	if L == 0:
-		return 0.0
-
-	for q in Qual:
-		P = CharToProb(q)
-		SumP += P
-
-	return SumP
+	return float(GetEEBatch([Qual])[0])
@@ -1,4 +1,4 @@
-import re, string, sys, time, itertools, os, subprocess
+import re, string, sys, time, itertools, os, stat, subprocess
 import usearch_python.primer
 
 def listify(inp):
@@ -26,6 +26,95 @@ def check_for_collisions(filenames):
         bad_names = " ".join([filename for filename, test in zip(filenames, tests) if test == True])
         raise RuntimeError("output file(s) already exist: %s" % bad_names)
 
+def wait_for_files(filenames, nonempty=True, retries=5, delay=0.1, factor=2.0, sleep=time.sleep):
+    '''
+    Check that files exist (and are nonempty) in one pass, looking again at the ones
+    that fail after waiting a little longer each time. On network filesystems, a file
+    written on another node can look missing or empty until the local attribute cache
+    expires; listing the file's directory refreshes it.
+
+    filenames : list of strings
+    nonempty : bool (default True)
+        also require each file to be nonempty
+    retries : int (default 5)
+        number of times to look again at files that fail
+    delay : float (default 0.1)
+        seconds to wait before the first retry
+    factor : float (default 2.0)
+        how much longer to wait before each later retry
+
+    returns : tuple
+        (list of missing files, list of empty files) after the last look
+    '''
+
+    filenames = listify(filenames)
+
+    def bad_files(fns):
+        missing = []
+        empty = []
+        for fn in fns:
+            try:
+                info = os.stat(fn)
+            except OSError:
+                missing.append(fn)
+                continue
+
+            # a directory (or anything else that is not a regular file) does not count
+            if not stat.S_ISREG(info.st_mode):
+                missing.append(fn)
+                continue
+
+            if nonempty and info.st_size == 0:
+                empty.append(fn)
+
+        return missing, empty
+
+    missing, empty = bad_files(filenames)
+    for attempt in range(retries):
+        if len(missing) + len(empty) == 0:
+            break
+
+        sleep(delay)
+        delay *= factor
+
+        for dirname in set([os.path.dirname(fn) or '.' for fn in missing + empty]):
+            try:
+                os.listdir(dirname)
+            except OSError:
+                pass
+
+        missing, empty = bad_files(missing + empty)
+
+    return missing, empty
+
+def fastq_entries(fastq):
+    '''
+    Read a fastq without parsing the quality scores
+    
+    fastq : filehandle
+        input fastq (four lines per entry)
+    
+    yields : tuples
+        (label without the @, sequence, quality line)
+    '''
+    
+    while True:
+        at_line = fastq.readline()
+        if len(at_line) == 0:
+            return
+
+        if not at_line.startswith('@'):
+            raise RuntimeError("fastq entry does not start with @: %s" % at_line)
+
+        seq = fastq.readline().rstrip()
+        fastq.readline()
+        qual = fastq.readline().rstrip()
+
+        if len(seq) != len(qual):
+            raise RuntimeError("sequence and quality lengths differ in %s" % at_line)
+
+        yield (at_line.rstrip()[1:], seq, qual)
+
 def message(text, indent=2):
     '''print message to stderr'''
     space = ' ' * indent
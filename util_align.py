@@ -0,0 +1,191 @@
+'''
+Global alignment kernels for computing distances and identities between sequences.
+
+All distances are unit-cost edit (Levenshtein) distances: every mismatch, insertion, or
+deletion costs 1. Three kernels are provided:
+    * edit_distances: banded Needleman-Wunsch of one query against many targets. The
+      dynamic programming matrix is filled one anti-diagonal at a time, so that every
+      cell on a diagonal (and every target) is computed in a single NumPy operation.
+    * edit_distance: the same kernel for a single pair of sequences
+    * myers_distance: Myers' bit-parallel algorithm (in Hyyro's global form), which
+      uses Python integers as bit vectors and is fastest for unbanded single pairs
+
+Banded distances are exact up to the band width. Pairs whose distance is larger than the
+band are reported as band + 1, which is enough to decide "is the distance at most k?" by
+using a band of k.
+'''
+
+import numpy as np
+
+def encode(seq):
+    '''string -> uint8 array of character codes'''
+    return np.frombuffer(str(seq), dtype=np.uint8)
+
+def edit_distances(query, targets, band=None):
+    '''
+    Banded global edit distances between one query and many targets.
+
+    query : string
+        sequence to be compared against every target
+    targets : list of strings
+        sequences to compare the query against
+    band : int or None (default None)
+        maximum difference between query and target positions on the alignment path;
+        None means no band (exact distances)
+
+    returns : numpy array of ints
+        distances in the same order as targets; values above the band are band + 1
+    '''
+
+    m = len(query)
+    lens = np.array([len(t) for t in targets], dtype=np.int64)
+    n_targets = len(lens)
+
+    if n_targets == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    n = lens.max()
+    if band is None:
+        band = max(m, n)
+    cap = band + 1
+
+    if m == 0:
+        return np.minimum(lens, cap)
+
+    # targets padded with zeros, which never match a sequence character. targets are
+    # stored reversed so that the target positions along an anti-diagonal are contiguous.
+    q = encode(query)
+    t = np.zeros((n_targets, n + 1), dtype=np.uint8)
+    for k, target in enumerate(targets):
+        t[k, :len(target)] = encode(target)
+    t_rev = t[:, ::-1].copy()
+
+    # every distance saturates at cap. capping commutes with the recursion (all costs
+    # are non-negative), so capped values are exact whenever they are below the cap.
+    # cells past the end of a shorter target are computed against padding, but they never
+    # feed back into that target's matrix.
+    # three rotating buffers hold anti-diagonals k, k-1, and k-2, indexed by query
+    # position i; the target position is j = k - i.
+    bufs = [np.full((n_targets, m + 1), cap, dtype=np.int32) for x in range(3)]
+    spans = [(0, 0), (0, 0), (0, 0)]
+    bufs[0][:, 0] = 0
+    prev1, prev2 = 0, 2
+    distances = np.full(n_targets, cap, dtype=np.int64)
+
+    for k in range(1, m + n + 1):
+        cur = 3 - prev1 - prev2
+        D, P1, P2 = bufs[cur], bufs[prev1], bufs[prev2]
+
+        # wipe the cells this buffer last held (anti-diagonal k-3)
+        lo_old, hi_old = spans[cur]
+        D[:, lo_old:hi_old + 1] = cap
+
+        # query positions on this anti-diagonal that are inside the matrix and the band
+        lo = max(0, k - n, (k - band + 1) // 2)
+        hi = min(m, k, (k + band) // 2)
+        spans[cur] = (lo, hi)
+
+        if lo <= hi:
+            # left neighbor (i, j-1) is on the previous diagonal at the same i
+            best = P1[:, lo:hi + 1] + 1
+
+            # upper neighbor (i-1, j) is on the previous diagonal at i-1
+            if lo > 0:
+                np.minimum(best, P1[:, lo - 1:hi] + 1, out=best)
+            else:
+                np.minimum(best[:, 1:], P1[:, 0:hi] + 1, out=best[:, 1:])
+
+            # diagonal neighbor (i-1, j-1) is two diagonals back at i-1; needs i, j >= 1
+            a = max(lo, 1)
+            b = min(hi, k - 1)
+            if a <= b:
+                subst = t_rev[:, n - k + a + 1:n - k + b + 2] != q[a - 1:b]
+                np.minimum(best[:, a - lo:b - lo + 1], P2[:, a - 1:b] + subst, out=best[:, a - lo:b - lo + 1])
+
+            np.minimum(best, cap, out=D[:, lo:hi + 1])
+
+            # targets whose final cell (m, len) lies on this diagonal are finished
+            if lo <= m <= hi:
+                done = lens == k - m
+                distances[done] = D[done, m]
+
+        prev1, prev2 = cur, prev1
+
+    return distances
+
+def edit_distance(a, b, band=None):
+    '''banded global edit distance between two sequences'''
+    return int(edit_distances(a, [b], band)[0])
+
+def myers_distance(a, b):
+    '''
+    Global edit distance using Myers' bit-parallel algorithm.
+
+    Each column of the dynamic programming matrix is represented by bit vectors of
+    vertical +1 and -1 differences, so that a whole column is updated with a handful
+    of integer operations.
+
+    a, b : strings
+        sequences to compare
+
+    returns : int
+        edit distance
+    '''
+
+    m = len(a)
+    if m == 0:
+        return len(b)
+
+    # peq[c] has bit i set wherever a[i] == c
+    peq = {}
+    for i, c in enumerate(a):
+        peq[c] = peq.get(c, 0) | (1 << i)
+
+    mask = (1 << m) - 1
+    high = 1 << (m - 1)
+    pv = mask
+    mv = 0
+    score = m
+
+    for c in b:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = (mv | ~(xh | pv)) & mask
+        mh = pv & xh
+
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+
+        # the first row of a global alignment increases by one in every column
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv
+
+    return score
+
+def identity(distance, len1, len2):
+    '''
+    Fraction identity implied by an edit distance, relative to the longer sequence
+
+    distance : int
+        edit distance
+    len1, len2 : int
+        lengths of the two sequences
+
+    returns : float
+        1 - distance / max(len1, len2)
+    '''
+
+    longest = max(len1, len2)
+    if longest == 0:
+        return 1.0
+    else:
+        return 1.0 - float(distance) / longest
+
+def max_differences(sid, len1, len2):
+    '''largest edit distance that keeps two sequences at or above sid percent identity'''
+    return int((1.0 - sid / 100.0) * max(len1, len2) + 1e-9)
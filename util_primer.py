@@ -108,7 +108,7 @@ class PrimerRemover():
                         success = False
 
                 if success:
-                    new_record = SeqRecord.SeqRecord(seq=str(trim_seq), id=record.id, letter_annotations={'phred_quality': trim_quality}, description="")
+                    new_record = SeqRecord.SeqRecord(seq=trim_seq, id=record.id, letter_annotations={'phred_quality': trim_quality}, description="")
                     self.n_successes += 1
 
                     return new_record
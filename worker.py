@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+'''
+Long-lived workers that run pipeline commands without starting a new interpreter for
+each one.
+
+Most pipeline commands are `python <library>/<script>.py ...`. Each of those pays for
+interpreter startup and for importing Biopython, numpy, and the library's modules. A
+worker imports those once and then runs each script in its own process, as if it were
+the main program, with sys.argv set to the command's arguments. Other commands (usearch,
+mv, shell lines with redirects) are run in a shell as usual.
+
+Workers take commands from a queue directory, which is shared by the workers on the
+local machine or on cluster nodes. A command is a json file in todo/. A worker claims it
+by renaming it into claimed/, which only one worker can do, and writes the exit status
+to done/ when it has finished.
+'''
+
+import os, sys, time, json, glob, socket, shlex, runpy, traceback, argparse, gc
+import telemetry
+
+library_dir = os.path.dirname(os.path.abspath(__file__))
+script_fn = os.path.abspath(__file__).replace('.pyc', '.py')
+
+# modules worth importing before the first command
+warm_modules = ['argparse', 'itertools', 're', 'numpy', 'Bio.SeqIO', 'Bio.Seq', 'Bio.SeqRecord',
+    'util', 'util_index', 'util_primer', 'util_align', 'usearch_python.primer', 'usearch_python.fastq']
+
+# characters that mean a command has to go to a shell
+shell_characters = set('|&;<>()$`\\"\'*?[]#~=%')
+
+def warm_up():
+    '''import the library's modules, so later commands do not have to'''
+    for path in [library_dir, os.path.dirname(library_dir)]:
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+    for module in warm_modules:
+        # a module that cannot be imported should fail the commands that need it, not
+        # the worker
+        try:
+            __import__(module)
+        except Exception:
+            pass
+
+def script_call(cmd):
+    '''
+    The script and arguments of a command that runs a python script from this library
+
+    cmd : list of words or shell string
+
+    returns : tuple or None
+        (script filename, list of arguments), or None if the command is something else
+    '''
+
+    if isinstance(cmd, list):
+        words = [str(x) for x in cmd]
+    elif shell_characters.intersection(cmd):
+        return None
+    else:
+        words = shlex.split(cmd)
+
+    if len(words) < 2 or words[0] != 'python' or not words[1].endswith('.py'):
+        return None
+
+    script = words[1]
+    if os.path.dirname(os.path.realpath(script)) != os.path.realpath(library_dir):
+        return None
+
+    return script, words[2:]
+
+def exit_status(code):
+    '''exit status from the code of a SystemExit, as the interpreter would give it'''
+    if code is None:
+        return 0
+    elif isinstance(code, int):
+        return code
+    else:
+        sys.stderr.write("%s\n" %(code))
+        return 1
+
+def run_script(script, args):
+    '''
+    Run a python script in this process as the main program
+
+    returns : int
+        exit status
+    '''
+
+    old_argv = sys.argv
+    sys.argv = [script] + args
+
+    try:
+        runpy.run_path(script, run_name='__main__')
+        status = 0
+    except SystemExit as e:
+        status = exit_status(e.code)
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.argv = old_argv
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+    return status
+
+def fork_script(script, args):
+    '''
+    Start a script in a forked copy of this process, so that whatever the script changes
+    (open files, module globals, memory) goes away with it
+
+    returns : int
+        process id of the fork
+    '''
+
+    # output still buffered in this process would otherwise be written twice
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            status = run_script(script, args)
+
+            # _exit skips the interpreter's cleanup, so close any files the script
+            # left open before leaving
+            gc.collect()
+        finally:
+            os._exit(status)
+
+    return pid
+
+def run_command(cmd):
+    '''
+    Run a command, in a copy of this process if it is one of the library's scripts
+
+    returns : tuple
+        (exit status, resource usage of the process that ran the command alone)
+    '''
+
+    call = script_call(cmd)
+    if call is not None:
+        return telemetry.wait_for(fork_script(*call))
+    elif isinstance(cmd, list):
+        return telemetry.run_shell(" ".join([str(x) for x in cmd]))
+    else:
+        return telemetry.run_shell(cmd)
+
+
+class TaskQueue():
+    '''a directory of commands for workers to claim and run'''
+
+    def __init__(self, queue_dir):
+        self.dir = queue_dir
+        for sub in ['todo', 'claimed', 'done']:
+            path = os.path.join(queue_dir, sub)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        self.stop_fn = os.path.join(queue_dir, 'stop')
+
+    def write(self, fn, content):
+        '''write a json file that appears all at once'''
+        with open(fn + '.tmp', 'w') as f:
+            json.dump(content, f)
+
+        os.rename(fn + '.tmp', fn)
+
+    def put(self, task_id, cmd, record_dir=None, stage=None):
+        '''
+        add a command to the queue
+
+        task_id : int
+            unique number for the command
+        cmd : list of words or shell string
+        record_dir, stage : strings (optional)
+            where to write the command's telemetry record, and its stage
+        '''
+
+        done_fn = os.path.join(self.dir, 'done', str(task_id))
+        if os.path.isfile(done_fn):
+            os.remove(done_fn)
+
+        self.write(os.path.join(self.dir, 'todo', str(task_id)), {'command': cmd, 'record_dir': record_dir, 'stage': stage})
+
+    def claim(self):
+        '''
+        take the next command from the queue
+
+        returns : tuple or None
+            (task id, task), or None if there are no commands waiting
+        '''
+
+        fns = glob.glob(os.path.join(self.dir, 'todo', '*'))
+        for fn in sorted([fn for fn in fns if not fn.endswith('.tmp')], key=lambda fn: int(os.path.basename(fn))):
+            task_id = os.path.basename(fn)
+            claimed_fn = os.path.join(self.dir, 'claimed', '%s.%s.%d' %(task_id, socket.gethostname(), os.getpid()))
+
+            try:
+                os.rename(fn, claimed_fn)
+            except OSError:
+                # another worker got it first
+                continue
+
+            with open(claimed_fn) as f:
+                return int(task_id), json.load(f)
+
+        return None
+
+    def finish(self, task_id, status):
+        self.write(os.path.join(self.dir, 'done', str(task_id)), {'status': status})
+
+    def status(self, task_id):
+        '''exit status of a command, or None if it has not finished'''
+        fn = os.path.join(self.dir, 'done', str(task_id))
+        if not os.path.isfile(fn):
+            return None
+
+        with open(fn) as f:
+            return json.load(f)['status']
+
+    def cancel(self, task_id):
+        '''take a command off the queue if no worker has claimed it'''
+        try:
+            os.remove(os.path.join(self.dir, 'todo', str(task_id)))
+        except OSError:
+            pass
+
+    def stop(self):
+        '''tell the workers to exit once the queue is empty'''
+        with open(self.stop_fn, 'w') as f:
+            f.write('stop\n')
+
+    def stopped(self):
+        return os.path.isfile(self.stop_fn)
+
+
+def run_task(task):
+    '''run a task from the queue, echoing it and measuring it if asked to'''
+    cmd = task['command']
+    if isinstance(cmd, list):
+        line = " ".join([str(x) for x in cmd])
+    else:
+        line = cmd
+
+    sys.stdout.write(line + "\n")
+    sys.stdout.flush()
+
+    if task['record_dir'] is None:
+        return run_command(cmd)[0]
+
+    record = telemetry.measure(line, run=lambda: run_command(cmd))
+    record['stage'] = task['stage'] or 'other'
+
+    try:
+        telemetry.write_record(record, task['record_dir'])
+    except (IOError, OSError) as e:
+        sys.stderr.write("telemetry: could not write record: %s\n" %(e))
+
+    return record['status']
+
+def serve(queue, exit_when_idle=False, poll_interval=0.05):
+    '''
+    claim and run commands until told to stop
+
+    queue : TaskQueue
+    exit_when_idle : bool (default False)
+        exit as soon as the queue is empty, rather than waiting for more commands
+    poll_interval : float (default 0.05)
+        seconds to wait between looks at an empty queue
+    '''
+
+    warm_up()
+
+    while True:
+        claimed = queue.claim()
+        if claimed is not None:
+            task_id, task = claimed
+            queue.finish(task_id, run_task(task))
+        elif exit_when_idle or queue.stopped():
+            break
+        else:
+            time.sleep(poll_interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run commands from a queue directory in a warm interpreter', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('queue_dir', help='queue directory')
+    parser.add_argument('--exit_when_idle', action='store_true', help='exit when the queue is empty, rather than waiting for a stop file')
+    args = parser.parse_args()
+
+    serve(TaskQueue(args.queue_dir), exit_when_idle=args.exit_when_idle)